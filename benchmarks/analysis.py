@@ -0,0 +1,92 @@
+#! /usr/bin/env python3
+"""
+End-to-end benchmark of the Python side of an analysis without a JVM
+
+Generates synthetic repositories and analyses them with ReverseServer, Analysis and SonarLintRuleResolver against
+the stand-in language server from fake_language_server.py. Reports files and MB per second, the wall-clock time per
+JSON-RPC message and the peak of Python allocations (with --memory, which slows everything else down).
+
+Usage: python benchmarks/analysis.py [--files 1000,10000,100000] [--diagnostics 10] [--message-size 60]
+                                     [--latency 0] [--rules 20] [--max-open 64] [--memory]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, __file__.rsplit('/', 2)[0])
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_language_server import generate_repository, start_in_thread
+from sonarlintcli import sonarlint, stats
+from sonarlintcli.languageserver import ReverseServer
+
+
+async def run(files, options, max_open):
+    server = ReverseServer()
+    await server.start()
+    thread = start_in_thread(server.addr[1], **options)
+    await server.wait_for_connection()
+    await sonarlint.initialize(server, "file:///benchmark")
+    resolver = sonarlint.SonarLintRuleResolver(server, {})
+    results = 0
+
+    def count(uri, result):
+        nonlocal results
+        results += 1
+
+    start = time.perf_counter()
+    await sonarlint.Analysis(server, resolver, files, count, max_open, keep_results=False).run()
+    elapsed = time.perf_counter() - start
+    await server.stop()
+    # the connection is only closed by the event loop so do not block it while waiting for the stand-in
+    await asyncio.get_event_loop().run_in_executor(None, thread.join)
+    return results, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--files", default="1000,10000", help="comma separated repository sizes")
+    parser.add_argument("--diagnostics", type=int, default=10, help="diagnostics per file")
+    parser.add_argument("--message-size", type=int, default=60, help="characters per diagnostic message")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds until diagnostics are published")
+    parser.add_argument("--rules", type=int, default=20, help="distinct rule codes")
+    parser.add_argument("--max-open", type=int, default=64)
+    parser.add_argument("--memory", action="store_true", help="trace the peak of Python allocations")
+    args = parser.parse_args()
+    options = {
+        "diagnostics": args.diagnostics,
+        "message_size": args.message_size,
+        "latency": args.latency,
+        "rules": args.rules
+    }
+
+    print("%8s %10s %9s %10s %9s %10s %12s" % ("files", "messages", "MB", "seconds", "files/s", "MB/s", "us/message"))
+    for count in [int(size) for size in args.files.split(",")]:
+        with tempfile.TemporaryDirectory() as directory:
+            files = generate_repository(directory, count)
+            # the recorder counts bytes and messages in both directions
+            recorder = stats.install(stats.Recorder())
+            if args.memory:
+                tracemalloc.start()
+            try:
+                results, elapsed = asyncio.run(run(files, options, args.max_open))
+            finally:
+                stats.install(None)
+            peak = ""
+            if args.memory:
+                peak = "  peak %.1f MiB" % (tracemalloc.get_traced_memory()[1] / 1024 / 1024)
+                tracemalloc.stop()
+            messages = sum(recorder.rpc_sent.values()) + sum(recorder.rpc_received.values())
+            megabytes = (recorder.bytes_sent + recorder.bytes_received) / 1024 / 1024
+            print("%8d %10d %9.1f %10.2f %9.0f %10.1f %12.1f%s" % (
+                results, messages, megabytes, elapsed, results / elapsed, megabytes / elapsed,
+                elapsed / max(1, messages) * 1e6, peak
+            ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+"""
+A stand-in for the SonarLint language server that speaks LSP over a socket without starting Java
+
+Answers initialize and textDocument/codeAction, and publishes synthetic diagnostics for every opened or changed
+document. Like SonarLint it clears the diagnostics of a document when it is closed. The number and size of the diagnostics and the latency before they are published are configurable. It runs on its own
+event loop in a background thread so it can connect to a ReverseServer of the same process, or as a separate process
+in place of the JVM (see main).
+"""
+import asyncio
+import json
+import os
+import sys
+import threading
+
+sys.path.insert(0, __file__.rsplit('/', 2)[0])
+
+from sonarlintcli.languageserver import LanguageServerNotification, parse_header_into_dict
+
+EXTENSIONS = ["py", "java", "js", "kt", "ts", "php"]
+
+
+def frame(message: dict) -> bytes:
+    body = json.dumps(message).encode()
+    return b"Content-Length: %d\r\n\r\n" % len(body) + body
+
+
+class FakeLanguageServer(asyncio.Protocol):
+    """
+    :param diagnostics: number of diagnostics published per document
+    :param message_size: length of the message of each diagnostic
+    :param latency: seconds between didOpen or didChange and publishDiagnostics
+    :param rules: number of distinct rule codes the diagnostics are spread over
+    """
+
+    def __init__(self, diagnostics: int = 10, message_size: int = 60, latency: float = 0.0, rules: int = 20):
+        self.diagnostics = diagnostics
+        self.message_size = message_size
+        self.latency = latency
+        self.rules = max(1, rules)
+        self.transport = None
+        self.messages_received = 0
+        self.messages_sent = 0
+        self._buffer = bytearray()
+        self._next_rule = 0
+
+    def connection_made(self, transport):
+        if self.transport is None:
+            self.transport = transport
+
+    def connection_lost(self, exc):
+        asyncio.get_event_loop().stop()
+
+    def data_received(self, data):
+        self._buffer.extend(data)
+        while True:
+            header_end = self._buffer.find(b"\r\n\r\n")
+            if header_end == -1:
+                return
+            length = int(parse_header_into_dict(self._buffer[:header_end].decode())["Content-Length"])
+            if len(self._buffer) < header_end + 4 + length:
+                return
+            body = bytes(self._buffer[header_end + 4:header_end + 4 + length])
+            del self._buffer[:header_end + 4 + length]
+            self.messages_received += 1
+            self.handle(json.loads(body))
+
+    def send(self, message: dict):
+        self.messages_sent += 1
+        self.transport.write(frame(message))
+
+    def handle(self, message: dict):
+        method = message.get("method")
+        if method == "initialize":
+            self.send({"jsonrpc": "2.0", "id": message["id"], "result": {"capabilities": {}}})
+        elif method == "shutdown":
+            self.send({"jsonrpc": "2.0", "id": message["id"], "result": None})
+        elif method in ("textDocument/didOpen", "textDocument/didChange"):
+            uri = message["params"]["textDocument"]["uri"]
+            if self.latency > 0:
+                asyncio.get_event_loop().call_later(self.latency, self.publish, uri)
+            else:
+                self.publish(uri)
+        elif method == "textDocument/didClose":
+            self.publish(message["params"]["textDocument"]["uri"], clear=True)
+        elif method == "textDocument/codeAction":
+            code = message["params"]["context"]["diagnostics"]["code"]
+            self.send({"jsonrpc": "2.0", "id": message["id"], "result": [{
+                "title": "Open description of rule %s" % code,
+                "command": "SonarLint.OpenRuleDesc",
+                "arguments": [code, "Rule %s" % code, "<p>%s</p>" % ("Description " * 40), "CODE_SMELL", "MAJOR"]
+            }]})
+
+    def publish(self, uri: str, clear: bool = False):
+        diagnostics = []
+        for line in range(0 if clear else self.diagnostics):
+            diagnostics.append({
+                "range": {"start": {"line": line, "character": 0}, "end": {"line": line, "character": 10}},
+                "severity": 2,
+                "code": "fake:S%d" % self._next_rule,
+                "source": "sonarlint",
+                "message": "m" * self.message_size
+            })
+            self._next_rule = (self._next_rule + 1) % self.rules
+        self.messages_sent += 1
+        self.transport.write(str(LanguageServerNotification("textDocument/publishDiagnostics", {
+            "uri": uri,
+            "diagnostics": diagnostics
+        })).encode())
+
+
+def start_in_thread(port: int, **options) -> threading.Thread:
+    """
+    Connect a FakeLanguageServer to a ReverseServer listening on localhost:port from a background thread
+    The thread ends once the ReverseServer closes the connection.
+
+    :param port:
+    :param options: passed to FakeLanguageServer
+    :return:
+    """
+    connected = threading.Event()
+
+    def run():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(loop.create_connection(lambda: FakeLanguageServer(**options), "localhost", port))
+        connected.set()
+        loop.run_forever()
+        loop.close()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    connected.wait()
+    return thread
+
+
+def generate_repository(directory: str, count: int, lines: int = 40) -> list:
+    """
+    Write a synthetic repository of count source files in directories of at most 100 files each
+
+    :param directory:
+    :param count:
+    :param lines: lines per file
+    :return: paths of all files
+    """
+    files = []
+    content = "".join("value_%d = compute(%d)  # TODO check\n" % (i, i) for i in range(lines))
+    for i in range(count):
+        package = os.path.join(directory, "pkg%d" % (i // 1000), "mod%d" % (i // 100 % 10))
+        if i % 100 == 0:
+            os.makedirs(package, exist_ok=True)
+        path = os.path.join(package, "file%d.%s" % (i, EXTENSIONS[i % len(EXTENSIONS)]))
+        with open(path, "w") as handle:
+            handle.write(content)
+        files.append(path)
+    return files
+
+
+async def serve_stdio(**options):
+    loop = asyncio.get_event_loop()
+    server = FakeLanguageServer(**options)
+    server.transport, _ = await loop.connect_write_pipe(asyncio.Protocol, sys.stdout.buffer)
+    await loop.connect_read_pipe(lambda: server, sys.stdin.buffer)
+
+
+def main():
+    """
+    Stand in for "java -jar sonarlint-ls.jar <port|-stdio> <analyzers>"
+
+    Usage: python benchmarks/fake_language_server.py <port|-stdio>
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    if sys.argv[1] == "-stdio":
+        loop.run_until_complete(serve_stdio())
+    else:
+        loop.run_until_complete(loop.create_connection(FakeLanguageServer, "localhost", int(sys.argv[1])))
+    loop.run_forever()
+
+
+if __name__ == '__main__':
+    main()
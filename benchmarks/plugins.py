@@ -0,0 +1,56 @@
+#! /usr/bin/env python3
+"""
+Language server startup time and memory per analyzer configuration
+
+Starts a SonarLint language server once with all analyzers and once per language with only the analyzer of that
+language. Reports the time until the initialize request has been answered and the resident set size of the JVM
+afterwards. The analyzers have to be downloaded already (`sonarlint-cli prefetch`).
+
+Usage: python benchmarks/plugins.py [java bin]
+"""
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, __file__.rsplit('/', 2)[0])
+
+from sonarlintcli import cli, sonarlint
+from sonarlintcli.languageserver import urify
+
+
+def get_rss(pid) -> int:
+    """
+    Resident set size of a process in KiB (Linux only)
+    """
+    try:
+        with open("/proc/%s/status" % pid, "r") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+async def measure(java_bin, languages):
+    start = time.perf_counter()
+    async with cli.create_worker(java_bin, urify(os.getcwd()), languages=languages) as worker:
+        elapsed = time.perf_counter() - start
+        # give the JVM a moment to settle after the handshake
+        await asyncio.sleep(1)
+        return len(worker.analyzers), elapsed, get_rss(worker.process.pid)
+
+
+def main():
+    java_bin = sys.argv[1] if len(sys.argv) > 1 else '/usr/bin/java'
+    configurations = [("all", None)]
+    configurations.extend((language, {language}) for language in sorted(sonarlint.JAR_DOWNLOAD_LANGUAGES.keys()))
+    print("%-12s %8s %10s %10s" % ("languages", "plugins", "startup", "RSS"))
+    for name, languages in configurations:
+        plugins, elapsed, rss = asyncio.run(measure(java_bin, languages))
+        print("%-12s %8d %9.2fs %7d MiB" % (name, plugins, elapsed, rss // 1024))
+
+
+if __name__ == '__main__':
+    main()
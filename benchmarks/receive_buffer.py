@@ -0,0 +1,146 @@
+#! /usr/bin/env python3
+"""
+Microbenchmark for the JSON-RPC receive path of BaseServer
+
+Feeds a burst of framed publishDiagnostics notifications through a local socket pair into a BaseServer running on an
+asyncio event loop and reports the throughput in MB/s. The legacy slicing buffer is measured as a reference.
+
+Usage: python benchmarks/receive_buffer.py [total MiB] [diagnostics per message]
+"""
+import asyncio
+import json
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, __file__.rsplit('/', 2)[0])
+
+from sonarlintcli.languageserver import BaseServer, JsonRPCProtocol, LanguageServerNotification, \
+    parse_header_into_dict
+
+
+def build_message(diagnostics_count):
+    diagnostic = {
+        "range": {"start": {"line": 12, "character": 4}, "end": {"line": 12, "character": 28}},
+        "severity": 2,
+        "code": "kotlin:S1481",
+        "source": "sonarlint",
+        "message": "Remove this unused \"result\" local variable."
+    }
+    return str(LanguageServerNotification("textDocument/publishDiagnostics", {
+        "uri": "file:///code/src/main/kotlin/Example.kt",
+        "diagnostics": [diagnostic] * diagnostics_count
+    })).encode()
+
+
+class LegacyBuffer:
+    """
+    The previous implementation that slices consumed bytes off the front of a bytearray
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.body_size = -1
+
+    def feed(self, sock):
+        while True:
+            data = sock.recv(4096)
+            self.buffer.extend(data)
+            if len(data) < 4096 or len(self.buffer) > 1024 * 1024 * 5:
+                break
+
+    def read(self, publish):
+        if self.body_size == -1:
+            header_end = self.buffer.find(b"\r\n\r\n")
+            if header_end == -1:
+                return False
+            header = self.buffer[:header_end].decode('utf-8')
+            self.buffer = self.buffer[header_end + 4:]
+            self.body_size = int(parse_header_into_dict(header)['Content-Length'])
+        if len(self.buffer) < self.body_size:
+            return False
+        body = self.buffer[:self.body_size]
+        self.buffer = self.buffer[self.body_size:]
+        self.body_size = -1
+        publish(body)
+        return True
+
+
+def send_in_background(sock, payload):
+    def send():
+        sock.sendall(payload)
+        sock.close()
+
+    sender = threading.Thread(target=send)
+    sender.start()
+    return sender
+
+
+def run_legacy(message, count):
+    reader, writer = socket.socketpair()
+    reader.setblocking(False)
+    legacy = LegacyBuffer()
+    received = 0
+
+    def publish(body):
+        nonlocal received
+        json.loads(str(body, 'utf-8'))
+        received += 1
+
+    start = time.perf_counter()
+    sender = send_in_background(writer, message * count)
+    while received < count:
+        try:
+            legacy.feed(reader)
+        except BlockingIOError:
+            time.sleep(0)
+            continue
+        while legacy.read(publish):
+            pass
+    elapsed = time.perf_counter() - start
+    sender.join()
+    reader.close()
+    return len(message) * count / elapsed / 1024 / 1024
+
+
+async def run_base_server(message, count):
+    reader, writer = socket.socketpair()
+    server = BaseServer()
+    done = asyncio.get_event_loop().create_future()
+    received = 0
+
+    def publish(body):
+        nonlocal received
+        json.loads(str(body, 'utf-8'))
+        received += 1
+        if received == count:
+            done.set_result(True)
+
+    server.publish_rpc_msg = publish
+    start = time.perf_counter()
+    await asyncio.get_event_loop().create_connection(lambda: JsonRPCProtocol(server), sock=reader)
+    sender = send_in_background(writer, message * count)
+    await done
+    elapsed = time.perf_counter() - start
+    server.close()
+    sender.join()
+    return len(message) * count / elapsed / 1024 / 1024
+
+
+def main():
+    total_mib = float(sys.argv[1]) if len(sys.argv) > 1 else 64
+    diagnostics_count = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    message = build_message(diagnostics_count)
+    count = max(1, int(total_mib * 1024 * 1024 / len(message)))
+
+    legacy_mbs = run_legacy(message, count)
+    current_mbs = asyncio.run(run_base_server(message, count))
+
+    print("%d messages of %d bytes (%.1f MiB)" % (count, len(message), count * len(message) / 1024 / 1024))
+    print("legacy slicing buffer: %8.1f MB/s" % legacy_mbs)
+    print("ReceiveBuffer:         %8.1f MB/s" % current_mbs)
+
+
+if __name__ == '__main__':
+    main()
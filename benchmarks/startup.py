@@ -0,0 +1,88 @@
+#! /usr/bin/env python3
+"""
+Benchmark of the language server startup with and without the AppCDS archive recorded by prefetch
+
+Starts the real language server (the jars have to be downloaded already) a number of times per mode and measures the
+time from spawning Java until it has connected and until the first diagnostics of a sample file have been published.
+The archive is recorded first if there is none for the given JDK, yet.
+
+Usage: python benchmarks/startup.py [--java-bin /usr/bin/java] [--runs 5] [--language java]
+                                    [--transport tcp] [--jvm-opt=-Xmx1g ...]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, __file__.rsplit('/', 2)[0])
+
+from sonarlintcli import cli, jvm, sonarlint
+from sonarlintcli.languageserver import get_language_id, urify
+
+SAMPLES = {get_language_id(name): name for name in cli.CDS_SAMPLES}
+
+
+async def measure(java_bin, sample, transport, jvm_options, class_data_sharing):
+    """
+    :return: seconds until the language server connected and until the first result
+    """
+    first_result = None
+
+    def on_result(uri, result):
+        nonlocal first_result
+        if first_result is None:
+            first_result = time.perf_counter()
+
+    start = time.perf_counter()
+    worker = cli.create_worker(
+        java_bin, urify(os.path.dirname(sample)), languages={get_language_id(sample)}, transport=transport,
+        jvm_options=jvm_options, class_data_sharing=class_data_sharing
+    )
+    try:
+        await worker.start()
+        connected = time.perf_counter()
+        await worker.analyze([sample], on_result, keep_results=False, file_timeout=120)
+    finally:
+        await worker.stop()
+    return connected - start, first_result - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--java-bin", default="/usr/bin/java")
+    parser.add_argument("--runs", type=int, default=5, help="launches per mode")
+    parser.add_argument("--language", default="java", choices=sorted(SAMPLES), help="language of the sample file")
+    parser.add_argument("--transport", default="tcp", choices=sonarlint.TRANSPORTS)
+    parser.add_argument("--jvm-opt", action="append", default=[], help="passed to the JVM in both modes")
+    args = parser.parse_args()
+    version = jvm.java_version(args.java_bin)
+    if version is None or version < jvm.MIN_CDS_VERSION:
+        parser.error("AppCDS archives need Java %s or newer" % jvm.MIN_CDS_VERSION)
+    jvm_options = cli.configured_jvm_options(args.jvm_opt)
+    if not os.path.isfile(cli.cds_archive(args.java_bin)):
+        print("Recording AppCDS archive...")
+        asyncio.run(cli.build_cds_archive(args.java_bin, args.transport, jvm_options))
+
+    with tempfile.TemporaryDirectory() as directory:
+        name = SAMPLES[args.language]
+        sample = os.path.join(directory, name)
+        with open(sample, "w") as handle:
+            handle.write(cli.CDS_SAMPLES[name])
+        print("%-12s %14s %14s %20s %20s" % ("mode", "connect (s)", "min", "first result (s)", "min"))
+        for mode, class_data_sharing in (("no archive", False), ("archive", True)):
+            timings = [
+                asyncio.run(measure(args.java_bin, sample, args.transport, jvm_options, class_data_sharing))
+                for _ in range(args.runs)
+            ]
+            connect = [connected for connected, _ in timings]
+            first = [first_result for _, first_result in timings]
+            print("%-12s %14.3f %14.3f %20.3f %20.3f" % (
+                mode, statistics.median(connect), min(connect), statistics.median(first), min(first)
+            ))
+
+
+if __name__ == '__main__':
+    main()
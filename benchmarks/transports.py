@@ -0,0 +1,74 @@
+#! /usr/bin/env python3
+"""
+Startup latency and throughput of the tcp and stdio transports
+
+Runs the stand-in from fake_language_server.py as a separate process in place of the JVM, so each transport
+carries the same traffic as with a real language server. For every transport the time from spawning the process until
+initialize has been answered and the time to analyse a synthetic repository are measured.
+
+Usage: python benchmarks/transports.py [files] [repeats]
+"""
+import asyncio
+import os
+import stat
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, __file__.rsplit('/', 2)[0])
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_language_server import generate_repository
+from sonarlintcli import sonarlint, stats
+
+
+def write_launcher(directory: str) -> str:
+    """
+    Write an executable that accepts the arguments of java (-jar <jar> <port|-stdio> ...) and starts the stand-in
+    """
+    launcher = os.path.join(directory, "java")
+    with open(launcher, "w") as handle:
+        handle.write('#!/bin/sh\nexec "%s" "%s" "$3"\n' % (
+            sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_language_server.py")
+        ))
+    os.chmod(launcher, os.stat(launcher).st_mode | stat.S_IEXEC)
+    return launcher
+
+
+async def measure(launcher, transport, files):
+    start = time.perf_counter()
+    worker = sonarlint.SonarLintWorker("sonarlint-ls.jar", [], launcher, "file:///benchmark", rules={},
+                                       transport=transport)
+    await worker.start()
+    startup = time.perf_counter() - start
+    try:
+        start = time.perf_counter()
+        await worker.analyze(files, keep_results=False)
+        elapsed = time.perf_counter() - start
+    finally:
+        await worker.stop()
+    return startup, elapsed
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    with tempfile.TemporaryDirectory() as directory:
+        launcher = write_launcher(directory)
+        files = generate_repository(os.path.join(directory, "repository"), count)
+        print("%-6s %12s %10s %9s %10s" % ("", "startup ms", "seconds", "files/s", "MB/s"))
+        for transport in sonarlint.TRANSPORTS:
+            for _ in range(repeats):
+                recorder = stats.install(stats.Recorder())
+                try:
+                    startup, elapsed = asyncio.run(measure(launcher, transport, files))
+                finally:
+                    stats.install(None)
+                megabytes = (recorder.bytes_sent + recorder.bytes_received) / 1024 / 1024
+                print("%-6s %12.1f %10.2f %9.0f %10.1f" % (
+                    transport, startup * 1000, elapsed, count / elapsed, megabytes / elapsed
+                ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+#! /usr/bin/env python3
+"""
+Wall-clock scaling of `sonarlint-cli analyse --workers N` from 1 to N language servers
+
+Analyses the same files once per worker count and prints the elapsed time and the speedup over a single worker.
+The analyzers have to be downloaded already (`sonarlint-cli prefetch`).
+
+Usage: python benchmarks/workers.py <max workers> <java bin> <glob> [<glob> ...]
+"""
+import asyncio
+import sys
+import time
+
+sys.path.insert(0, __file__.rsplit('/', 2)[0])
+
+from sonarlintcli import cli
+
+
+def main():
+    max_workers = int(sys.argv[1])
+    java_bin = sys.argv[2]
+    files = cli.get_files_by_glob(sys.argv[3:])
+    print("%d files" % len(files))
+    baseline = None
+    workers = 1
+    while workers <= max_workers:
+        start = time.perf_counter()
+        results = asyncio.run(cli.run_analysis(files, java_bin, workers=workers))
+        elapsed = time.perf_counter() - start
+        if baseline is None:
+            baseline = elapsed
+        print("workers=%-3d files=%-6d %8.2fs  speedup %.2fx" % (workers, len(results), elapsed, baseline / elapsed))
+        workers *= 2
+        if workers > max_workers and workers // 2 != max_workers:
+            workers = max_workers
+
+
+if __name__ == '__main__':
+    main()
@@ -5,11 +5,13 @@ setup(
     version='0.0.0',
     py_modules=['sonarlintcli'],
     packages=find_packages(),
+    # SonarLintSession starts Java from the thread of its event loop, which needs the thread-safe child watcher of 3.8
+    python_requires='>=3.8',
     package_data={
         'sonarlintcli' : ['sonarlint/server/*.jar', 'sonarlint/analyzers/*.jar']
     },
     install_requires=[
-        'Click',
+        'Click>=8.0',
     ],
     entry_points='''
         [console_scripts]
@@ -0,0 +1,241 @@
+import hashlib
+import json
+import os
+import struct
+
+from sonarlintcli import source
+from sonarlintcli.languageserver import unurify
+
+MAGIC = b"SLBL"
+FORMAT_VERSION = 1
+# magic, format version, number of rules, number of paths
+HEADER = struct.Struct("<4sIII")
+STRING_LENGTH = struct.Struct("<H")
+RECORD_COUNT = struct.Struct("<I")
+# rule index, line hash, line number (0-based)
+RECORD = struct.Struct("<IQI")
+
+
+def line_hash(line: str) -> int:
+    """
+    Hash of a source line that ignores all whitespace, so re-indenting code does not make its issues new
+
+    :param line:
+    :return:
+    """
+    return int.from_bytes(hashlib.blake2b("".join(line.split()).encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def read_results(path: str) -> list:
+    """
+    Read the results of an analysis written with --format json or ndjson
+
+    :param path:
+    :return:
+    """
+    with open(path, "r") as handle:
+        content = handle.read()
+    if content.lstrip().startswith("["):
+        return json.loads(content)
+    return [json.loads(line) for line in content.splitlines() if line.strip() != ""]
+
+
+class Baseline:
+    """
+    Index of known issues by file path (relative to root), rule code and the hash of the line they start on
+    Comparing a result with the baseline keeps only the new issues and lists the known issues that are gone as fixed,
+    no matter if lines have moved. Saved baselines are loaded lazily: only the string tables are parsed up front and
+    the issues of a file are unpacked when a result for it arrives, so even huge baselines load in milliseconds.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self._rules = []
+        # (rule code, line hash, line) by path that have been added
+        self._issues = {}
+        # (start, count) of the records by path in the data of a loaded baseline
+        self._offsets = {}
+        self._data = b""
+        # (URI, error) of the results that could not be added because their file cannot be read
+        self.skipped = []
+
+    def __len__(self):
+        return sum(len(issues) for issues in self._issues.values()) + sum(
+            count for _, count in self._offsets.values()
+        )
+
+    def relative_path(self, uri: str) -> str:
+        return os.path.relpath(os.path.abspath(unurify(uri)), self.root).replace(os.sep, "/")
+
+    def add_result(self, result: dict, text: str = None):
+        """
+        Add all issues of a result
+
+        :param result:
+        :param text: content of the file the result belongs to. Read from disk if None.
+        :return:
+        """
+        if "error" in result or "skipped" in result or len(result["diagnostics"]) == 0:
+            return
+        if text is None:
+            text = source.read(unurify(result["uri"]))
+        lines = text.splitlines()
+        issues = self._issues.setdefault(self.relative_path(result["uri"]), [])
+        for diagnostic in result["diagnostics"]:
+            line = diagnostic["range"]["start"]["line"]
+            issues.append((diagnostic.get("code") or "", line_hash(lines[line] if line < len(lines) else ""), line))
+
+    def add_results(self, results: list):
+        """
+        Add all issues of several results. Results whose file cannot be read (anymore) are skipped and listed in
+        skipped, so their issues are not known.
+
+        :param results:
+        :return:
+        """
+        for result in results:
+            try:
+                self.add_result(result)
+            except OSError as e:
+                self.skipped.append((result["uri"], e))
+
+    def _records(self, path: str) -> list:
+        if path in self._issues:
+            return self._issues[path]
+        if path not in self._offsets:
+            return []
+        start, count = self._offsets[path]
+        data = memoryview(self._data)[start:start + count * RECORD.size]
+        return [(self._rules[rule], digest, line) for rule, digest, line in RECORD.iter_unpack(data)]
+
+    def needs_text(self, result: dict) -> bool:
+        """
+        Check if compare() needs the content of the file a result belongs to
+
+        :param result:
+        :return:
+        """
+        if "error" in result or "skipped" in result or len(result["diagnostics"]) == 0:
+            return False
+        path = self.relative_path(result["uri"])
+        return path in self._issues or path in self._offsets
+
+    def compare(self, result: dict, text: str = None) -> dict:
+        """
+        Reduce a result to the issues that are not in the baseline and add the baseline issues that are gone
+        Results that failed or have been skipped are returned as they are.
+
+        :param result:
+        :param text: content of the file the result belongs to. Read from disk if None and needed (see needs_text).
+        :return: copy of the result with only new diagnostics and a "fixed" list of {"code", "line"}
+        """
+        if "error" in result or "skipped" in result:
+            return result
+        known = {}
+        for code, digest, line in self._records(self.relative_path(result["uri"])):
+            known.setdefault((code, digest), []).append(line)
+        diagnostics = result["diagnostics"]
+        if len(known) > 0 and len(diagnostics) > 0:
+            if text is None:
+                try:
+                    text = source.read(unurify(result["uri"]))
+                except OSError:
+                    text = ""
+            lines = text.splitlines()
+            new = []
+            for diagnostic in diagnostics:
+                line = diagnostic["range"]["start"]["line"]
+                digest = line_hash(lines[line] if line < len(lines) else "")
+                matches = known.get((diagnostic.get("code") or "", digest))
+                if matches:
+                    # the closest known issue is the one that has been matched
+                    matches.remove(min(matches, key=lambda known_line: abs(known_line - line)))
+                else:
+                    new.append(diagnostic)
+            diagnostics = new
+        fixed = sorted(
+            ({"code": code, "line": line} for (code, _), known_lines in known.items() for line in known_lines),
+            key=lambda issue: issue["line"]
+        )
+        codes = {diagnostic.get("code") for diagnostic in diagnostics}
+        codes.update(issue["code"] for issue in fixed)
+        compared = dict(result)
+        compared["diagnostics"] = diagnostics
+        compared["rules"] = {code: rule for code, rule in result["rules"].items() if code in codes}
+        compared["fixed"] = fixed
+        return compared
+
+    def save(self, path: str):
+        """
+        Write the baseline in its binary format (see load)
+
+        :param path:
+        :return:
+        """
+        rules = {}
+        paths = sorted(set(self._issues) | set(self._offsets))
+        records = []
+        for file in paths:
+            issues = sorted(self._records(file), key=lambda issue: issue[2])
+            records.append([(rules.setdefault(code, len(rules)), digest, line) for code, digest, line in issues])
+        chunks = [HEADER.pack(MAGIC, FORMAT_VERSION, len(rules), len(paths))]
+        for code in rules:
+            encoded = code.encode("utf-8")
+            chunks.append(STRING_LENGTH.pack(len(encoded)) + encoded)
+        for file, file_records in zip(paths, records):
+            encoded = file.encode("utf-8")
+            chunks.append(STRING_LENGTH.pack(len(encoded)) + encoded + RECORD_COUNT.pack(len(file_records)))
+        for file_records in records:
+            chunks.extend(RECORD.pack(*record) for record in file_records)
+        temporary = "%s.%d.tmp" % (path, os.getpid())
+        with open(temporary, "wb") as handle:
+            handle.write(b"".join(chunks))
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path: str, root: str):
+        """
+        Load a baseline saved with save() or build one from a JSON or NDJSON result file
+        The lines of the issues in a result file are read from the files as they are on disk now. Issues on lines that
+        have changed or moved since the results were written cannot be matched, so convert result files with
+        "baseline save" on the checkout they belong to. Files that do not exist anymore are skipped (see add_results).
+
+        :param path:
+        :param root: paths in the baseline are relative to this directory
+        :return:
+        """
+        baseline = cls(root)
+        with open(path, "rb") as handle:
+            data = handle.read()
+        if not data.startswith(MAGIC):
+            baseline.add_results(read_results(path))
+            return baseline
+        try:
+            _, version, rule_count, path_count = HEADER.unpack_from(data)
+            if version != FORMAT_VERSION:
+                raise ValueError("Unsupported baseline format version %s" % version)
+            offset = HEADER.size
+            for _ in range(rule_count):
+                (length,) = STRING_LENGTH.unpack_from(data, offset)
+                offset += STRING_LENGTH.size
+                baseline._rules.append(data[offset:offset + length].decode("utf-8"))
+                offset += length
+            counts = []
+            for _ in range(path_count):
+                (length,) = STRING_LENGTH.unpack_from(data, offset)
+                offset += STRING_LENGTH.size
+                file = data[offset:offset + length].decode("utf-8")
+                offset += length
+                (count,) = RECORD_COUNT.unpack_from(data, offset)
+                offset += RECORD_COUNT.size
+                counts.append((file, count))
+        except struct.error:
+            # cut off in the header or the string tables
+            raise ValueError("Baseline %s is truncated or corrupt" % path)
+        for file, count in counts:
+            baseline._offsets[file] = (offset, count)
+            offset += count * RECORD.size
+        if offset != len(data):
+            raise ValueError("Baseline %s is truncated or corrupt" % path)
+        baseline._data = data
+        return baseline
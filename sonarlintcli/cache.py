@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+
+from sonarlintcli.languageserver import urify, get_language_id
+
+# bump this whenever the format of cached results changes
+CACHE_FORMAT = 1
+
+
+class ResultCache:
+    """
+    On-disk cache of analysis results keyed by file content, language and an analyzer fingerprint
+    Every entry is a small JSON file containing the diagnostics and rules of one file. The modification time of an entry
+    is updated on every hit and the least recently used entries are evicted once the cache exceeds max_size bytes.
+    """
+
+    def __init__(self, directory: str, fingerprint: str, max_size: int = 1024 * 1024 * 256):
+        self.directory = directory
+        self.max_size = max_size
+        self._fingerprint = fingerprint
+        self._keys = {}
+        self._written = 0
+
+    def key(self, file, content: bytes) -> str:
+        digest = hashlib.sha256()
+        digest.update(("%s\0%s\0%s\0" % (CACHE_FORMAT, self._fingerprint, get_language_id(file))).encode())
+        digest.update(content)
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".json")
+
+    def get(self, file):
+        """
+        Return the cached result for a file or None if its current content has not been analysed yet or it cannot be
+        read
+        The key is remembered so a later put() stores the result for exactly the content that has been looked up.
+
+        :param file:
+        :return:
+        """
+        try:
+            with open(str(file), "rb") as fd:
+                key = self.key(file, fd.read())
+        except OSError:
+            # the analysis reports the file as it cannot be read
+            return None
+        self._keys[os.path.abspath(file)] = key
+        path = self._path(key)
+        try:
+            with open(path, "r") as handle:
+                cached = json.load(handle)
+        except (OSError, ValueError):
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            # evicted by another run in the meantime
+            pass
+        return {"uri": urify(file), "diagnostics": cached["diagnostics"], "rules": cached["rules"]}
+
+    def put(self, file, result: dict):
+        key = self._keys.get(os.path.abspath(file))
+        if key is None:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = "%s.%s.tmp" % (path, os.getpid())
+        with open(tmp_path, "w") as handle:
+            json.dump({"diagnostics": result["diagnostics"], "rules": result["rules"]}, handle, separators=(',', ':'))
+        os.replace(tmp_path, path)
+        self._written += 1
+
+    def lookup(self, files: list):
+        """
+        Split files into cached results and files that still have to be analysed
+
+        :param files:
+        :return: tuple of (results, missing files)
+        """
+        results = []
+        missing = []
+        for file in files:
+            result = self.get(file)
+            if result is None:
+                missing.append(file)
+            else:
+                results.append(result)
+        return results, missing
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits into max_size
+        Only needed if anything has been written since the cache was opened.
+
+        :return:
+        """
+        if self._written == 0:
+            return
+        entries = []
+        total = 0
+        try:
+            shards = list(os.scandir(self.directory))
+        except OSError:
+            return
+        for shard in shards:
+            if not shard.is_dir():
+                continue
+            try:
+                shard_entries = list(os.scandir(shard.path))
+            except OSError:
+                continue
+            for entry in shard_entries:
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    # evicted by another run sharing the cache
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        if total <= self.max_size:
+            return
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
+
+
+class RuleDatabase:
+    """
+    Rule details (code, description, html, type, severity) by rule code for one analyzer fingerprint
+    The database is a single JSON file that is loaded completely and only written back if new rules have been added.
+    """
+
+    def __init__(self, directory: str, fingerprint: str):
+        self.path = os.path.join(directory, "rules-%s.json" % fingerprint)
+        self.rules = {}
+        self._saved = 0
+
+    def load(self):
+        try:
+            with open(self.path, "r") as handle:
+                self.rules = {code: tuple(rule) for code, rule in json.load(handle).items()}
+        except (OSError, ValueError):
+            self.rules = {}
+        self._saved = len(self.rules)
+        return self
+
+    def save(self):
+        if len(self.rules) == self._saved:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = "%s.%s.tmp" % (self.path, os.getpid())
+        with open(tmp_path, "w") as handle:
+            json.dump(self.rules, handle, separators=(',', ':'))
+        os.replace(tmp_path, self.path)
+        self._saved = len(self.rules)
@@ -1,14 +1,20 @@
 #! /usr/bin/env python3
+import asyncio
 import json
+import signal
+import subprocess
 import sys
-import urllib.request
+import time
 from pathlib import Path
 
 import click
+from click.core import ParameterSource
 import os
-import threading
+import tempfile
 
-from sonarlintcli import languageserver, sonarlint
+from sonarlintcli import baseline as sonarlint_baseline, cache, daemon as sonarlint_daemon, discovery, download, git, \
+    jvm, output as output_writers, service, sonarlint, stats, watch as sonarlint_watch
+from sonarlintcli.languageserver import unurify, urify
 
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 SONARLINT_CLI_HOME = str(Path.home()) + "/.sonarlint-cli"
@@ -16,13 +22,23 @@ SONARLINT_DIR = SONARLINT_CLI_HOME + "/sonarlint"
 SONARLINT_LS_DIR = SONARLINT_DIR + "/server"
 DEFAULT_LS_JAR = SONARLINT_LS_DIR + "/sonarlint-ls.jar"
 DEFAULT_ANALYZERS_DIR = SONARLINT_DIR + "/analyzers"
-
-
-def download_if_needed(url, destination):
-    if os.path.isfile(destination):
-        return True
-    print("Downloading %s..." % (os.path.basename(destination)))
-    urllib.request.urlretrieve(url, destination)
+MANIFEST = SONARLINT_DIR + "/manifest.json"
+DAEMON_SOCKET = SONARLINT_CLI_HOME + "/daemon.sock"
+CACHE_DIR = SONARLINT_CLI_HOME + "/cache"
+RULES_DIR = SONARLINT_CLI_HOME + "/rules"
+DAEMON_LOG = SONARLINT_CLI_HOME + "/daemon.log"
+JVM_OPTIONS_FILE = SONARLINT_CLI_HOME + "/jvm.options"
+CDS_DIR = SONARLINT_CLI_HOME + "/cds"
+# loaded once while the class data sharing archive is recorded so the classes of every analyzer end up in it
+CDS_SAMPLES = {
+    "Sample.java": "public class Sample {\n  public static void main(String[] args) {\n    int unused = 1;\n  }\n}\n",
+    "sample.kt": "fun main() {\n    val unused = 1\n}\n",
+    "sample.py": "def main():\n    unused = 1\n    if True:\n        pass\n",
+    "sample.js": "function main() {\n  var unused = 1;\n}\n",
+    "sample.ts": "function main(): void {\n  let unused = 1;\n}\n",
+    "sample.php": "<?php\nfunction main() {\n  $unused = 1;\n}\n",
+    "sample.html": "<html>\n<body>\n<img src=\"a.png\">\n</body>\n</html>\n"
+}
 
 
 def mkdir_required():
@@ -33,95 +49,648 @@ def mkdir_required():
 
 
 def get_files_by_ext(path: str, extensions: list) -> list:
-    files = []
-    for extension in extensions:
-        files.extend([str(path) for path in Path(path).glob("./**/*.%s" % extension)])
-    return files
-
-
-def get_files_by_glob(pattern) -> list:
-    if type(pattern) is list:
-        files = []
-        for g in pattern:
-            files.extend(get_files_by_glob(g))
-        return files
-
-    if pattern == '':
-        return []
-
-    if '*' not in pattern:
-        return [pattern]
-    if pattern.startswith('/'):
-        files = Path('/').glob(pattern[1:])
-    else:
-        files = Path('.').glob(pattern)
-    return [str(file.absolute()) for file in files]
+    finder = discovery.FileFinder(use_gitignore=False, extensions=set(extensions))
+    return finder.find([os.path.join(path, "**", "*")])
+
+
+def get_files_by_glob(pattern, excludes: list = None) -> list:
+    if type(pattern) is not list:
+        pattern = [pattern]
+    return discovery.find_files(pattern, excludes)
 
 
-def download_analyzers():
-    # Download all jars
+def download_analyzers(mirror: str = None, verify: bool = False):
+    """
+    Download the language server and all analyzers in parallel unless the manifest says they are there already
+
+    :param mirror: directory or base URL to download the jars from. Defaults to $SONARLINT_CLI_MIRROR.
+    :param verify: check the checksums of all jars on disk instead of trusting the manifest
+    :return:
+    """
     mkdir_required()
-    download_if_needed(sonarlint.JAR_DOWNLOAD_LANGUAGE_SERVER, DEFAULT_LS_JAR)
-    for language, jar in sonarlint.JAR_DOWNLOAD_LANGUAGES.items():
-        plugin_jar_path = DEFAULT_ANALYZERS_DIR + "/" + os.path.basename(sonarlint.JAR_DOWNLOAD_LANGUAGES[language])
-        download_if_needed(sonarlint.JAR_DOWNLOAD_LANGUAGES[language], plugin_jar_path)
+    jars = {DEFAULT_LS_JAR: sonarlint.JAR_DOWNLOAD_LANGUAGE_SERVER}
+    for url in sonarlint.JAR_DOWNLOAD_LANGUAGES.values():
+        jars[DEFAULT_ANALYZERS_DIR + "/" + os.path.basename(url)] = url
+    if mirror is None:
+        mirror = os.environ.get(download.MIRROR_ENV)
+    try:
+        download.ensure_downloads(jars, MANIFEST, sonarlint.analyzer_fingerprint(), mirror, verify)
+    except download.DownloadError as e:
+        raise click.ClickException(str(e))
+
+
+# options shared by the commands that start language servers
+transport_option = click.option(
+    "--transport", default="tcp", type=click.Choice(sonarlint.TRANSPORTS),
+    help="Talk to the language server over a local TCP connection or its stdin and stdout"
+)
+jvm_opt_option = click.option(
+    "--jvm-opt", "jvm_opts", multiple=True, metavar="OPTION",
+    help="Pass an option like -Xmx2g to the JVM of the language server. Repeat it for more options."
+)
+max_open_option = click.option(
+    "--max-open", default=64, type=click.IntRange(min=1),
+    help="Maximum number of files that are open on a language server at the same time"
+)
+file_timeout_option = click.option(
+    "--file-timeout", default=300, type=click.FloatRange(min=0),
+    help="Report a file as timed out if it has no result this many seconds after it has been opened"
+)
+max_file_size_option = click.option(
+    "--max-file-size", default=1000, type=click.IntRange(min=0),
+    help="Report files larger than this many KiB as skipped instead of analysing them (0 for no limit)"
+)
+
 
 @click.group()
 def main():
     pass
 
 
+def open_rule_database() -> cache.RuleDatabase:
+    return cache.RuleDatabase(RULES_DIR, sonarlint.analyzer_fingerprint()).load()
+
+
 @main.command()
-def prefetch():
-    download_analyzers()
+@click.option("--rules", is_flag=True, help="Also fetch the descriptions of all rules into the rule database")
+@click.option("--mirror", envvar=download.MIRROR_ENV,
+              help="Directory or base URL with the jars and their .sha1 files to use instead of the public repository")
+@click.option("--verify", is_flag=True, help="Check the checksums of all jars and download broken ones again")
+@click.option("--cds/--no-cds", default=True,
+              help="Record an AppCDS archive of the language server and analyzers to speed up later starts (Java 13+)")
+@click.option("--java-bin", default='/usr/bin/java')
+@transport_option
+@jvm_opt_option
+def prefetch(rules, mirror, verify, cds, java_bin, transport, jvm_opts):
+    download_analyzers(mirror, verify)
+    options = configured_jvm_options(jvm_opts)
+    if rules:
+        rule_count = asyncio.run(prefetch_rules(java_bin, transport, options))
+        click.echo("%s rules in %s" % (rule_count, open_rule_database().path))
+    if cds:
+        version = jvm.java_version(java_bin)
+        if version is None or version < jvm.MIN_CDS_VERSION:
+            click.echo("Skipping the AppCDS archive, it needs Java %s or newer (%s is %s)" % (
+                jvm.MIN_CDS_VERSION, java_bin, "unknown" if version is None else version
+            ), err=True)
+            return
+        archive = asyncio.run(build_cds_archive(java_bin, transport, options))
+        if archive is None:
+            raise click.ClickException("The language server did not write an AppCDS archive")
+        click.echo("AppCDS archive in %s" % archive)
+
+
+async def prefetch_rules(java_bin, transport="tcp", jvm_options: list = None) -> int:
+    rule_database = open_rule_database()
+    try:
+        async with create_worker(java_bin, urify(os.getcwd()), rule_database.rules, transport=transport,
+                                 jvm_options=jvm_options) as worker:
+            await worker.rule_resolver.prefetch(await worker.list_rules())
+    finally:
+        rule_database.save()
+    return len(rule_database.rules)
+
+
+def configured_jvm_options(extra: tuple = ()) -> list:
+    """
+    JVM options from JVM_OPTIONS_FILE followed by the given ones, so options on the command line win
+
+    :param extra:
+    :return:
+    """
+    return jvm.read_options_file(JVM_OPTIONS_FILE) + list(extra)
+
+
+def cds_archive(java_bin) -> str:
+    return jvm.cds_archive_path(CDS_DIR, java_bin, DEFAULT_LS_JAR, sonarlint.analyzer_fingerprint())
+
+
+async def build_cds_archive(java_bin, transport="tcp", jvm_options: list = None):
+    """
+    Record the classes the language server loads while it analyses a sample file of every language into an AppCDS
+    archive that create_worker passes to every later JVM
+
+    :param java_bin:
+    :param transport: see sonarlint.TRANSPORTS
+    :param jvm_options:
+    :return: path of the archive or None if the JVM did not write one
+    """
+    os.makedirs(CDS_DIR, exist_ok=True)
+    archive = cds_archive(java_bin)
+    # the JVM writes the archive on exit, only move it into place if that worked
+    temporary = "%s.%d.tmp" % (archive, os.getpid())
+    with tempfile.TemporaryDirectory() as directory:
+        samples = []
+        for name, text in CDS_SAMPLES.items():
+            samples.append(os.path.join(directory, name))
+            with open(samples[-1], "w") as handle:
+                handle.write(text)
+        worker = create_worker(
+            java_bin, urify(directory), transport=transport, class_data_sharing=False,
+            jvm_options=jvm.cds_dump_options(temporary) + list(jvm_options or [])
+        )
+        await worker.start()
+        try:
+            await worker.analyze(samples, keep_results=False, file_timeout=120)
+            await worker.list_rules()
+        finally:
+            await worker.exit()
+    if not os.path.isfile(temporary):
+        return None
+    os.replace(temporary, archive)
+    return archive
 
 
 @main.command()
 @click.argument("files", nargs=-1)
 @click.option("--java-bin", default='/usr/bin/java')
 @click.option("--output")
-def analyse(files, java_bin, output):
-    files = get_files_by_glob(list(files))
-    if len(files) == 0:
-        click.echo("[]")
-        return True
+@click.option("--format", "output_format", default="json", type=click.Choice(sorted(output_writers.WRITERS.keys())),
+              help="json collects all results, ndjson and sarif are written while the analysis is running")
+@click.option("--workers", default=1, type=click.IntRange(min=1), help="Number of language servers to run in parallel")
+@click.option("--no-daemon", is_flag=True, help="Do not use a running daemon even if there is one")
+@click.option("--no-cache", is_flag=True, help="Analyse all files even if their results are cached")
+@click.option("--cache-size", default=256, type=click.IntRange(min=0), help="Maximum size of the result cache in MiB")
+@max_open_option
+@click.option("--exclude", multiple=True,
+              help="Skip files and directories matching this .gitignore-style pattern (relative to the working dir)")
+@click.option("--changed-since", metavar="REF",
+              help="Only analyse files changed since the merge base of REF and HEAD. FILES restrict the changed files.")
+@click.option("--staged", is_flag=True, help="Only analyse staged files. FILES restrict the staged files.")
+@file_timeout_option
+@click.option("--timeout", type=click.FloatRange(min=0),
+              help="Report all files without result as timed out after this many seconds")
+@click.option("--max-restarts", default=3, type=click.IntRange(min=0),
+              help="Number of times a crashed language server is restarted to analyse the remaining files")
+@click.option("--stats", "show_stats", is_flag=True,
+              help="Print per-file latency percentiles, RPC counts and queue depths to stderr. Implies --no-daemon.")
+@click.option("--trace", type=click.Path(dir_okay=False, writable=True),
+              help="Write a Chrome trace of the analysis to this file (open it in Perfetto). Implies --no-daemon.")
+@transport_option
+@max_file_size_option
+@click.option("--baseline", "baseline_file", type=click.Path(exists=True, dir_okay=False),
+              help="Only report issues that are not in this baseline (see baseline save) or JSON result file, and the "
+                   "baseline issues that are gone as fixed. The issues of a result file are matched by the lines of "
+                   "the files as they are now, so issues on lines that changed since are reported as new.")
+@jvm_opt_option
+def analyse(files, java_bin, output, output_format, workers, no_daemon, no_cache, cache_size, max_open, exclude,
+            changed_since, staged, file_timeout, timeout, max_restarts, show_stats, trace, transport, max_file_size,
+            baseline_file, jvm_opts):
+    recorder = None
+    if show_stats or trace is not None:
+        # the daemon analyses in another process so everything has to run here to be measured
+        no_daemon = True
+        recorder = stats.install(stats.Recorder(trace=trace is not None))
+    root_uri = None
+    if changed_since is not None or staged:
+        try:
+            root_uri = urify(git.repository_root())
+            changed = git.changed_files(changed_since, staged)
+        except RuntimeError as e:
+            raise click.ClickException(str(e))
+        files = discovery.FileFinder(list(exclude)).filter(changed, list(files))
+    else:
+        files = get_files_by_glob(list(files), list(exclude))
+    known_issues = None
+    if baseline_file is not None:
+        try:
+            known_issues = sonarlint_baseline.Baseline.load(baseline_file, os.getcwd())
+        except (OSError, ValueError) as e:
+            raise click.ClickException("Could not load baseline %s: %s" % (baseline_file, e))
+        for uri, e in known_issues.skipped:
+            click.echo("Baseline: skipping %s: %s" % (uri, e), err=True)
+
+    if output is None:
+        handle = sys.stdout
+    else:
+        handle = open(output, "w", buffering=1024 * 1024)
+    try:
+        writer = output_writers.create_writer(output_format, handle)
+        if known_issues is not None:
+            writer = output_writers.BaselineWriter(writer, known_issues)
+        result_cache = None
+        if not no_cache:
+            result_cache = cache.ResultCache(CACHE_DIR, sonarlint.analyzer_fingerprint(), cache_size * 1024 * 1024)
+            cached, files = result_cache.lookup(files)
+            for result in cached:
+                writer.write(result)
+
+        max_file_size = max_file_size * 1024 if max_file_size > 0 else None
+
+        def each_callback(uri, result):
+            writer.write(result)
+            # skipped files depend on --max-file-size and not only on their content
+            if result_cache is not None and "error" not in result and "skipped" not in result:
+                result_cache.put(unurify(uri), result)
+
+        if len(files) > 0:
+            if workers == 1 and not no_daemon and sonarlint_daemon.is_running(DAEMON_SOCKET):
+                files = [os.path.abspath(file) for file in files]
+                analysis = sonarlint_daemon.forward_analysis(
+                    DAEMON_SOCKET, files, each_callback, max_open, keep_results=False, file_timeout=file_timeout,
+                    timeout=timeout, max_file_size=max_file_size, root_uri=root_uri,
+                    settings=daemon_settings(click.get_current_context(), java_bin, transport, jvm_opts)
+                )
+            else:
+                download_analyzers()
+                analysis = run_analysis(
+                    files, java_bin, each_callback, workers=workers, keep_results=False, root_uri=root_uri,
+                    timeout=timeout, max_restarts=max_restarts, transport=transport,
+                    jvm_options=configured_jvm_options(jvm_opts), max_open=max_open, file_timeout=file_timeout,
+                    max_file_size=max_file_size
+                )
+            try:
+                asyncio.run(analysis)
+            except sonarlint_daemon.DaemonError as e:
+                raise click.ClickException(str(e))
+
+        writer.close()
+        if result_cache is not None:
+            # the output is complete, so a failing eviction cannot take it down with it
+            result_cache.evict()
+    finally:
+        if output is not None:
+            handle.close()
+        if recorder is not None:
+            stats.install(None)
+            if show_stats:
+                click.echo(recorder.format_summary(), err=True)
+            if trace is not None:
+                recorder.write_trace(trace)
+
+
+def daemon_settings(ctx: click.Context, java_bin, transport, jvm_opts) -> dict:
+    """
+    Settings a running daemon has to have been started with to analyse for a command (see daemon.Daemon). Only the
+    options that have been given explicitly count, the defaults are fine with any daemon.
+
+    :param ctx:
+    :param java_bin:
+    :param transport:
+    :param jvm_opts:
+    :return:
+    """
+    settings = {}
+    if ctx.get_parameter_source("java_bin") is not ParameterSource.DEFAULT:
+        settings["java_bin"] = java_bin
+    if ctx.get_parameter_source("transport") is not ParameterSource.DEFAULT:
+        settings["transport"] = transport
+    if len(jvm_opts) > 0:
+        settings["jvm_options"] = configured_jvm_options(jvm_opts)
+    return settings
+
+
+async def run_analysis(files, java_bin, each_callback=None, workers=1, keep_results=True, root_uri=None,
+                       timeout=None, max_restarts=3, transport="tcp", jvm_options: list = None, **options) -> list:
+    """
+    Analyse all files with one or more SonarLint language servers and merge their results
+    The files are spread over the language servers by size (see sonarlint.shard_files).
+
+    :param files:
+    :param java_bin:
+    :param each_callback: called with the URI and result of each file once it has been analysed
+    :param workers: number of language servers to run in parallel
+    :param keep_results: return all results at the end. Disable this if each_callback already consumes them.
+    :param root_uri: workspace root for the language servers. Defaults to the common path of the projects of a shard.
+    :param timeout: seconds after which all files without result are reported as timed out
+    :param max_restarts: number of times a crashed language server is replaced per shard
+    :param transport: see sonarlint.TRANSPORTS
+    :param jvm_options: see create_worker
+    :param options: passed to SonarLintWorker.analyze (e.g. max_open or file_timeout)
+    :return:
+    """
+    if timeout is not None:
+        options["deadline"] = asyncio.get_event_loop().time() + timeout
+    # keep the files of a project together so every language server only needs to know a few projects
+    shards = sonarlint.shard_files(files, workers, discovery.group_by_project(files)) if workers > 1 else [files]
+    rule_database = open_rule_database()
+    try:
+        results = await asyncio.gather(*[run_shard(
+            shard,
+            java_bin,
+            each_callback,
+            rules=rule_database.rules,
+            keep_results=keep_results,
+            root_uri=root_uri,
+            max_restarts=max_restarts,
+            transport=transport,
+            jvm_options=jvm_options,
+            **options
+        ) for shard in shards])
+    finally:
+        rule_database.save()
+    return [result for shard_results in results for result in shard_results]
+
+
+def create_worker(java_bin, root_uri, rules: dict = None, languages: set = None, request_timeout: float = None,
+                  transport: str = "tcp", workspace_folders: list = None, jvm_options: list = None,
+                  class_data_sharing: bool = True) -> sonarlint.SonarLintWorker:
+    """
+    Create a worker that loads the analyzers for the given languages or all downloaded analyzers if languages is None
 
+    :param java_bin:
+    :param root_uri:
+    :param rules:
+    :param languages:
+    :param request_timeout: seconds to wait for rule details from the language server
+    :param transport: see sonarlint.TRANSPORTS
+    :param workspace_folders: project roots to initialize the language server with
+    :param jvm_options: defaults to the options in JVM_OPTIONS_FILE
+    :param class_data_sharing: start the JVM with the AppCDS archive recorded by prefetch if there is one
+    :return:
+    """
+    if languages is None:
+        analyzers = get_files_by_ext(DEFAULT_ANALYZERS_DIR, ['jar'])
+    else:
+        analyzers = sonarlint.get_analyzer_jars(DEFAULT_ANALYZERS_DIR, languages)
+    if jvm_options is None:
+        jvm_options = configured_jvm_options()
+    if class_data_sharing and os.path.isfile(cds_archive(java_bin)):
+        # first so -Xshare:off in the configured options still wins
+        jvm_options = jvm.cds_options(cds_archive(java_bin)) + jvm_options
+    return sonarlint.SonarLintWorker(
+        ls_jar=DEFAULT_LS_JAR,
+        analyzers=analyzers,
+        java_bin=java_bin,
+        root_uri=root_uri,
+        rules=rules,
+        request_timeout=request_timeout,
+        transport=transport,
+        workspace_folders=workspace_folders,
+        jvm_options=jvm_options
+    )
+
+
+async def run_shard(files, java_bin, each_callback=None, rules: dict = None, keep_results=True, root_uri=None,
+                    max_restarts=3, transport="tcp", jvm_options: list = None, **options) -> list:
+    """
+    Start a SonarLint language server and analyse all files with it
+    If the language server crashes the unfinished files are analysed on a new one (see sonarlint.analyze_with_restarts).
+
+    :param files:
+    :param java_bin:
+    :param each_callback: called with the URI and result of each file once it has been analysed
+    :param rules: known rule details by code that will be extended with newly resolved rules
+    :param keep_results: return all results at the end. Disable this if each_callback already consumes them.
+    :param root_uri: workspace root for the language server. Defaults to the common path of all projects.
+    :param max_restarts: number of times a crashed language server is replaced
+    :param transport: see sonarlint.TRANSPORTS
+    :param jvm_options: see create_worker
+    :param options: passed to SonarLintWorker.analyze (e.g. max_open or file_timeout)
+    :return:
+    """
+    # every project root becomes a workspace folder so analyzers resolve their context per project
+    projects = list(discovery.group_by_project(files).keys())
+    if root_uri is None:
+        root_uri = urify(os.path.commonpath(projects))
+    # only load the analyzers for the languages of this shard
+    languages = sonarlint.get_languages(files)
+    return await sonarlint.analyze_with_restarts(
+        lambda: create_worker(
+            java_bin, root_uri, rules, languages, options.get("file_timeout"), transport, projects, jvm_options
+        ),
+        files,
+        each_callback,
+        keep_results=keep_results,
+        max_restarts=max_restarts,
+        **options
+    )
+
+
+@main.command()
+@click.argument("files", nargs=-1)
+@click.option("--java-bin", default='/usr/bin/java')
+@click.option("--output", help="Append results to this file instead of printing them")
+@click.option("--exclude", multiple=True,
+              help="Skip files and directories matching this .gitignore-style pattern (relative to the working dir)")
+@click.option("--initial/--no-initial", default=True, help="Analyse all matching files once before watching")
+@click.option("--poll", is_flag=True, help="Poll for changes instead of using inotify")
+@click.option("--interval", default=1.0, type=float, help="Seconds between two scans when polling")
+@transport_option
+@jvm_opt_option
+@max_open_option
+@file_timeout_option
+def watch(files, java_bin, output, exclude, initial, poll, interval, transport, jvm_opts, max_open, file_timeout):
+    """
+    Analyse files again whenever they change and print their results as NDJSON
+    """
+    download_analyzers()
+    handle = sys.stdout if output is None else open(output, "a")
+    writer = output_writers.NdjsonWriter(handle)
+
+    def each_callback(uri, result):
+        writer.write(result)
+        handle.flush()
+
+    try:
+        asyncio.run(run_watch(
+            list(files), java_bin, each_callback, list(exclude), initial, poll, interval, transport,
+            configured_jvm_options(jvm_opts), max_open, file_timeout
+        ))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if output is not None:
+            handle.close()
+
+
+async def run_watch(patterns, java_bin, each_callback, excludes=None, initial=True, poll=False, interval=1.0,
+                    transport="tcp", jvm_options: list = None, max_open=64, file_timeout=None):
+    """
+    Keep one language server session open and send every change of a file matching the patterns to it
+
+    :param patterns:
+    :param java_bin:
+    :param each_callback: called with the URI and result of a file whenever it has been analysed
+    :param excludes:
+    :param initial: analyse all matching files once at the beginning
+    :param poll: poll for changes instead of using inotify
+    :param interval: seconds between two scans when polling
+    :param transport: see sonarlint.TRANSPORTS
+    :param jvm_options: see create_worker
+    :param max_open: maximum number of documents that are open on the language server at the same time
+    :param file_timeout: seconds after which a file without result is reported as timed out
+    :return:
+    """
+    watcher = sonarlint_watch.create_watcher(patterns, excludes, poll, interval)
+    files = watcher.start()
+    rule_database = open_rule_database()
+    try:
+        async with create_worker(java_bin, urify(os.getcwd()), rule_database.rules, request_timeout=file_timeout,
+                                 transport=transport, jvm_options=jvm_options) as worker:
+            if initial and len(files) > 0:
+                await worker.analyze(files, each_callback, max_open, keep_results=False, file_timeout=file_timeout)
+                rule_database.save()
+            live = sonarlint.LiveAnalysis(worker.server, worker.rule_resolver, each_callback, max_open, file_timeout,
+                                          worker.closed_documents)
+            live.start()
+            try:
+                async for changed, removed in watcher.changes():
+                    for file in removed:
+                        live.remove(file)
+                    for file in changed:
+                        live.update(file)
+                    rule_database.save()
+            finally:
+                live.stop()
+    finally:
+        watcher.close()
+        rule_database.save()
+
+
+@main.command()
+@click.option("--host", default="127.0.0.1", help="Address to listen on")
+@click.option("--port", default=8080, type=click.IntRange(min=0, max=65535), help="Port to listen on (0 picks one)")
+@click.option("--java-bin", default='/usr/bin/java')
+@click.option("--workers", default=2, type=click.IntRange(min=1), help="Number of warm language servers")
+@click.option("--max-queue", default=1000, type=click.IntRange(min=1),
+              help="Requests that may wait for a worker before new ones are rejected with 503")
+@max_open_option
+@file_timeout_option
+@transport_option
+@max_file_size_option
+@jvm_opt_option
+def serve(host, port, java_bin, workers, max_queue, max_open, file_timeout, transport, max_file_size, jvm_opts):
+    """
+    Analyse files and sources sent over HTTP on a pool of warm language servers
+    """
     download_analyzers()
+    rule_database = open_rule_database()
+    jvm_options = configured_jvm_options(jvm_opts)
+    analysis_service = service.AnalysisService(
+        lambda: create_worker(java_bin, urify(os.getcwd()), rule_database.rules, request_timeout=file_timeout,
+                              transport=transport, jvm_options=jvm_options),
+        workers=workers,
+        max_queue=max_queue,
+        max_open=max_open,
+        file_timeout=file_timeout,
+        rule_database=rule_database,
+        max_file_size=max_file_size * 1024 if max_file_size > 0 else None
+    )
 
-    done = threading.Event()
-
-    def save_lint_result(results):
-        json_result = json.dumps(results, indent=4)
-        if output is None:
-            sys.stdout.write(json_result)
-        else:
-            with open(output, "w") as handle:
-                handle.write(json_result)
-
-    def finish(lint_results):
-        save_lint_result(lint_results)
-        done.set()
-
-    def on_connection(server: languageserver.ReverseServer, socket):
-        rule_resolver = sonarlint.SonarLintRuleResolver(server)
-        sonarlint.analyze(
-            server,
-            rule_resolver,
-            files,
-            done_callback=finish
+    async def run():
+        loop = asyncio.get_event_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, analysis_service.stop)
+        await analysis_service.run(
+            host, port, lambda address: click.echo("Listening on http://%s:%s" % address[:2], err=True)
         )
 
-    with languageserver.ReverseServer(on_connection=on_connection) as server:
-        sonar_process = sonarlint.SonarLintProcess(
-            port=server.addr[1],
-            ls_jar=DEFAULT_LS_JAR,
-            analyzers=get_files_by_ext(DEFAULT_ANALYZERS_DIR, ['jar']),
-            java_bin=java_bin
+    asyncio.run(run())
+
+
+@main.group()
+def baseline():
+    """
+    Manage baselines of known issues for analyse --baseline
+    """
+
+
+@baseline.command("save")
+@click.argument("results", type=click.Path(exists=True, dir_okay=False))
+@click.argument("output", type=click.Path(dir_okay=False, writable=True))
+def baseline_save(results, output):
+    """
+    Index the issues of a JSON or NDJSON result file in the compact baseline format
+    The lines of the issues are read from the files on disk, so run this on the checkout the results belong to. Paths
+    are stored relative to the working directory.
+    """
+    index = sonarlint_baseline.Baseline(os.getcwd())
+    try:
+        index.add_results(sonarlint_baseline.read_results(results))
+    except ValueError as e:
+        raise click.ClickException("Could not read results from %s: %s" % (results, e))
+    for uri, e in index.skipped:
+        click.echo("Skipping %s: %s" % (uri, e), err=True)
+    index.save(output)
+    click.echo("%s issues in %s" % (len(index), output), err=True)
+
+
+@main.group()
+def daemon():
+    """
+    Keep a SonarLint language server running in the background. analyse will use it automatically.
+    """
+    pass
+
+
+@daemon.command("start")
+@click.option("--java-bin", default='/usr/bin/java')
+@click.option("--idle-timeout", default=1800, type=float, help="Stop the daemon after this many idle seconds")
+@transport_option
+@jvm_opt_option
+@click.option("--request-timeout", default=300, type=click.FloatRange(min=0),
+              help="Seconds to wait for rule details from the language server before the files that need them fail")
+def daemon_start(java_bin, idle_timeout, transport, jvm_opts, request_timeout):
+    if sonarlint_daemon.is_running(DAEMON_SOCKET):
+        click.echo("Daemon is already running")
+        return
+    download_analyzers()
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [os.path.dirname(ROOT_DIR), env.get("PYTHONPATH")]))
+    command = [sys.executable, "-m", "sonarlintcli.cli", "daemon", "run",
+               "--java-bin", java_bin, "--idle-timeout", str(idle_timeout), "--transport", transport,
+               "--request-timeout", str(request_timeout)]
+    for option in jvm_opts:
+        # the = keeps click from reading options like -Xmx2g as its own
+        command.append("--jvm-opt=%s" % option)
+    with open(DAEMON_LOG, "a") as log:
+        subprocess.Popen(
+            command,
+            stdin=subprocess.DEVNULL,
+            stdout=log,
+            stderr=log,
+            env=env,
+            start_new_session=True
         )
-        sonar_process.start()
-        bg_server = threading.Thread(target=server.start)
-        bg_server.start()
-        # Wait until done flag has been set after one analysis and stop server and SonarLint LS process
-        done.wait()
-        server.stop()
-        sonar_process.stop()
+    deadline = time.time() + 60
+    while not sonarlint_daemon.is_running(DAEMON_SOCKET):
+        if time.time() > deadline:
+            raise click.ClickException("Daemon did not start within 60s. See %s" % DAEMON_LOG)
+        time.sleep(.1)
+    click.echo("Daemon started")
+
+
+@daemon.command("run", hidden=True)
+@click.option("--java-bin", default='/usr/bin/java')
+@click.option("--idle-timeout", default=1800, type=float)
+@transport_option
+@jvm_opt_option
+@click.option("--request-timeout", default=300, type=click.FloatRange(min=0))
+def daemon_run(java_bin, idle_timeout, transport, jvm_opts, request_timeout):
+    rule_database = open_rule_database()
+    jvm_options = configured_jvm_options(jvm_opts)
+    server = sonarlint_daemon.Daemon(
+        DAEMON_SOCKET,
+        lambda: create_worker(java_bin, urify(os.getcwd()), rule_database.rules, request_timeout=request_timeout,
+                              transport=transport, jvm_options=jvm_options),
+        idle_timeout=idle_timeout,
+        rule_database=rule_database,
+        settings={"java_bin": java_bin, "transport": transport, "jvm_options": jvm_options}
+    )
+    asyncio.run(server.run())
+
+
+@daemon.command("stop")
+def daemon_stop():
+    if not sonarlint_daemon.is_running(DAEMON_SOCKET):
+        click.echo("Daemon is not running")
+        return
+    asyncio.run(sonarlint_daemon.request(DAEMON_SOCKET, {"command": "stop"}))
+    deadline = time.time() + 30
+    while os.path.exists(DAEMON_SOCKET) and time.time() < deadline:
+        time.sleep(.1)
+    click.echo("Daemon stopped")
+
+
+@daemon.command("status")
+def daemon_status():
+    if not sonarlint_daemon.is_running(DAEMON_SOCKET):
+        click.echo("Daemon is not running")
+        return
+    status = asyncio.run(sonarlint_daemon.request(DAEMON_SOCKET, {"command": "status"}))
+    click.echo(json.dumps(status, indent=4))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,298 @@
+import asyncio
+import json
+import os
+import socket
+import time
+
+from sonarlintcli.languageserver import unurify, urify
+from sonarlintcli.sonarlint import LanguageServerExited
+
+# results for big files can easily exceed the default line limit of asyncio streams
+STREAM_LIMIT = 1024 * 1024 * 64
+
+
+class DaemonError(RuntimeError):
+    """
+    Raised if the daemon answers a request with an error
+    """
+
+
+def write_message(writer: asyncio.StreamWriter, message: dict):
+    writer.write(json.dumps(message, separators=(',', ':')).encode() + b"\n")
+
+
+async def read_message(reader: asyncio.StreamReader):
+    line = await reader.readline()
+    if not line:
+        return None
+    return json.loads(line.decode('utf-8'))
+
+
+class Daemon:
+    """
+    Keeps a SonarLintWorker alive behind a local Unix socket so analyses do not have to pay for JVM startup and
+    initialization every time.
+    Clients send a single JSON request line ({"command": "analyse"|"status"|"stop", ...}) and receive JSON lines back.
+    The language server is restarted automatically if it crashes and the daemon exits after idle_timeout seconds
+    without any request. Analyses that ask for other settings (e.g. java_bin or transport) than the language server has
+    been started with are refused.
+    """
+
+    def __init__(self, socket_path: str, worker_factory: callable, idle_timeout: float = 1800, rule_database=None,
+                 settings: dict = None):
+        self.socket_path = socket_path
+        self.idle_timeout = idle_timeout
+        self.settings = settings or {}
+        self._worker_factory = worker_factory
+        self._rule_database = rule_database
+        self._worker = None
+        self._worker_ready: asyncio.Event = None
+        self._stop: asyncio.Future = None
+        self._idle_handle = None
+        self._active = 0
+        self._started = time.time()
+        self._analyses = 0
+        self._restarts = 0
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        self._stop = loop.create_future()
+        self._worker_ready = asyncio.Event()
+        await self._start_worker()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        server = await asyncio.start_unix_server(self._handle_client, path=self.socket_path, limit=STREAM_LIMIT)
+        supervisor = asyncio.ensure_future(self._supervise())
+        self._reset_idle_timer()
+        try:
+            await self._stop
+        finally:
+            server.close()
+            await server.wait_closed()
+            supervisor.cancel()
+            if self._idle_handle is not None:
+                self._idle_handle.cancel()
+            await self._worker.stop()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+    def stop(self):
+        if not self._stop.done():
+            self._stop.set_result(None)
+
+    async def _start_worker(self):
+        self._worker_ready.clear()
+        self._worker = self._worker_factory()
+        await self._worker.start()
+        self._worker_ready.set()
+
+    async def _supervise(self):
+        """
+        Restart the language server whenever its process exits while the daemon is still running
+
+        :return:
+        """
+        while not self._stop.done():
+            await self._worker.process.wait()
+            if self._stop.done():
+                return
+            print("SonarLint language server exited unexpectedly. Restarting...")
+            self._restarts += 1
+            await self._worker.stop()
+            try:
+                await self._start_worker()
+            except Exception as e:
+                print("Could not restart SonarLint language server: %s" % e)
+                self.stop()
+                return
+
+    def _reset_idle_timer(self):
+        if self._idle_handle is not None:
+            self._idle_handle.cancel()
+        self._idle_handle = asyncio.get_event_loop().call_later(self.idle_timeout, self._on_idle)
+
+    def _on_idle(self):
+        if self._active > 0:
+            self._reset_idle_timer()
+            return
+        print("No requests for %ss. Stopping daemon..." % self.idle_timeout)
+        self.stop()
+
+    def status(self) -> dict:
+        return {
+            "pid": os.getpid(),
+            "uptime": time.time() - self._started,
+            "analyses": self._analyses,
+            "active": self._active,
+            "restarts": self._restarts,
+            "idle_timeout": self.idle_timeout,
+            "java_bin": self._worker.java_bin,
+            "running": self._worker.running
+        }
+
+    async def _analyze(self, files, each_callback, max_open, file_timeout=None, timeout=None, max_file_size=None,
+                       root_uri=None):
+        """
+        Run an analysis on the worker. If the language server crashes in between the files without result are analysed
+        once more on the fresh language server started by the supervisor.
+
+        :param files:
+        :param each_callback:
+        :param max_open:
+        :param file_timeout:
+        :param timeout:
+        :param max_file_size:
+        :param root_uri: workspace root of the client, added as a workspace folder
+        :return:
+        """
+        finished = set()
+
+        def on_result(uri, result):
+            finished.add(uri)
+            each_callback(uri, result)
+
+        deadline = None if timeout is None else asyncio.get_event_loop().time() + timeout
+        for attempt in range(2):
+            await self._worker_ready.wait()
+            worker = self._worker
+            if root_uri is not None:
+                worker.add_workspace_folders([unurify(root_uri)])
+            try:
+                return await worker.analyze(files, on_result, max_open, keep_results=False, file_timeout=file_timeout,
+                                            deadline=deadline, max_file_size=max_file_size)
+            except LanguageServerExited:
+                if attempt > 0:
+                    raise
+                files = [file for file in files if urify(file) not in finished]
+                # wait for the supervisor to bring up a new language server
+                if self._worker is worker:
+                    self._worker_ready.clear()
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._active += 1
+        try:
+            request = await read_message(reader)
+            command = request.get("command") if request is not None else None
+            if command == "analyse":
+                differing = sorted(
+                    name for name, value in (request.get("settings") or {}).items() if self.settings.get(name) != value
+                )
+                if len(differing) > 0:
+                    raise RuntimeError("The daemon has been started with a different %s. Restart it with these settings "
+                                       "or analyse without it (--no-daemon)" % ", ".join(differing))
+                self._analyses += 1
+                await self._analyze(
+                    request["files"],
+                    lambda uri, result: write_message(writer, {"result": result}),
+                    request.get("max_open", 64),
+                    request.get("file_timeout"),
+                    request.get("timeout"),
+                    request.get("max_file_size"),
+                    request.get("root_uri")
+                )
+                if self._rule_database is not None:
+                    self._rule_database.save()
+                write_message(writer, {"done": True})
+            elif command == "status":
+                write_message(writer, self.status())
+            elif command == "stop":
+                write_message(writer, {"stopping": True})
+                self.stop()
+            else:
+                write_message(writer, {"error": "Unknown command %s" % command})
+            await writer.drain()
+        except Exception as e:
+            write_message(writer, {"error": str(e)})
+        finally:
+            self._active -= 1
+            self._reset_idle_timer()
+            writer.close()
+
+
+def is_running(socket_path: str) -> bool:
+    """
+    Check if a daemon accepts connections on the given socket
+
+    :param socket_path:
+    :return:
+    """
+    if not os.path.exists(socket_path):
+        return False
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+
+async def request(socket_path: str, message: dict, on_message: callable = None) -> dict:
+    """
+    Send a request to a running daemon
+    Every message the daemon answers with will be passed to on_message. The last message is returned.
+
+    :param socket_path:
+    :param message:
+    :param on_message:
+    :return:
+    """
+    reader, writer = await asyncio.open_unix_connection(socket_path, limit=STREAM_LIMIT)
+    try:
+        write_message(writer, message)
+        await writer.drain()
+        last = None
+        while True:
+            answer = await read_message(reader)
+            if answer is None:
+                return last
+            if "error" in answer:
+                raise DaemonError("Daemon error: %s" % answer["error"])
+            last = answer
+            if on_message is not None:
+                on_message(answer)
+    finally:
+        writer.close()
+
+
+async def forward_analysis(socket_path: str, files: list, each_callback: callable = None, max_open: int = 64,
+                           keep_results: bool = True, file_timeout: float = None, timeout: float = None,
+                           max_file_size: int = None, root_uri: str = None, settings: dict = None) -> list:
+    """
+    Let a running daemon analyse the files and stream the results back
+
+    :param socket_path:
+    :param files:
+    :param each_callback: called with the URI and result of each file once it has been analysed
+    :param max_open: maximum number of documents that are open on the language server at the same time
+    :param keep_results: return all results at the end. Disable this if each_callback already consumes them.
+    :param file_timeout: seconds after which a file without result is reported as timed out
+    :param timeout: seconds after which all files without result are reported as timed out
+    :param max_file_size: files with more bytes are reported as skipped
+    :param root_uri: workspace root the files belong to
+    :param settings: settings the language server has to have been started with (see Daemon.settings)
+    :return:
+    """
+    results = []
+
+    def on_message(message):
+        if "result" in message:
+            if keep_results:
+                results.append(message["result"])
+            if each_callback is not None:
+                each_callback(message["result"]["uri"], message["result"])
+
+    last = await request(socket_path, {
+        "command": "analyse",
+        "files": files,
+        "max_open": max_open,
+        "file_timeout": file_timeout,
+        "timeout": timeout,
+        "max_file_size": max_file_size,
+        "root_uri": root_uri,
+        "settings": settings or {}
+    }, on_message)
+    if last is None or not last.get("done"):
+        raise RuntimeError("Connection to daemon closed before analysis finished")
+    return results
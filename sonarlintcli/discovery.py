@@ -0,0 +1,388 @@
+import os
+import re
+
+from sonarlintcli.languageserver import FILE_EXTENSIONS_REVERSE
+
+# version control metadata is never worth looking into
+ALWAYS_EXCLUDED = {'.git', '.hg', '.svn'}
+# build files that mark the root directory of a project
+PROJECT_MARKERS = {'pom.xml', 'build.gradle', 'build.gradle.kts', 'package.json', 'tsconfig.json', 'setup.py',
+                   'pyproject.toml'}
+
+
+def translate_glob(pattern: str) -> str:
+    """
+    Translate a glob with Path.glob semantics into a regular expression
+    "*" and "?" never match "/" and a "**" segment matches any number of directories (including none).
+
+    :param pattern:
+    :return:
+    """
+    parts = []
+    segments = pattern.split('/')
+    for i, segment in enumerate(segments):
+        last = i == len(segments) - 1
+        if segment == '**':
+            parts.append('.*' if last else '(?:[^/]+/)*')
+            continue
+        regex = ''
+        j = 0
+        while j < len(segment):
+            c = segment[j]
+            if c == '*':
+                regex += '[^/]*'
+            elif c == '?':
+                regex += '[^/]'
+            elif c == '[' and segment.find(']', j + 2) != -1:
+                end = segment.find(']', j + 2)
+                content = segment[j + 1:end]
+                if content.startswith('!'):
+                    content = '^' + content[1:]
+                regex += '[%s]' % content.replace('\\', '\\\\')
+                j = end
+            else:
+                regex += re.escape(c)
+            j += 1
+        parts.append(regex if last else regex + '/')
+    return ''.join(parts)
+
+
+def has_magic(pattern: str) -> bool:
+    return any(c in pattern for c in '*?[')
+
+
+class IgnoreRules:
+    """
+    Matcher for .gitignore-style patterns relative to a base directory
+    Supports comments, negation with "!", directory-only patterns with a trailing "/", patterns anchored by a "/"
+    and "**". The last matching pattern wins like in git.
+    """
+
+    def __init__(self, base: str, lines: list):
+        self.base = base
+        self._prefix = base.rstrip('/') + '/'
+        self._rules = []
+        for line in lines:
+            line = line.rstrip('\n').rstrip('\r')
+            if line.endswith('\\ '):
+                line = line[:-2] + ' '
+            else:
+                line = line.rstrip(' ')
+            if line == '' or line.startswith('#'):
+                continue
+            negate = line.startswith('!')
+            if negate:
+                line = line[1:]
+            elif line.startswith('\\'):
+                line = line[1:]
+            dir_only = line.endswith('/')
+            line = line.rstrip('/')
+            if line == '':
+                continue
+            if '/' in line:
+                # patterns with a slash are relative to the base directory
+                regex = translate_glob(line.lstrip('/'))
+            else:
+                regex = '(?:.*/)?' + translate_glob(line)
+            self._rules.append((re.compile(regex + r'\Z'), negate, dir_only))
+
+    @classmethod
+    def from_file(cls, base: str, path: str):
+        try:
+            with open(path, "r", errors="replace") as handle:
+                return cls(base, handle.readlines())
+        except OSError:
+            return None
+
+    def __bool__(self):
+        return len(self._rules) > 0
+
+    def match(self, path: str, is_dir: bool):
+        """
+        Check if a path is ignored by these rules
+
+        :param path: absolute path
+        :param is_dir:
+        :return: True if ignored, False if explicitly included with "!" and None if no pattern matches
+        """
+        if not path.startswith(self._prefix):
+            return None
+        relative = path[len(self._prefix):]
+        result = None
+        for regex, negate, dir_only in self._rules:
+            if dir_only and not is_dir:
+                continue
+            if regex.match(relative):
+                result = not negate
+        return result
+
+
+def find_repository_root(path: str):
+    while True:
+        if os.path.exists(os.path.join(path, '.git')):
+            return path
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def find_project_root(directory: str, known: dict = None):
+    """
+    Find the nearest directory at or above directory that contains a project build file (see PROJECT_MARKERS)
+    The search stops at the repository root.
+
+    :param directory: absolute path
+    :param known: project root (or None) by directory of earlier lookups. Filled with every directory visited.
+    :return: the project root or None if there is none
+    """
+    known = {} if known is None else known
+    visited = []
+    root = None
+    while True:
+        if directory in known:
+            root = known[directory]
+            break
+        visited.append(directory)
+        try:
+            entries = set(os.listdir(directory))
+        except OSError:
+            entries = set()
+        if not entries.isdisjoint(PROJECT_MARKERS):
+            root = directory
+            break
+        parent = os.path.dirname(directory)
+        if '.git' in entries or parent == directory:
+            break
+        directory = parent
+    for path in visited:
+        known[path] = root
+    return root
+
+
+def group_by_project(files: list) -> dict:
+    """
+    Group files by their project root (see find_project_root)
+    Files outside of any project are grouped under their common directory.
+
+    :param files:
+    :return: files by absolute project root
+    """
+    known = {}
+    groups = {}
+    orphans = []
+    for file in files:
+        directory = os.path.dirname(os.path.abspath(file))
+        root = find_project_root(directory, known)
+        if root is None:
+            orphans.append((directory, file))
+        else:
+            groups.setdefault(root, []).append(file)
+    if len(orphans) > 0:
+        common = os.path.commonpath([directory for directory, _ in orphans])
+        groups.setdefault(common, []).extend(file for _, file in orphans)
+    return groups
+
+
+def split_pattern(pattern: str):
+    """
+    Split a glob pattern into the absolute directory before the first wildcard, a regex for the rest of the pattern and
+    the maximum directory depth below the directory the pattern can match (None if unlimited)
+
+    :param pattern:
+    :return: tuple of (root, regex, depth)
+    """
+    pattern = os.path.join(os.getcwd(), pattern) if not pattern.startswith('/') else pattern
+    segments = pattern.split('/')
+    static = 0
+    while static < len(segments) - 1 and not has_magic(segments[static]):
+        static += 1
+    root = os.path.normpath('/'.join(segments[:static]) or '/')
+    depth = None if '**' in segments[static:] else len(segments) - static
+    return root, translate_glob('/'.join(segments[static:])), depth
+
+
+class FileFinder:
+    """
+    Finds files matching any number of glob patterns in a single pass over the file system
+    Every directory is scanned at most once with os.scandir. Directories excluded by .gitignore files or the exclude
+    patterns are pruned together with everything below them. Only files with a known language are returned by default.
+    """
+
+    def __init__(self, excludes: list = None, use_gitignore: bool = True, extensions=None):
+        self._excludes = IgnoreRules(os.getcwd(), excludes or [])
+        self._use_gitignore = use_gitignore
+        self._extensions = FILE_EXTENSIONS_REVERSE if extensions is None else extensions
+
+    def find(self, patterns: list, on_directory: callable = None) -> list:
+        """
+        Return all files matching any of the patterns without duplicates
+        Patterns without wildcards are returned as-is. Matches of glob patterns are returned as absolute paths.
+
+        :param patterns:
+        :param on_directory: called with every directory that is scanned
+        :return:
+        """
+        files = []
+        seen = set()
+        roots = {}
+        for pattern in patterns:
+            if pattern == '':
+                continue
+            if not has_magic(pattern):
+                if pattern not in seen:
+                    seen.add(pattern)
+                    files.append(pattern)
+                continue
+            root, regex, depth = split_pattern(pattern)
+            roots.setdefault(root, []).append((regex, depth))
+
+        # nested roots are covered by the walk of their outermost parent
+        for root in sorted(roots.keys()):
+            for other in roots.keys():
+                if other != root and root.startswith(other.rstrip('/') + '/'):
+                    break
+            else:
+                nested = [(r, p) for r, p in roots.items() if r == root or r.startswith(root.rstrip('/') + '/')]
+                for path in self._walk(root, nested, on_directory):
+                    if path not in seen:
+                        seen.add(path)
+                        files.append(path)
+        return files
+
+    def filter(self, files: list, patterns: list = None) -> list:
+        """
+        Keep only files with a known language that are not excluded and match one of the patterns (if any)
+        .gitignore files are not taken into account here.
+
+        :param files: absolute paths
+        :param patterns:
+        :return:
+        """
+        matchers = []
+        for pattern in patterns or []:
+            if pattern == '':
+                continue
+            if has_magic(pattern):
+                root, regex, _ = split_pattern(pattern)
+                matchers.append(re.escape(root.rstrip('/') + '/') + regex)
+            else:
+                matchers.append(re.escape(os.path.abspath(pattern)))
+        matcher = re.compile('(?:%s)\\Z' % '|'.join(matchers)) if len(matchers) > 0 else None
+        filtered = []
+        for file in files:
+            _, ext = os.path.splitext(file)
+            if ext[1:] not in self._extensions or self._is_excluded_file(file):
+                continue
+            if matcher is None or matcher.match(file):
+                filtered.append(file)
+        return filtered
+
+    def _is_excluded_file(self, file: str) -> bool:
+        """
+        Check a file and all of its parent directories against the exclude patterns
+
+        :param file:
+        :return:
+        """
+        if self._excludes.match(file, False):
+            return True
+        directory = os.path.dirname(file)
+        while directory.startswith(self._excludes.base.rstrip('/') + '/'):
+            if self._excludes.match(directory, True):
+                return True
+            directory = os.path.dirname(directory)
+        return False
+
+    def _initial_ignores(self, root: str) -> list:
+        """
+        Load the .gitignore files of all directories between the repository root and root (exclusive)
+
+        :param root:
+        :return:
+        """
+        if not self._use_gitignore:
+            return []
+        repository = find_repository_root(root)
+        if repository is None or repository == root:
+            return []
+        directories = []
+        directory = os.path.dirname(root)
+        while True:
+            directories.insert(0, directory)
+            if directory == repository:
+                break
+            directory = os.path.dirname(directory)
+        ignores = []
+        for directory in directories:
+            rules = IgnoreRules.from_file(directory, os.path.join(directory, '.gitignore'))
+            if rules:
+                ignores.append(rules)
+        return ignores
+
+    def _is_excluded(self, path: str, is_dir: bool, ignores: list) -> bool:
+        if self._excludes.match(path, is_dir):
+            return True
+        excluded = False
+        for rules in ignores:
+            matched = rules.match(path, is_dir)
+            if matched is not None:
+                excluded = matched
+        return excluded
+
+    def _walk(self, root: str, patterns: list, on_directory: callable = None):
+        """
+        Walk the tree below root once and yield all files matching one of the patterns
+
+        :param root:
+        :param patterns: list of (root, [(regex, max depth)]) with roots equal to or below root
+        :param on_directory: called with every directory that is scanned
+        :return:
+        """
+        matchers = []
+        max_depth = 0
+        for pattern_root, globs in patterns:
+            prefix = pattern_root.rstrip('/') + '/'
+            offset = len(os.path.relpath(pattern_root, root).split('/')) if pattern_root != root else 0
+            for regex, depth in globs:
+                matchers.append(re.escape(prefix) + regex)
+                max_depth = None if depth is None or max_depth is None else max(max_depth, depth + offset)
+        matcher = re.compile('(?:%s)\\Z' % '|'.join(matchers))
+        if not os.path.isdir(root):
+            return
+        stack = [(root.rstrip('/') or '/', 1, self._initial_ignores(root))]
+        while stack:
+            directory, depth, ignores = stack.pop()
+            if self._use_gitignore:
+                rules = IgnoreRules.from_file(directory, os.path.join(directory, '.gitignore'))
+                if rules:
+                    ignores = ignores + [rules]
+            try:
+                entries = sorted(os.scandir(directory), key=lambda e: e.name)
+            except OSError:
+                continue
+            if on_directory is not None:
+                on_directory(directory)
+            subdirectories = []
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    continue
+                if is_dir:
+                    if entry.name in ALWAYS_EXCLUDED or (max_depth is not None and depth >= max_depth):
+                        continue
+                    if not self._is_excluded(entry.path, True, ignores):
+                        subdirectories.append(entry.path)
+                    continue
+                _, ext = os.path.splitext(entry.name)
+                if self._extensions is not None and ext[1:] not in self._extensions:
+                    continue
+                if matcher.match(entry.path) and not self._is_excluded(entry.path, False, ignores):
+                    yield entry.path
+            for subdirectory in sorted(subdirectories, reverse=True):
+                stack.append((subdirectory, depth + 1, ignores))
+
+
+def find_files(patterns: list, excludes: list = None, use_gitignore: bool = True) -> list:
+    return FileFinder(excludes, use_gitignore).find(patterns)
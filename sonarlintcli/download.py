@@ -0,0 +1,223 @@
+import concurrent.futures
+import hashlib
+import json
+import os
+import shutil
+import sys
+import urllib.error
+import urllib.request
+
+CHUNK_SIZE = 1024 * 1024
+# environment variable with the default for --mirror so every command that needs the jars can use it
+MIRROR_ENV = "SONARLINT_CLI_MIRROR"
+
+
+class DownloadError(RuntimeError):
+    pass
+
+
+def is_url(location: str) -> bool:
+    return "://" in location
+
+
+def sha1_file(path: str) -> str:
+    digest = hashlib.sha1()
+    with open(path, "rb") as handle:
+        for chunk in iter(lambda: handle.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_source(url: str, mirror: str = None) -> str:
+    """
+    Location to download a jar from. A mirror is a directory or base URL that contains all jars (and their .sha1 files)
+    by the file names of their original URLs, like a flat copy of the Maven repository.
+
+    :param url: original download URL
+    :param mirror:
+    :return:
+    """
+    if mirror is None:
+        return url
+    name = os.path.basename(url)
+    if is_url(mirror):
+        return mirror.rstrip("/") + "/" + name
+    return os.path.join(mirror, name)
+
+
+def read_checksum(source: str):
+    """
+    Read the SHA-1 published next to a jar (<jar>.sha1 like in Maven repositories)
+    Raises DownloadError if the checksum file cannot be fetched for any other reason than that it does not exist.
+
+    :param source:
+    :return: hex digest or None if there is no checksum file
+    """
+    try:
+        if is_url(source):
+            with urllib.request.urlopen(source + ".sha1", timeout=60) as response:
+                content = response.read().decode("ascii", errors="replace")
+        else:
+            with open(source + ".sha1", "r") as handle:
+                content = handle.read()
+    except urllib.error.HTTPError as e:
+        if e.code in (404, 410):
+            return None
+        raise DownloadError("Could not fetch %s.sha1: %s" % (source, e))
+    except urllib.error.URLError as e:
+        raise DownloadError("Could not reach %s.sha1: %s" % (source, e.reason))
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        raise DownloadError("Could not read %s.sha1: %s" % (source, e))
+    # the file may contain "<digest>  <file name>"
+    parts = content.split()
+    return parts[0].lower() if len(parts) > 0 else None
+
+
+def fetch(source: str, part: str):
+    """
+    Download source into part. A part left over by an interrupted download is resumed with a range request.
+
+    :param source:
+    :param part:
+    :return:
+    """
+    if not is_url(source):
+        shutil.copyfile(source, part)
+        return
+    offset = os.path.getsize(part) if os.path.isfile(part) else 0
+    request = urllib.request.Request(source, headers={"Range": "bytes=%d-" % offset} if offset > 0 else {})
+    try:
+        response = urllib.request.urlopen(request, timeout=60)
+    except urllib.error.HTTPError as e:
+        if e.code == 416 and offset > 0:
+            # nothing left to fetch, the checksum will tell whether the part is complete
+            return
+        raise DownloadError("Could not download %s: %s" % (source, e))
+    except urllib.error.URLError as e:
+        raise DownloadError("Could not download %s: %s" % (source, e.reason))
+    with response:
+        # servers that ignore the range send the whole file again
+        mode = "ab" if response.status == 206 else "wb"
+        with open(part, mode) as handle:
+            shutil.copyfileobj(response, handle, CHUNK_SIZE)
+
+
+def download(url: str, destination: str, mirror: str = None) -> dict:
+    """
+    Download a jar, verify it against its published SHA-1 and move it into place atomically
+    Until it has been verified the jar only exists as <destination>.part so an interrupted download never looks
+    complete. A jar that is already at the destination (e.g. from a version without the manifest) is kept if it
+    matches the checksum.
+
+    :param url: original download URL
+    :param destination:
+    :param mirror: see get_source
+    :return: manifest entry of the jar
+    """
+    source = get_source(url, mirror)
+    try:
+        checksum = read_checksum(source)
+    except DownloadError as e:
+        if os.path.isfile(destination):
+            raise DownloadError("%s is not in the manifest and cannot be verified. %s" % (destination, e))
+        raise
+    if checksum is None and is_url(source):
+        raise DownloadError("No checksum published for %s" % source)
+    if checksum is not None and os.path.isfile(destination) and sha1_file(destination) == checksum:
+        return {"url": url, "sha1": checksum, "size": os.path.getsize(destination)}
+    print("Downloading %s..." % os.path.basename(destination), file=sys.stderr)
+    part = destination + ".part"
+    fetch(source, part)
+    actual = sha1_file(part)
+    if checksum is not None and actual != checksum:
+        os.remove(part)
+        raise DownloadError("Checksum mismatch for %s: expected %s, got %s" % (source, checksum, actual))
+    os.replace(part, destination)
+    return {"url": url, "sha1": actual, "size": os.path.getsize(destination)}
+
+
+class Manifest:
+    """
+    Record of all verified jars for one analyzer fingerprint
+    As long as the manifest matches, the jars are trusted without touching them, so a run only has to read one file.
+    """
+
+    def __init__(self, path: str, fingerprint: str):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.files = {}
+
+    def load(self):
+        try:
+            with open(self.path, "r") as handle:
+                data = json.load(handle)
+        except (OSError, ValueError):
+            return self
+        if data.get("fingerprint") == self.fingerprint:
+            self.files = data.get("files", {})
+        return self
+
+    def save(self):
+        temporary = "%s.%d.tmp" % (self.path, os.getpid())
+        with open(temporary, "w") as handle:
+            json.dump({"fingerprint": self.fingerprint, "files": self.files}, handle, indent=2, sort_keys=True)
+        os.replace(temporary, self.path)
+
+    def is_intact(self, destination: str, url: str, verify: bool = False) -> bool:
+        """
+        Check if a jar has been downloaded and verified before
+
+        :param destination:
+        :param url:
+        :param verify: hash the jar again instead of only checking its size
+        :return:
+        """
+        entry = self.files.get(destination)
+        if entry is None or entry.get("url") != url:
+            return False
+        try:
+            if os.path.getsize(destination) != entry["size"]:
+                return False
+            return not verify or sha1_file(destination) == entry["sha1"]
+        except OSError:
+            return False
+
+
+def ensure_downloads(jars: dict, manifest_path: str, fingerprint: str, mirror: str = None, verify: bool = False,
+                     workers: int = 8) -> list:
+    """
+    Make sure all jars are downloaded and verified. Missing or broken jars are downloaded in parallel.
+
+    :param jars: original download URL by destination path
+    :param manifest_path:
+    :param fingerprint: identifies the set of jars (see sonarlint.analyzer_fingerprint)
+    :param mirror: see get_source
+    :param verify: check every jar on disk instead of trusting a matching manifest
+    :param workers: number of parallel downloads
+    :return: destinations of all jars that have been downloaded
+    """
+    manifest = Manifest(manifest_path, fingerprint).load()
+    if not verify and all(manifest.files.get(destination, {}).get("url") == url for destination, url in jars.items()):
+        return []
+    missing = {
+        destination: url for destination, url in jars.items() if not manifest.is_intact(destination, url, verify)
+    }
+    if len(missing) == 0:
+        return []
+    errors = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {
+            executor.submit(download, url, destination, mirror): destination for destination, url in missing.items()
+        }
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                manifest.files[futures[future]] = future.result()
+            except (OSError, DownloadError) as e:
+                errors.append(str(e))
+    # keep what has been verified even if other downloads failed
+    manifest.save()
+    if len(errors) > 0:
+        raise DownloadError("\n".join(errors))
+    return list(missing.keys())
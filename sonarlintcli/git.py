@@ -0,0 +1,43 @@
+import os
+import subprocess
+
+
+def run_git(args: list, cwd: str = None) -> str:
+    try:
+        completed = subprocess.run(
+            ["git"] + args,
+            cwd=cwd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            check=True
+        )
+    except FileNotFoundError:
+        raise RuntimeError("git is not installed")
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError("git %s failed: %s" % (" ".join(args), e.stderr.decode('utf-8', 'replace').strip()))
+    return completed.stdout.decode('utf-8', 'surrogateescape')
+
+
+def repository_root(cwd: str = None) -> str:
+    return run_git(["rev-parse", "--show-toplevel"], cwd).strip()
+
+
+def changed_files(since: str = None, staged: bool = False, cwd: str = None) -> list:
+    """
+    List the absolute paths of all added, copied, modified or renamed files in the repository of cwd
+    With since the working tree is compared to the merge base of since and HEAD, so all committed and uncommitted
+    changes of a branch are included. With staged only the changes in the index are listed.
+
+    :param since: a git revision like origin/master
+    :param staged:
+    :param cwd:
+    :return:
+    """
+    root = repository_root(cwd)
+    args = ["diff", "--name-only", "-z", "--diff-filter=ACMR"]
+    if staged:
+        args.append("--cached")
+    if since is not None:
+        args.append(run_git(["merge-base", since, "HEAD"], root).strip())
+    files = run_git(args, root).split("\0")
+    return [os.path.join(root, file) for file in files if file != '' and os.path.isfile(os.path.join(root, file))]
@@ -0,0 +1,89 @@
+import hashlib
+import os
+import re
+import shlex
+import subprocess
+
+# JDK 13 introduced dynamic AppCDS archives (-XX:ArchiveClassesAtExit)
+MIN_CDS_VERSION = 13
+# warnings (e.g. about an archive that does not match the JDK) must not end up on stdout, it may be the LSP channel
+LOG_OPTIONS = ["-Xlog:disable", "-Xlog:all=warning:stderr"]
+
+
+def read_options_file(path: str) -> list:
+    """
+    Read JVM options from a file like Elasticsearch's jvm.options: options are separated by whitespace or lines and
+    everything after a # is a comment
+
+    :param path:
+    :return: the options or an empty list if the file does not exist
+    """
+    try:
+        with open(path, "r") as handle:
+            lines = handle.read().splitlines()
+    except FileNotFoundError:
+        return []
+    return [option for line in lines for option in shlex.split(line, comments=True)]
+
+
+def java_version(java_bin: str):
+    """
+    Feature version of a JDK (8 for 1.8.0_292, 17 for 17.0.2)
+
+    :param java_bin:
+    :return: the version or None if it cannot be determined
+    """
+    try:
+        output = subprocess.run([java_bin, "-version"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                timeout=60).stdout.decode("utf-8", errors="replace")
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    match = re.search(r'version "(\d+)(?:\.(\d+))?', output)
+    if match is None:
+        return None
+    major = int(match.group(1))
+    if major == 1 and match.group(2) is not None:
+        return int(match.group(2))
+    return major
+
+
+def cds_archive_path(directory: str, java_bin: str, ls_jar: str, fingerprint: str) -> str:
+    """
+    Location of the class data sharing archive for a JDK and a set of jars
+    The archive only works with the exact JDK it has been created with, so the path includes the resolved java binary
+    and its modification time to ignore archives of a JDK that has been updated in place.
+
+    :param directory:
+    :param java_bin:
+    :param ls_jar:
+    :param fingerprint: analyzer fingerprint (see sonarlint.analyzer_fingerprint)
+    :return:
+    """
+    resolved = os.path.realpath(java_bin)
+    try:
+        modified = os.stat(resolved).st_mtime_ns
+    except OSError:
+        modified = 0
+    digest = hashlib.sha1(("%s\0%s\0%s\0%s" % (resolved, modified, ls_jar, fingerprint)).encode()).hexdigest()
+    return os.path.join(directory, "sonarlint-ls-%s.jsa" % digest[:16])
+
+
+def cds_options(archive: str) -> list:
+    """
+    Options to start the JVM with a class data sharing archive. The JVM falls back to loading all classes itself if
+    the archive does not match.
+
+    :param archive:
+    :return:
+    """
+    return ["-XX:SharedArchiveFile=%s" % archive, "-Xshare:auto"] + LOG_OPTIONS
+
+
+def cds_dump_options(archive: str) -> list:
+    """
+    Options to write all classes that have been loaded into an archive once the JVM exits
+
+    :param archive:
+    :return:
+    """
+    return ["-XX:ArchiveClassesAtExit=%s" % archive] + LOG_OPTIONS
@@ -1,12 +1,11 @@
+import asyncio
+import collections
 import json
 import os
-import socketserver
 import socket
-import select
-import threading
-import time
-import errno
-from threading import Thread
+import sys
+
+from sonarlintcli import stats
 
 
 class LANGUAGES:
@@ -177,6 +176,9 @@ class JsonRPCMessage:
     def __str__(self):
         return json.dumps(self.json(), separators=(',', ':'))
 
+    def encode(self) -> bytes:
+        return json.dumps(self.json(), separators=(',', ':')).encode("utf-8")
+
 
 class LanguageServerNotification(JsonRPCMessage):
     def __init__(self, method: str, params: any = None):
@@ -192,9 +194,16 @@ class LanguageServerNotification(JsonRPCMessage):
         return the_json
 
     def __str__(self):
-        body = super().__str__()
-        header = "Content-Length: %s\r\n" % len(body.encode("utf-8"))
-        return "%s\r\n%s" % (header, body)
+        return self.encode().decode("utf-8")
+
+    def encode(self) -> bytes:
+        """
+        Frame the message with its header. The body is serialized and encoded exactly once.
+
+        :return:
+        """
+        body = super().encode()
+        return b"Content-Length: %d\r\n\r\n%s" % (len(body), body)
 
 
 class LanguageServerRequest(LanguageServerNotification):
@@ -211,93 +220,309 @@ class LanguageServerRequest(LanguageServerNotification):
         return the_json
 
 
+class ReceiveBuffer:
+    """
+    A growable receive buffer for framed JSON-RPC messages that tracks a read and a write offset instead of slicing
+    consumed bytes off the front. Data is written in-place (e.g. via socket.recv_into) and consumed messages only move
+    the read offset. The unread rest is compacted to the front occasionally when the buffer runs out of free space.
+    """
+
+    def __init__(self, size: int = 1024 * 64):
+        self._data = bytearray(size)
+        self._start = 0
+        self._end = 0
+        self._body_size = -1
+
+    def __len__(self):
+        return self._end - self._start
+
+    @property
+    def capacity(self):
+        return len(self._data)
+
+    def writable(self, min_size: int = 4096) -> memoryview:
+        """
+        Return a view on the free space at the end of the buffer with at least min_size bytes
+        The caller has to call commit() with the number of bytes that have actually been written to the view.
+
+        :param min_size:
+        :return:
+        """
+        self.reserve(min_size)
+        return memoryview(self._data)[self._end:]
+
+    def commit(self, size: int):
+        self._end += size
+
+    def extend(self, data: bytes):
+        self.reserve(len(data))
+        self._data[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def reserve(self, size: int):
+        """
+        Make sure there are at least size bytes of free space behind the write offset
+        Unread data is moved to the front first and the buffer will only grow if that is still not enough.
+
+        :param size:
+        :return:
+        """
+        if len(self._data) - self._end >= size:
+            return
+        unread = self._end - self._start
+        if len(self._data) - unread >= size:
+            self._data[:unread] = self._data[self._start:self._end]
+        else:
+            capacity = len(self._data)
+            while capacity - unread < size:
+                capacity *= 2
+            # allocate a new buffer instead of resizing because views on the old one may still be alive
+            data = bytearray(capacity)
+            data[:unread] = self._data[self._start:self._end]
+            self._data = data
+        self._start = 0
+        self._end = unread
+
+    def next_message(self):
+        """
+        Try to frame the next JSON-RPC message from the buffer. If the header has already arrived but not the body
+        the header will be parsed and remembered until the buffer contains enough bytes for the body.
+        Returns a memoryview on the message body or None if no complete message is available. The view is only valid
+        until the buffer is written to again.
+
+        :return:
+        """
+        # Parse a new header if we are not waiting for a body to arrive fully
+        if self._body_size == -1:
+            # look for \r\n\r\n in buffer
+            header_end = self._data.find(b"\r\n\r\n", self._start, self._end)
+            if header_end == -1:
+                return None
+            header = str(memoryview(self._data)[self._start:header_end], 'utf-8')
+            self._start = header_end + 4
+            header_dict = parse_header_into_dict(header)
+            if 'Content-Length' not in header_dict:
+                print("Invalid LanguageServer message: no Content-Length header", file=sys.stderr)
+                return None
+            self._body_size = int(header_dict['Content-Length'])
+            # make room for the whole body right away so it can be received without another compaction
+            if self._start + self._body_size > len(self._data):
+                self.reserve(self._body_size - (self._end - self._start))
+
+        # check if we have enough data for our body
+        if self._end - self._start < self._body_size:
+            return None
+
+        body = memoryview(self._data)[self._start:self._start + self._body_size]
+        self._start += self._body_size
+        self._body_size = -1
+        if self._start == self._end:
+            # buffer has been read completely so we can start from the front again for free
+            self._start = self._end = 0
+        return body
+
+
 def parse_header_into_dict(header: str) -> dict:
     lines = header.strip("\r\n").split("\r\n")
     ret = {}
     for line in lines:
         if ":" not in line:
-            print("Invalid header-line '%s'..." % line)
+            print("Invalid header-line '%s'..." % line, file=sys.stderr)
             continue
         key, val = line.split(":", 1)
         ret[key.rstrip(" ")] = val.lstrip(" ")
     return ret
 
 
+class JsonRPCProtocol(asyncio.BufferedProtocol):
+    """
+    asyncio protocol for a single connection to a language server
+    Incoming data is received directly into the ReceiveBuffer of the server which frames and publishes each message
+    as soon as it is complete.
+    """
+
+    def __init__(self, server):
+        self._server = server
+        self._rejected = False
+
+    def connection_made(self, transport):
+        if not self._server.connection_made(transport):
+            self._rejected = True
+            transport.close()
+
+    def get_buffer(self, sizehint):
+        if self._rejected:
+            return bytearray(1)
+        return self._server.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        if not self._rejected:
+            self._server.buffer_updated(nbytes)
+
+    def connection_lost(self, exc):
+        if not self._rejected:
+            self._server.connection_lost(exc)
+
+    def pause_writing(self):
+        if not self._rejected:
+            self._server.pause_writing()
+
+    def resume_writing(self):
+        if not self._rejected:
+            self._server.resume_writing()
+
+
+class WritePipeProtocol(asyncio.Protocol):
+    """
+    Protocol of the write-only pipe to a language server that only reports flow control to the server
+    """
+
+    def __init__(self, server):
+        self._server = server
+
+    def pause_writing(self):
+        self._server.pause_writing()
+
+    def resume_writing(self):
+        self._server.resume_writing()
+
+
 class BaseServer:
     """
-    A basic language server that has a single socket connection to a language server and can receive and send JSON-RPC
+    A basic language server that has a single connection to a language server and can receive and send JSON-RPC
     messages
+    Outgoing messages are queued and written together with one writelines call per event loop iteration, so opening
+    hundreds of documents costs a handful of syscalls. Once more than WRITE_HIGH_WATER bytes wait for the language
+    server, writing_paused is set until it has caught up (see drain).
+    All methods have to be called from the event loop the connection has been made on.
     """
+    WRITE_HIGH_WATER = 1024 * 1024 * 4
+    WRITE_LOW_WATER = 1024 * 1024
 
     def __init__(self, on_msg: callable = None, on_connection: callable = None):
         self._response_queue = {}
         self._event_listeners = {}
         self._on_connection = on_connection
         self._on_msg = on_msg
-        self._stop = threading.Event()
-        self._connection: socket.socket = None
-        self._poll_interval = .5
-        self._last_select = None
-        self._buffer = bytearray()
-        self._buffer_max_size = 1024 * 1024 * 5 # 5MiB
-        self._body_size = -1
-        self._buffer_has_data = threading.Event()
-        self._send_queue = []
-        self._send_queue_access = threading.Lock()
-        self._send_queue_has_data = threading.Event()
+        self._transport: asyncio.Transport = None
+        self._connected: asyncio.Future = None
+        self._buffer = ReceiveBuffer()
+        self._recv_size = 1024 * 64
+        # method and start time of requests that are waiting for a response (only while stats are recorded)
+        self._request_starts = {}
+        # framed messages that have not been handed to the transport, yet
+        self._send_queue = collections.deque()
+        self._send_queue_size = 0
+        self._flush_handle: asyncio.Handle = None
+        self._writing_paused = False
+        self._drained: asyncio.Future = None
 
     @property
-    def socket(self):
-        if self._connection is None:
+    def transport(self):
+        if self._transport is None:
             raise RuntimeError("No connection has been established, yet")
-        return self._connection
+        return self._transport
+
+    def _connected_future(self) -> asyncio.Future:
+        if self._connected is None:
+            self._connected = asyncio.get_event_loop().create_future()
+        return self._connected
 
-    def handle_socket(self, socket, addr, _):
+    async def wait_for_connection(self):
         """
-        Handle an established connection to a language server
-        If more than one connection has been made the connection will be closed
+        Wait until a language server has connected
 
-        :param socket: The socket to the language server
-        :param addr: The remote address of the language server
-        :param _:
         :return:
         """
-        sock: socket.socket = socket
-        ip, port = addr
+        await self._connected_future()
+
+    def connection_made(self, transport) -> bool:
+        """
+        Handle an established connection to a language server
+        If more than one connection has been made the connection will be rejected
 
-        if self._connection is not None:
-            print("More than one connection to client. Dropping connection...")
+        :param transport: The transport to the language server
+        :return: False if the connection has been rejected
+        """
+        if self._transport is not None:
+            print("More than one connection to client. Dropping connection...", file=sys.stderr)
             # do not allow more than one connection
-            sock.close()
-            return
+            return False
+
+        self._transport = transport
+        transport.set_write_buffer_limits(high=self.WRITE_HIGH_WATER, low=self.WRITE_LOW_WATER)
+        connected = self._connected_future()
+        if not connected.done():
+            connected.set_result(True)
+        if self._on_connection is not None:
+            self._on_connection(self, transport)
+        return True
+
+    def connection_lost(self, exc):
+        """
+        Fail all requests that are still waiting for a response once the connection is gone
 
-        self._connection = sock
-        sock.setblocking(False)
-        # Run the wait poll in a separate thread to be really non-blocking
-        listen_thread = Thread(target=self._wait_for_data)
-        listen_thread.start()
-        self._on_connection(self, sock)
-        while not self._stop.isSet():
-            self._buffer_has_data.wait(self._poll_interval)
-            while self._read_json_rpc_msg():
-                pass
-            self._buffer_has_data.clear()
+        :param exc:
+        :return:
+        """
+        connected = self._connected_future()
+        if not connected.done():
+            connected.set_exception(ConnectionError("Connection to language server lost"))
+        for future in self._response_queue.values():
+            if not future.done():
+                future.set_exception(ConnectionError("Connection to language server lost"))
+        self._response_queue.clear()
+        self._request_starts.clear()
+        self._send_queue.clear()
+        self._send_queue_size = 0
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        # nothing will be written anymore so nobody has to wait
+        self.resume_writing()
+
+    def get_buffer(self, sizehint):
+        return self._buffer.writable(max(sizehint, self._recv_size))
+
+    @property
+    def pending_requests(self) -> int:
+        return len(self._response_queue)
+
+    def buffer_updated(self, nbytes):
+        if stats.recorder is not None:
+            stats.recorder.bytes_received += nbytes
+        self._buffer.commit(nbytes)
+        while self._read_json_rpc_msg():
+            pass
 
-    def send_request(self, method, params, cb):
+    def send_request(self, method, params) -> asyncio.Future:
         """
         Send a RPC request and expect a response
-        The callback cb will be called with the response once it arrives
+        The returned future will be resolved with the result once the response arrives
 
         :param method:
         :param params:
-        :param cb:
         :return:
         """
         rpc = LanguageServerRequest(method, params)
-        self._response_queue[rpc.id] = cb
-        with self._send_queue_access:
-            self._send_queue.append(str(rpc).encode())
-        self._send_queue_has_data.set()
+        future = asyncio.get_event_loop().create_future()
+        if self.transport.is_closing():
+            future.set_exception(ConnectionError("Connection to language server lost"))
+            return future
+        self._response_queue[rpc.id] = future
+        # a request that has timed out or been cancelled will not be waited for anymore
+        future.add_done_callback(lambda done, request_id=rpc.id: self._forget_request(request_id, done))
+        data = rpc.encode()
+        if stats.recorder is not None:
+            stats.recorder.sent(method, len(data))
+            self._request_starts[rpc.id] = (method, stats.recorder.now())
+        self._write(data)
+        return future
+
+    def _forget_request(self, request_id, future: asyncio.Future):
+        if future.cancelled():
+            self._response_queue.pop(request_id, None)
+            self._request_starts.pop(request_id, None)
 
     def send_notification(self, method, params):
         """
@@ -307,117 +532,122 @@ class BaseServer:
         :param params:
         :return:
         """
+        if self.transport.is_closing():
+            # nobody is listening anymore, e.g. a didClose after the language server crashed
+            return
         rpc = LanguageServerNotification(method, params)
-        with self._send_queue_access:
-            self._send_queue.append(str(rpc).encode())
-        self._send_queue_has_data.set()
-
-    def _wait_for_data(self):
+        data = rpc.encode()
+        if stats.recorder is not None:
+            stats.recorder.sent(method, len(data))
+        self._write(data)
+
+    def _write(self, data: bytes):
+        self._send_queue.append(data)
+        self._send_queue_size += len(data)
+        if self._send_queue_size >= self.WRITE_HIGH_WATER:
+            # do not let the queue grow past the limit of the transport
+            self.flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_event_loop().call_soon(self.flush)
+
+    def flush(self):
         """
-        Runs in another thread (called by handle_socket) and waits for data on the socket connection
-        If there is data to receive it will be flushed into self._buffer and parsed by read_json_rpc_msg on the main thread
-        see _drain_socket and _read_json_rpc_msg
+        Hand all queued messages to the transport at once
 
         :return:
         """
-        sock = self._connection
-        while not self._stop.isSet() and sock.fileno() >= 0:
-            selected = select.select([sock], [sock], [], self._poll_interval)
-            now = time.time()
-            if self._last_select is not None:
-                if (self._last_select + 10 * self._poll_interval) <= now:
-                    print("Last select is more than 10x poll intervall ago, possible thread locking detected")
-            self._last_select = now
-            try:
-                if selected[0] and not self._buffer_has_data.isSet():
-                    # Reading the buffer is done on this thread but publishing the results will happen on the main
-                    # thread so we do not block the receiving thread
-                    self._drain_socket()
-                    self._buffer_has_data.set()
-                if selected[1] and self._send_queue_has_data.isSet():
-                    with self._send_queue_access:
-                        while len(self._send_queue) > 0:
-                            self._connection.sendall(self._send_queue.pop(0))
-                    self._send_queue_has_data.clear()
-            except IOError as e:
-                if e.errno == errno.EWOULDBLOCK:
-                    pass
-                else:
-                    raise e
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if len(self._send_queue) == 0:
+            return
+        data = list(self._send_queue)
+        self._send_queue.clear()
+        self._send_queue_size = 0
+        if not self.transport.is_closing():
+            self.transport.writelines(data)
+
+    @property
+    def writing_paused(self) -> bool:
+        return self._writing_paused
 
-    def _drain_socket(self):
+    def pause_writing(self):
+        self._writing_paused = True
+
+    def resume_writing(self):
+        self._writing_paused = False
+        if self._drained is not None:
+            if not self._drained.done():
+                self._drained.set_result(None)
+            self._drained = None
+
+    async def drain(self):
         """
-        Also runs on the receiving thread and simply reads all data from the socket into _buffer until buffer exceeds
-        max_buffer_size or connection holds no more data
+        Wait until the language server has read enough of the data written so far (see WRITE_HIGH_WATER)
 
         :return:
         """
-        size = 4096
-        while True:
-            data = self._connection.recv(size)
-            self._buffer.extend(data)
-            if len(data) < size or len(self._buffer) > self._buffer_max_size:
-                break
+        if not self._writing_paused:
+            return
+        if self._drained is None:
+            self._drained = asyncio.get_event_loop().create_future()
+        await self._drained
 
     def _read_json_rpc_msg(self):
         """
-        Try to read a JSON-RPC header and body from the buffer. If the header has already arrived but not the body
-        the function will parse the header and wait until the buffer contains enough bytes for the body.
-        This is all happening on the main thread! We dont want to block the receiving thread
+        Try to read a JSON-RPC message from the buffer and publish it. See ReceiveBuffer.next_message for framing.
 
         :return:
         """
-        # Parse a new header if we are not waiting for a body to arrive fully
-        if self._body_size == -1:
-            # look for \r\n\r\n in buffer
-            header_end = self._buffer.find(b"\r\n\r\n")
-            if header_end == -1:
-                return False
-            header = self._buffer[:header_end].decode('utf-8')
-            self._buffer = self._buffer[header_end + 4:]
-            header_dict = parse_header_into_dict(header)
-            if 'Content-Length' not in header_dict:
-                print("Invalid LanguageServer message: no Content-Length header")
-                return False
-            self._body_size = int(header_dict['Content-Length'])
-
-        # check if we have enough data for our body
-        if len(self._buffer) < self._body_size:
+        body = self._buffer.next_message()
+        if body is None:
             return False
-
-        # take the body from the buffer and publish the RPC message
-        body = self._buffer[:self._body_size]
-        self._buffer = self._buffer[self._body_size:]
-        self._body_size = -1
-        self.publish_rpc_msg(body)
+        with body:
+            self.publish_rpc_msg(body)
         return True
 
-    def publish_rpc_msg(self, body: bytes):
+    def publish_rpc_msg(self, body):
         """
         Check if we have anyone waiting for the given RPC message (if it is a response) or otherwise simply
 
-        :param body:
+        :param body: bytes-like object (bytes, bytearray or memoryview) containing the JSON body
         :return:
         """
-        json_msg = json.loads(body.decode('utf-8'))
-        if "id" in json_msg:
-            # check if we are waiting for this response and call the corresponsing callback function
+        recorder = stats.recorder
+        start = recorder.now() if recorder is not None else None
+        json_msg = json.loads(str(body, 'utf-8'))
+        if "id" in json_msg and "method" not in json_msg:
+            if recorder is not None and json_msg["id"] in self._request_starts:
+                method, sent = self._request_starts.pop(json_msg["id"])
+                recorder.received(method)
+                recorder.request_done(method, sent, self)
+            # check if we are waiting for this response and resolve the corresponding future
             if json_msg["id"] in self._response_queue:
-                cb = self._response_queue[json_msg["id"]]
-                del self._response_queue[json_msg["id"]]
-                cb(json_msg["result"])
+                future = self._response_queue.pop(json_msg["id"])
+                if future.done():
+                    pass
+                elif "error" in json_msg:
+                    future.set_exception(RuntimeError("RPC call #%s failed: %s" % (
+                        json_msg["id"], json_msg["error"].get("message")
+                    )))
+                else:
+                    future.set_result(json_msg.get("result"))
             else:
-                # this should never happen but who knows...
-                print("Got response for message #%s we never sent..." % json_msg["id"])
+                # a late answer to a request that has timed out or been cancelled
+                print("Got response for message #%s nobody is waiting for..." % json_msg["id"], file=sys.stderr)
         else:
             # event sent from the server
             # check if we have any event listeners for it and call them
+            if recorder is not None:
+                recorder.received(json_msg['method'])
             if json_msg['method'] in self._event_listeners:
                 for listener in self._event_listeners[json_msg['method']]:
-                    listener(json_msg['params'])
+                    listener(json_msg.get('params'))
         # call the generic listener last in all cases
         if self._on_msg is not None:
             self._on_msg(json_msg)
+        if recorder is not None:
+            recorder.span("handle %s" % json_msg.get("method", "response"), "dispatch", start, owner=self)
 
     def on(self, msg_type: str, cb: callable):
         """
@@ -432,6 +662,22 @@ class BaseServer:
         if cb not in self._event_listeners[msg_type]:
             self._event_listeners[msg_type].append(cb)
 
+    def off(self, msg_type: str, cb: callable):
+        """
+        Remove a listener that has been registered with on()
+
+        :param msg_type:
+        :param cb:
+        :return:
+        """
+        if cb in self._event_listeners.get(msg_type, []):
+            self._event_listeners[msg_type].remove(cb)
+
+    def close(self):
+        if self._transport is not None:
+            self.flush()
+            self._transport.close()
+
 
 class ReverseServer(BaseServer):
     """
@@ -441,27 +687,108 @@ class ReverseServer(BaseServer):
 
     def __init__(self, on_msg: callable = None, on_connection: callable = None, ip: str = "localhost"):
         super().__init__(on_msg, on_connection)
-        self.server = socketserver.TCPServer((ip, 0), self.handle_socket)
+        self._ip = ip
+        self.server: asyncio.AbstractServer = None
 
     @property
     def addr(self):
-        return self.server.server_address
+        return self.server.sockets[0].getsockname()
 
-    def start(self):
-        try:
-            self.server.serve_forever()
-        except KeyboardInterrupt:
-            pass
+    async def start(self):
+        loop = asyncio.get_event_loop()
+        self.server = await loop.create_server(lambda: JsonRPCProtocol(self), self._ip, 0, family=socket.AF_INET)
+
+    async def stop(self):
         if len(self._response_queue) > 0:
-            print("Warning: There are %s RPC calls without answer left in queue" % len(self._response_queue))
+            print("Warning: There are %s RPC calls without answer left in queue" % len(self._response_queue),
+                  file=sys.stderr)
+        self.close()
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
 
-    def stop(self):
-        self._stop.set()
-        self._stop.wait()
-        self.server.shutdown()
+    async def __aexit__(self, *args):
+        await self.stop()
 
-    def __enter__(self):
-        return self
 
-    def __exit__(self, *args):
-        self.stop()
+class StdioServer(BaseServer):
+    """
+    A connection to a language server over the stdin and stdout pipes of its process
+    The pipes are created before the process is spawned (see create_pipes) so no listening socket is needed. Whenever
+    the event loop reports the stdout pipe as readable its data is read straight into the receive buffer with os.readv.
+    """
+
+    def __init__(self, on_msg: callable = None, on_connection: callable = None):
+        super().__init__(on_msg, on_connection)
+        self._read_fd: int = None
+        self._write_fd: int = None
+        self._child_fds: tuple = None
+
+    def create_pipes(self) -> tuple:
+        """
+        Create the pipes for the language server process
+
+        :return: (stdin, stdout) file descriptors to pass to the process
+        """
+        stdin_read, self._write_fd = os.pipe()
+        self._read_fd, stdout_write = os.pipe()
+        self._child_fds = (stdin_read, stdout_write)
+        return self._child_fds
+
+    async def start(self):
+        """
+        Start talking to the language server once its process has been spawned with the pipes from create_pipes
+
+        :return:
+        """
+        for fd in self._child_fds:
+            # the child has its own copies now and we would never see EOF while holding them
+            os.close(fd)
+        self._child_fds = None
+        loop = asyncio.get_event_loop()
+        os.set_blocking(self._read_fd, False)
+        transport, _ = await loop.connect_write_pipe(
+            lambda: WritePipeProtocol(self), os.fdopen(self._write_fd, "wb", buffering=0)
+        )
+        loop.add_reader(self._read_fd, self._read_ready)
+        self.connection_made(transport)
+
+    def _read_ready(self):
+        try:
+            nbytes = os.readv(self._read_fd, [self.get_buffer(-1)])
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self._close_reader(e)
+            return
+        if nbytes == 0:
+            # the language server closed its stdout, most likely because it exited
+            self._close_reader(None)
+            return
+        self.buffer_updated(nbytes)
+
+    def _close_reader(self, exc):
+        if self._read_fd is None:
+            return
+        asyncio.get_event_loop().remove_reader(self._read_fd)
+        os.close(self._read_fd)
+        self._read_fd = None
+        self.close()
+        self.connection_lost(exc)
+
+    async def stop(self):
+        if len(self._response_queue) > 0:
+            print("Warning: There are %s RPC calls without answer left in queue" % len(self._response_queue),
+                  file=sys.stderr)
+        if self._child_fds is not None:
+            # never started
+            for fd in self._child_fds + (self._read_fd, self._write_fd):
+                os.close(fd)
+            self._child_fds = None
+            self._read_fd = None
+            return
+        self._close_reader(None)
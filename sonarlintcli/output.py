@@ -0,0 +1,171 @@
+import collections
+import json
+
+from sonarlintcli import source
+from sonarlintcli.languageserver import unurify
+
+SARIF_SCHEMA = "https://raw.githubusercontent.com/oasis-tcs/sarif-spec/master/Schemata/sarif-schema-2.1.0.json"
+
+# LSP DiagnosticSeverity to SARIF result level
+SARIF_LEVELS = {
+    1: "error",
+    2: "warning",
+    3: "note",
+    4: "note"
+}
+
+
+def dump_compact(data) -> str:
+    return json.dumps(data, separators=(',', ':'))
+
+
+class JsonWriter:
+    """
+    Collects all results and writes them as one indented JSON array once the analysis is finished
+    """
+
+    def __init__(self, handle):
+        self._handle = handle
+        self._results = []
+
+    def write(self, result: dict):
+        self._results.append(result)
+
+    def close(self):
+        self._handle.write(json.dumps(self._results, indent=4))
+        self._handle.flush()
+
+
+class NdjsonWriter:
+    """
+    Writes one compact JSON record per file as soon as its result is available
+    """
+
+    def __init__(self, handle):
+        self._handle = handle
+
+    def write(self, result: dict):
+        self._handle.write(dump_compact(result))
+        self._handle.write("\n")
+
+    def close(self):
+        self._handle.flush()
+
+
+class SarifWriter:
+    """
+    Writes a SARIF 2.1.0 log with a single run. Results are written as soon as they are available and only the rule
+    descriptions are kept until the end, because they belong to the tool section that follows the results.
+    Results compared with a baseline mark their issues as new and list the fixed ones as absent.
+    """
+
+    def __init__(self, handle):
+        self._handle = handle
+        self._rules = {}
+        self._first = True
+        self._handle.write('{"version":"2.1.0","$schema":%s,"runs":[{"results":[' % dump_compact(SARIF_SCHEMA))
+
+    def write(self, result: dict):
+        for code, rule in result["rules"].items():
+            if code not in self._rules:
+                self._rules[code] = {
+                    "id": code,
+                    "shortDescription": {"text": rule["description"]},
+                    "help": {"text": rule["description"], "markdown": rule["html"]},
+                    "properties": {"type": rule["type"], "severity": rule["severity"]}
+                }
+        for diagnostic in result["diagnostics"]:
+            start = diagnostic["range"]["start"]
+            end = diagnostic["range"]["end"]
+            sarif_result = {
+                "ruleId": diagnostic.get("code"),
+                "level": SARIF_LEVELS.get(diagnostic.get("severity"), "warning"),
+                "message": {"text": diagnostic.get("message", "")},
+                "locations": [{
+                    "physicalLocation": {
+                        "artifactLocation": {"uri": result["uri"]},
+                        "region": {
+                            "startLine": start["line"] + 1,
+                            "startColumn": start["character"] + 1,
+                            "endLine": end["line"] + 1,
+                            "endColumn": end["character"] + 1
+                        }
+                    }
+                }]
+            }
+            if "fixed" in result:
+                sarif_result["baselineState"] = "new"
+            self._write_result(sarif_result)
+        for issue in result.get("fixed", []):
+            self._write_result({
+                "ruleId": issue["code"],
+                "message": {"text": "Fixed"},
+                "baselineState": "absent",
+                "locations": [{
+                    "physicalLocation": {
+                        "artifactLocation": {"uri": result["uri"]},
+                        "region": {"startLine": issue["line"] + 1}
+                    }
+                }]
+            })
+
+    def _write_result(self, sarif_result: dict):
+        if not self._first:
+            self._handle.write(",")
+        self._first = False
+        self._handle.write(dump_compact(sarif_result))
+
+    def close(self):
+        self._handle.write('],"tool":{"driver":{"name":"SonarLint","informationUri":"https://www.sonarlint.org",')
+        self._handle.write('"rules":%s}}}]}' % dump_compact(list(self._rules.values())))
+        self._handle.flush()
+
+
+class BaselineWriter:
+    """
+    Compares every result with a baseline (see baseline.Baseline.compare) before passing it on to another writer
+    The files whose issues have to be matched are read on the source thread pool, so the event loop never waits for the
+    disk. Results are passed on in order as soon as their file has been read.
+    """
+
+    def __init__(self, writer, baseline):
+        self._writer = writer
+        self._baseline = baseline
+        # (result, future of the text of its file or None) that have not been passed on, yet
+        self._pending = collections.deque()
+
+    def write(self, result: dict):
+        text = None
+        if self._baseline.needs_text(result):
+            text = source.executor().submit(source.read, unurify(result["uri"]))
+        self._pending.append((result, text))
+        self._flush(wait=False)
+
+    def _flush(self, wait: bool):
+        while len(self._pending) > 0:
+            result, text = self._pending[0]
+            if text is not None and not wait and not text.done():
+                break
+            self._pending.popleft()
+            if text is not None:
+                try:
+                    text = text.result()
+                except OSError:
+                    # deleted in the meantime, all its issues are new
+                    text = ""
+            self._writer.write(self._baseline.compare(result, text))
+
+    def close(self):
+        self._flush(wait=True)
+        self._writer.close()
+
+
+WRITERS = {
+    "json": JsonWriter,
+    "ndjson": NdjsonWriter,
+    "sarif": SarifWriter
+}
+
+
+def create_writer(output_format: str, handle):
+    return WRITERS[output_format](handle)
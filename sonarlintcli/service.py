@@ -0,0 +1,330 @@
+import asyncio
+import collections
+import json
+import os
+import time
+
+from sonarlintcli.session import AsyncSonarLintSession
+
+# largest request body that is accepted
+MAX_BODY_SIZE = 1024 * 1024 * 64
+REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 405: "Method Not Allowed",
+           413: "Payload Too Large", 415: "Unsupported Media Type", 500: "Internal Server Error",
+           503: "Service Unavailable"}
+# names the service may be addressed by besides the address it listens on. Anything else in the Host header is most
+# likely a DNS rebinding attack from a web page.
+LOCAL_HOSTS = ["localhost", "127.0.0.1", "[::1]"]
+# addresses that do not name a host on their own
+WILDCARD_HOSTS = ["", "0.0.0.0", "::"]
+
+
+class HttpError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class FairQueue:
+    """
+    Bounded queue with one FIFO per client that hands out items round-robin over the clients
+    A client that sends a huge number of requests only delays its own requests, not everyone else's.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._queues = collections.OrderedDict()
+        self._size = 0
+        self._available: asyncio.Condition = None
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def clients(self) -> int:
+        return len(self._queues)
+
+    def _condition(self) -> asyncio.Condition:
+        if self._available is None:
+            self._available = asyncio.Condition()
+        return self._available
+
+    async def put(self, client: str, item):
+        """
+        Queue an item for a client. Raises HttpError(503) if the queue is full.
+
+        :param client:
+        :param item:
+        :return:
+        """
+        if self._size >= self.max_size:
+            raise HttpError(503, "Too many queued requests")
+        self._queues.setdefault(client, collections.deque()).append(item)
+        self._size += 1
+        async with self._condition():
+            self._condition().notify()
+
+    async def get(self):
+        """
+        Wait for the next item, taking turns between the clients
+
+        :return:
+        """
+        async with self._condition():
+            await self._condition().wait_for(lambda: self._size > 0)
+        client, queue = next(iter(self._queues.items()))
+        item = queue.popleft()
+        self._size -= 1
+        if len(queue) == 0:
+            del self._queues[client]
+        else:
+            # the client goes to the back of the line
+            self._queues.move_to_end(client)
+        return item
+
+
+class AnalysisService:
+    """
+    HTTP service that analyses files and inline sources on a pool of warm language servers
+    Requests are queued per client (X-Client-Id header or the peer address) and every worker takes the next request
+    round-robin over the clients, so at most one request runs per worker.
+
+    POST /analyze {"files": ["/path/Main.java"], "sources": [{"name": "Snippet.py", "text": "..."}]}
+        -> {"results": [...]} with one result per file followed by one per source
+    GET /health -> {"status": "ok"|"degraded", ...}
+    GET /metrics -> queue depth, worker utilization and request counters in the Prometheus text format
+
+    Requests have to name the service by a local address in their Host header and analyses have to be sent as
+    application/json, so web pages can neither post to it nor read its answers.
+    """
+
+    def __init__(self, worker_factory: callable, workers: int = 2, max_queue: int = 1000, max_open: int = 64,
+                 file_timeout: float = None, rule_database=None, max_file_size: int = None):
+        self._sessions = [
+            AsyncSonarLintSession(worker_factory, max_open, file_timeout, max_file_size) for _ in range(max(1, workers))
+        ]
+        self._queue = FairQueue(max_queue)
+        self._rule_database = rule_database
+        self._started = time.time()
+        self._busy_since = [None] * len(self._sessions)
+        self._busy_time = [0.0] * len(self._sessions)
+        self._requests = collections.Counter()
+        self._files = 0
+        self._request_seconds = 0.0
+        self._stop: asyncio.Future = None
+        self._allowed_hosts = set()
+
+    async def run(self, host: str, port: int, on_ready: callable = None):
+        self._stop = asyncio.get_event_loop().create_future()
+        await asyncio.gather(*[session.start() for session in self._sessions])
+        server = await asyncio.start_server(self._handle_client, host, port, limit=MAX_BODY_SIZE)
+        self._allowed_hosts = allowed_hosts(host, server.sockets[0].getsockname()[1])
+        runners = [asyncio.ensure_future(self._work(i)) for i in range(len(self._sessions))]
+        if on_ready is not None:
+            on_ready(server.sockets[0].getsockname())
+        try:
+            await self._stop
+        finally:
+            server.close()
+            await server.wait_closed()
+            for runner in runners:
+                runner.cancel()
+            await asyncio.gather(*[session.stop() for session in self._sessions])
+            if self._rule_database is not None:
+                self._rule_database.save()
+
+    def stop(self):
+        if self._stop is not None and not self._stop.done():
+            self._stop.set_result(None)
+
+    async def _work(self, index: int):
+        session = self._sessions[index]
+        while True:
+            future, files, sources = await self._queue.get()
+            if future.done():
+                # the client is gone already
+                continue
+            self._busy_since[index] = time.time()
+            try:
+                results = await session.analyze_files(files) if len(files) > 0 else []
+                results.extend(await asyncio.gather(*[session.analyze_text(name, text) for name, text in sources]))
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(results)
+            finally:
+                self._busy_time[index] += time.time() - self._busy_since[index]
+                self._busy_since[index] = None
+                if self._rule_database is not None:
+                    self._rule_database.save()
+
+    async def analyze(self, client: str, request: dict) -> list:
+        files = request.get("files") or []
+        sources = request.get("sources") or []
+        if type(files) is not list or any(type(file) is not str for file in files):
+            raise HttpError(400, "files has to be a list of paths")
+        if type(sources) is not list or any(
+                type(source) is not dict or type(source.get("name")) is not str or type(source.get("text")) is not str
+                for source in sources):
+            raise HttpError(400, "sources has to be a list of {\"name\": ..., \"text\": ...}")
+        future = asyncio.get_event_loop().create_future()
+        await self._queue.put(client, (future, files, [(source["name"], source["text"]) for source in sources]))
+        try:
+            return await future
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+
+    def utilization(self) -> list:
+        """
+        Share of the uptime each worker has spent analysing
+
+        :return:
+        """
+        now = time.time()
+        uptime = max(now - self._started, 1e-9)
+        return [
+            (busy + (now - since if since is not None else 0.0)) / uptime
+            for busy, since in zip(self._busy_time, self._busy_since)
+        ]
+
+    def health(self) -> dict:
+        running = sum(1 for session in self._sessions if session.running)
+        return {
+            "status": "ok" if running == len(self._sessions) else "degraded",
+            "pid": os.getpid(),
+            "uptime": time.time() - self._started,
+            "workers": len(self._sessions),
+            "running": running,
+            "busy": sum(1 for since in self._busy_since if since is not None),
+            "queued": len(self._queue)
+        }
+
+    def metrics(self) -> str:
+        lines = [
+            "# TYPE sonarlint_queue_depth gauge",
+            "sonarlint_queue_depth %d" % len(self._queue),
+            "# TYPE sonarlint_queue_clients gauge",
+            "sonarlint_queue_clients %d" % self._queue.clients,
+            "# TYPE sonarlint_workers gauge",
+            "sonarlint_workers %d" % len(self._sessions),
+            "# TYPE sonarlint_workers_busy gauge",
+            "sonarlint_workers_busy %d" % sum(1 for since in self._busy_since if since is not None),
+            "# TYPE sonarlint_worker_utilization gauge"
+        ]
+        for index, utilization in enumerate(self.utilization()):
+            lines.append('sonarlint_worker_utilization{worker="%d"} %.6f' % (index, utilization))
+        lines.append("# TYPE sonarlint_requests_total counter")
+        for status in ("ok", "error", "rejected"):
+            lines.append('sonarlint_requests_total{status="%s"} %d' % (status, self._requests[status]))
+        lines.extend([
+            "# TYPE sonarlint_files_total counter",
+            "sonarlint_files_total %d" % self._files,
+            "# TYPE sonarlint_request_seconds_total counter",
+            "sonarlint_request_seconds_total %.6f" % self._request_seconds
+        ])
+        return "\n".join(lines) + "\n"
+
+    async def _route(self, client: str, method: str, path: str, headers: dict, body: bytes):
+        """
+        :return: status, content type and body of the response
+        """
+        if headers.get("host", "").lower() not in self._allowed_hosts:
+            raise HttpError(403, "Host %s is not allowed" % headers.get("host"))
+        if path == "/health":
+            health = self.health()
+            return 200 if health["status"] == "ok" else 503, "application/json", json.dumps(health)
+        if path == "/metrics":
+            return 200, "text/plain; version=0.0.4", self.metrics()
+        if path != "/analyze":
+            raise HttpError(404, "Unknown endpoint %s" % path)
+        if method != "POST":
+            raise HttpError(405, "Use POST to analyse")
+        if headers.get("content-type", "").split(";", 1)[0].strip().lower() != "application/json":
+            raise HttpError(415, "Send the request as application/json")
+        try:
+            request = json.loads(body.decode("utf-8"))
+        except ValueError:
+            raise HttpError(400, "Body is not valid JSON")
+        if type(request) is not dict:
+            raise HttpError(400, "Body has to be a JSON object")
+        start = time.time()
+        try:
+            results = await self.analyze(client, request)
+        except HttpError:
+            self._requests["rejected"] += 1
+            raise
+        except Exception:
+            self._requests["error"] += 1
+            raise
+        self._requests["ok"] += 1
+        self._files += len(results)
+        self._request_seconds += time.time() - start
+        return 200, "application/json", json.dumps({"results": results}, separators=(',', ':'))
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            status, content_type, body = await self._handle_request(reader, writer)
+        except HttpError as e:
+            status, content_type, body = e.status, "application/json", json.dumps({"error": str(e)})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            writer.close()
+            return
+        except Exception as e:
+            status, content_type, body = 500, "application/json", json.dumps({"error": str(e)})
+        data = body.encode("utf-8")
+        writer.write(("HTTP/1.1 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: close\r\n\r\n" % (
+            status, REASONS.get(status, ""), content_type, len(data)
+        )).encode("latin-1") + data)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _handle_request(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        request_line = (await reader.readline()).decode("latin-1").strip()
+        parts = request_line.split(" ")
+        if len(parts) != 3:
+            raise HttpError(400, "Malformed request line")
+        method, target, _ = parts
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if line == "":
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get("content-length", "0") or "0")
+        except ValueError:
+            raise HttpError(400, "Invalid Content-Length")
+        if length < 0:
+            raise HttpError(400, "Invalid Content-Length")
+        if length > MAX_BODY_SIZE:
+            raise HttpError(413, "Request body exceeds %d bytes" % MAX_BODY_SIZE)
+        body = await reader.readexactly(length) if length > 0 else b""
+        peer = writer.get_extra_info("peername")
+        client = headers.get("x-client-id") or (peer[0] if peer else "unknown")
+        return await self._route(client, method.upper(), target.split("?", 1)[0], headers, body)
+
+
+def allowed_hosts(host, port: int) -> set:
+    """
+    Values of the Host header that address the service
+
+    :param host: address (or addresses) the service listens on
+    :param port:
+    :return:
+    """
+    names = list(LOCAL_HOSTS)
+    for address in (host if isinstance(host, (list, tuple)) else [host]):
+        if address is not None and address not in WILDCARD_HOSTS:
+            names.append("[%s]" % address if ":" in address else address)
+    hosts = {"%s:%d" % (name.lower(), port) for name in names}
+    if port == 80:
+        # the default port may be left out
+        hosts.update(name.lower() for name in names)
+    return hosts
@@ -0,0 +1,175 @@
+import asyncio
+import itertools
+import os
+import threading
+
+from sonarlintcli import discovery
+from sonarlintcli.sonarlint import Analysis, LanguageServerExited
+
+# text snippets are analysed as documents below this directory. It does not have to exist.
+SNIPPET_ROOT = "/sonarlint-cli-snippets"
+
+
+class AsyncSonarLintSession:
+    """
+    A SonarLint language server that stays up for any number of analyses of files and text snippets
+    All requests share one window of max_open open documents, so thousands of them can be pipelined without waiting for
+    each other. If the language server exits, the unfinished requests fail with LanguageServerExited and the next
+    request starts a new one. Has to be used from a single event loop.
+
+        async with AsyncSonarLintSession(lambda: cli.create_worker("/usr/bin/java", "file:///code")) as session:
+            results = await session.analyze_files(["/code/Main.java"])
+            result = await session.analyze_text("Snippet.java", "class Snippet {}")
+    """
+
+    def __init__(self, worker_factory: callable, max_open: int = 64, file_timeout: float = None,
+                 max_file_size: int = None):
+        """
+        :param worker_factory: creates a SonarLintWorker that has not been started, yet (e.g. cli.create_worker)
+        :param max_open: maximum number of documents that are open on the language server at the same time
+        :param file_timeout: seconds after which a file without result is reported as timed out
+        :param max_file_size: files with more bytes are reported as skipped
+        """
+        self._worker_factory = worker_factory
+        self._max_open = max_open
+        self._file_timeout = file_timeout
+        self._max_file_size = max_file_size
+        self._worker = None
+        self._analysis: Analysis = None
+        self._supervisor: asyncio.Future = None
+        self._lock: asyncio.Lock = None
+        self._snippets = itertools.count(1)
+
+    @property
+    def running(self) -> bool:
+        return self._worker is not None and self._worker.running
+
+    async def start(self):
+        """
+        Start the language server unless it is running already. Called by all analyse methods.
+
+        :return:
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self.running:
+                return
+            await self._shutdown()
+            worker = self._worker_factory()
+            await worker.start()
+            analysis = Analysis(worker.server, worker.rule_resolver, max_open=self._max_open,
+                                file_timeout=self._file_timeout, max_file_size=self._max_file_size,
+                                closed_documents=worker.closed_documents)
+            analysis.start()
+            self._worker = worker
+            self._analysis = analysis
+            self._supervisor = asyncio.ensure_future(self._supervise(worker, analysis))
+
+    async def _supervise(self, worker, analysis: Analysis):
+        code = await worker.process.wait()
+        analysis.stop(LanguageServerExited(
+            "SonarLint language server exited with code %s" % code,
+            analysis.open_files
+        ))
+
+    async def analyze_files(self, paths: list, each_callback: callable = None) -> list:
+        """
+        Analyse files as they are on disk
+
+        :param paths:
+        :param each_callback: called with the URI and result of each file once it has been analysed
+        :return: the results of all files
+        """
+        await self.start()
+        self._worker.add_workspace_folders(list(discovery.group_by_project(paths).keys()))
+        return await self._analysis.submit(list(paths), each_callback)
+
+    async def analyze_text(self, name: str, text: str) -> dict:
+        """
+        Analyse a snippet of code that does not exist on disk
+
+        :param name: file name of the snippet. The extension selects the language.
+        :param text:
+        :return: the result. Its URI is a unique path below SNIPPET_ROOT.
+        """
+        await self.start()
+        path = os.path.join(SNIPPET_ROOT, str(next(self._snippets)), os.path.basename(name))
+        results = await self._analysis.submit([path], sources={path: text})
+        return results[0]
+
+    async def _shutdown(self):
+        if self._supervisor is not None:
+            self._supervisor.cancel()
+            self._supervisor = None
+        if self._analysis is not None:
+            self._analysis.stop()
+            self._analysis = None
+        if self._worker is not None:
+            await self._worker.stop()
+            self._worker = None
+
+    async def stop(self):
+        if self._lock is None:
+            return
+        async with self._lock:
+            await self._shutdown()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.stop()
+
+
+class SonarLintSession:
+    """
+    Thread-safe variant of AsyncSonarLintSession for callers without an event loop
+    The session runs on its own event loop in a background thread and every method returns a concurrent.futures.Future.
+
+        with SonarLintSession(lambda: cli.create_worker("/usr/bin/java", "file:///code")) as session:
+            futures = [session.analyze_files([path]) for path in paths]
+            results = [future.result() for future in futures]
+    """
+
+    def __init__(self, worker_factory: callable, max_open: int = 64, file_timeout: float = None,
+                 max_file_size: int = None):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="sonarlint-session", daemon=True)
+        self._thread.start()
+        self._session = AsyncSonarLintSession(worker_factory, max_open, file_timeout, max_file_size)
+
+    def _submit(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    def start(self):
+        return self._submit(self._session.start())
+
+    def analyze_files(self, paths: list):
+        return self._submit(self._session.analyze_files(paths))
+
+    def analyze_text(self, name: str, text: str):
+        return self._submit(self._session.analyze_text(name, text))
+
+    def close(self):
+        """
+        Stop the language server and the event loop thread
+
+        :return:
+        """
+        if self._loop.is_closed():
+            return
+        try:
+            self._submit(self._session.stop()).result()
+        finally:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+
+    def __enter__(self):
+        self.start().result()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,8 +1,15 @@
+import asyncio
+import collections
+import hashlib
+import heapq
+import itertools
+import json
 import os
-import subprocess
-import threading
+import sys
 
-from sonarlintcli.languageserver import urify, unurify, LANGUAGES, get_language_id
+from sonarlintcli import discovery, source, stats
+from sonarlintcli.languageserver import urify, unurify, LANGUAGES, get_language_id, ReverseServer, \
+    StdioServer
 
 JAR_DOWNLOAD_LANGUAGE_SERVER = "https://repox.jfrog.io/repox/sonarsource/org/sonarsource/sonarlint/core/sonarlint-language-server/4.3.1.2486/sonarlint-language-server-4.3.1.2486.jar"
 JAR_DOWNLOAD_LANGUAGES = {
@@ -15,6 +22,45 @@ JAR_DOWNLOAD_LANGUAGES = {
     LANGUAGES.java: "https://repox.jfrog.io/repox/sonarsource/org/sonarsource/java/sonar-java-plugin/5.9.2.16552/sonar-java-plugin-5.9.2.16552.jar"
 }
 
+# ways to talk to the language server: it connects back to a local TCP port or uses its stdin and stdout
+TRANSPORTS = ["tcp", "stdio"]
+
+INITIALIZATION_OPTIONS = {
+    "disableTelemetry": True,
+    "includeRuleDetailsInCodeAction": True,
+    "typeScriptLocation": "/usr/lib/node_modules/typescript/lib"
+}
+
+
+def analyzer_fingerprint() -> str:
+    """
+    Identify the language server, analyzer versions and configuration that produce a result
+
+    :return:
+    """
+    config = [JAR_DOWNLOAD_LANGUAGE_SERVER, JAR_DOWNLOAD_LANGUAGES, INITIALIZATION_OPTIONS]
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+
+def get_languages(files: list) -> set:
+    languages = {get_language_id(file) for file in files}
+    languages.discard(None)
+    return languages
+
+
+def get_analyzer_jars(analyzers_dir: str, languages: set) -> list:
+    """
+    Return the plugin jars in analyzers_dir that are needed to analyse the given languages
+
+    :param analyzers_dir:
+    :param languages:
+    :return:
+    """
+    return [
+        os.path.join(analyzers_dir, os.path.basename(JAR_DOWNLOAD_LANGUAGES[language]))
+        for language in sorted(languages) if language in JAR_DOWNLOAD_LANGUAGES
+    ]
+
 
 def ensure_callable(val):
     if callable(val):
@@ -22,143 +68,1163 @@ def ensure_callable(val):
     return lambda *args, **kwargs: None
 
 
+class LanguageServerExited(RuntimeError):
+    """
+    Raised if the language server process exits while an analysis is running
+    open_files contains the URIs of all files that were open on the language server at that time.
+    """
+
+    def __init__(self, message, open_files: list):
+        super().__init__(message)
+        self.open_files = open_files
+
+
 class SonarLintRuleResolver:
-    def __init__(self, language_server):
+    """
+    Resolves rule details for diagnostics via textDocument/codeAction
+    All rule details that have been received are cached in the given rules dict (e.g. RuleDatabase.rules) so a rule is
+    only fetched once per database.
+    """
+
+    def __init__(self, language_server, rules: dict = None, request_timeout: float = None):
         self._language_server = language_server
-        self._diagnostics_cache = {}
+        self._diagnostics_cache = rules if rules is not None else {}
+        # rule records by code that are shared by the results of all files (see combine_result)
+        self.rule_table = {}
         self._resolve_queue = {}
+        self._request_timeout = request_timeout
+
+    def get_cached(self, code):
+        """
+        Return the rule details for a code if they are already known or None otherwise
+
+        :param code:
+        :return:
+        """
+        return self._diagnostics_cache.get(code)
 
-    def get_by_diagnostics(self, file, diagnostics: dict, cb: callable):
+    async def get_by_diagnostics(self, file, diagnostics: dict):
+        """
+        Resolve the rule details (code, description, html, type, severity) for a diagnostic
+        Concurrent lookups for the same rule code share a single codeAction request.
+
+        :param file: URI of the file the diagnostic belongs to
+        :param diagnostics:
+        :return:
+        """
         code = diagnostics['code']
         if code in self._diagnostics_cache:
             return self._diagnostics_cache[code]
 
-        if code not in self._resolve_queue:
-            self._resolve_queue[code] = [cb]
+        if code in self._resolve_queue:
+            return await self._resolve_queue[code]
+
+        future = asyncio.get_event_loop().create_future()
+        self._resolve_queue[code] = future
+        try:
+            responses = await asyncio.wait_for(self._language_server.send_request("textDocument/codeAction", {
+                'textDocument': {
+                    "uri": file
+                },
+                "range": diagnostics['range'],
+                "context": {
+                    "diagnostics": diagnostics
+                }
+            }), self._request_timeout)
+        except asyncio.TimeoutError:
+            del self._resolve_queue[code]
+            future.set_exception(RuntimeError("No details for rule %s within %ss" % (code, self._request_timeout)))
+        except Exception as e:
+            del self._resolve_queue[code]
+            future.set_exception(e)
         else:
-            self._resolve_queue[code].append(cb)
-            return
+            self._on_rule_desc(responses)
+            if not future.done():
+                del self._resolve_queue[code]
+                future.set_exception(RuntimeError("Language server did not return details for rule %s" % code))
+        return await future
 
-        self._language_server.send_request("textDocument/codeAction", {
-            'textDocument': {
-                "uri": file
-            },
-            "range": diagnostics['range'],
-            "context": {
-                "diagnostics": diagnostics
-            }
-        }, self._on_rule_desc)
+    async def prefetch(self, codes: list):
+        """
+        Resolve the details of all given rule codes that are not cached, yet
+
+        :param codes:
+        :return:
+        """
+        await asyncio.gather(*[self.get_by_diagnostics(urify("/sonarlint-cli-prefetch"), {
+            "code": code,
+            "source": "sonarlint",
+            "message": "",
+            "range": {"start": {"line": 0, "character": 0}, "end": {"line": 0, "character": 0}}
+        }) for code in codes if code not in self._diagnostics_cache])
 
     def _on_rule_desc(self, responses):
-        for response in responses:
+        for response in responses or []:
+            if len(response.get("arguments") or []) != 5:
+                # not a rule description command
+                continue
             code, description, html, type, severity = response["arguments"]
+            self._diagnostics_cache[code] = (code, description, html, type, severity)
             if code in self._resolve_queue:
-                for cb in self._resolve_queue[code]:
-                    cb(code, description, html, type, severity)
-                del self._resolve_queue[code]
+                future = self._resolve_queue.pop(code)
+                if not future.done():
+                    future.set_result((code, description, html, type, severity))
 
 
-class SonarLintProcess(threading.Thread):
-    def __init__(self, port, ls_jar, analyzers, java_bin):
-        super().__init__(target=self._run_sonarlint_ls)
+class SonarLintProcess:
+    def __init__(self, port, ls_jar, analyzers, java_bin, stdio: tuple = None, jvm_options: list = None):
+        """
+        :param port: port of the ReverseServer the language server connects to
+        :param ls_jar:
+        :param analyzers:
+        :param java_bin:
+        :param stdio: (stdin, stdout) file descriptors to talk over instead of a port (see StdioServer.create_pipes)
+        :param jvm_options: passed to java before -jar, e.g. heap and GC settings
+        """
         self.analyzers = analyzers
         self.java_bin = java_bin
         self.ls_jar = ls_jar
         self.port = port
-        self._stop_e = threading.Event()
-        self._is_stop = threading.Event()
+        self.stdio = stdio
+        self.jvm_options = list(jvm_options or [])
+        self._proc: asyncio.subprocess.Process = None
+
+    @property
+    def pid(self):
+        return self._proc.pid if self._proc is not None else None
 
     def get_sonar_analyzers(self):
         return ["file://" + analyzer for analyzer in self.analyzers]
 
-    def _run_sonarlint_ls(self):
-        cmd = [self.java_bin, "-jar", self.ls_jar, str(self.port)]
+    @property
+    def running(self):
+        return self._proc is not None and self._proc.returncode is None
+
+    async def start(self):
+        cmd = [self.java_bin] + self.jvm_options + ["-jar", self.ls_jar]
+        if self.stdio is not None:
+            cmd.append("-stdio")
+            stdin, stdout = self.stdio
+        else:
+            cmd.append(str(self.port))
+            stdin, stdout = None, asyncio.subprocess.DEVNULL
         cmd.extend(self.get_sonar_analyzers())
-        with open(os.devnull, 'w') as devnull:
-            with subprocess.Popen(cmd, stdout=devnull, stderr=devnull) as proc:
-                self._stop_e.wait()
-                proc.terminate()
-                proc.wait()
-            self._is_stop.set()
+        self._proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=stdin,
+            stdout=stdout,
+            stderr=asyncio.subprocess.DEVNULL
+        )
 
-    def stop(self):
-        self._stop_e.set()
-        self._is_stop.wait()
+    async def wait(self):
+        return await self._proc.wait()
 
+    async def stop(self):
+        if self._proc is None:
+            return
+        if self._proc.returncode is None:
+            self._proc.terminate()
+        await self._proc.wait()
 
-class Analysis:
-    def __init__(self, ls_client, rule_resolver: SonarLintRuleResolver, files: list, cb: callable, done: callable):
-        self._files = files
-        self._pending_files = []
-        self._results = []
+
+def workspace_folder(path: str) -> dict:
+    return {"uri": urify(path), "name": os.path.basename(path) or path}
+
+
+async def initialize(ls_client, root_uri, workspace_folders: list = None):
+    """
+    Initialize a language server
+
+    :param ls_client:
+    :param root_uri: file:// URI of the workspace root
+    :param workspace_folders: paths of the project roots within the workspace
+    :return:
+    """
+    params = {
+        "processId": os.getpid(),
+        "rootUri": root_uri,
+        "capabilities": {
+            "workspace": {"workspaceFolders": True}
+        },
+        "initializationOptions": INITIALIZATION_OPTIONS
+    }
+    if workspace_folders:
+        params["workspaceFolders"] = [workspace_folder(path) for path in workspace_folders]
+    await ls_client.send_request("initialize", params)
+
+
+class SonarLintWorker:
+    """
+    A SonarLint language server process together with its initialized connection
+    The worker can run any number of analyses one after another without restarting Java.
+    """
+
+    def __init__(self, ls_jar, analyzers, java_bin, root_uri, rules: dict = None, request_timeout: float = None,
+                 transport: str = "tcp", workspace_folders: list = None, jvm_options: list = None):
+        if transport not in TRANSPORTS:
+            raise ValueError("Unknown transport %s" % transport)
+        self.ls_jar = ls_jar
+        self.analyzers = analyzers
+        self.java_bin = java_bin
+        self.root_uri = root_uri
+        self.rules = rules
+        self.request_timeout = request_timeout
+        self.transport = transport
+        self.workspace_folders = list(workspace_folders or [])
+        self.jvm_options = list(jvm_options or [])
+        self.server = None
+        self.process: SonarLintProcess = None
+        self.rule_resolver: SonarLintRuleResolver = None
+        self.closed_documents: ClosedDocuments = None
+        self._lock: asyncio.Lock = None
+
+    @property
+    def running(self):
+        return self.process is not None and self.process.running
+
+    async def start(self):
+        self._lock = asyncio.Lock()
+        recorder = stats.recorder
+        start = recorder.now() if recorder is not None else None
+        if self.transport == "stdio":
+            self.server = StdioServer()
+            self.process = SonarLintProcess(
+                port=None,
+                ls_jar=self.ls_jar,
+                analyzers=self.analyzers,
+                java_bin=self.java_bin,
+                stdio=self.server.create_pipes(),
+                jvm_options=self.jvm_options
+            )
+            try:
+                await self.process.start()
+            except Exception:
+                await self.server.stop()
+                raise
+            await self.server.start()
+        else:
+            self.server = ReverseServer()
+            await self.server.start()
+            self.process = SonarLintProcess(
+                port=self.server.addr[1],
+                ls_jar=self.ls_jar,
+                analyzers=self.analyzers,
+                java_bin=self.java_bin,
+                jvm_options=self.jvm_options
+            )
+            await self.process.start()
+        connected = asyncio.ensure_future(self.server.wait_for_connection())
+        exited = asyncio.ensure_future(self.process.wait())
+        await asyncio.wait([connected, exited], return_when=asyncio.FIRST_COMPLETED)
+        if not connected.done():
+            connected.cancel()
+            await self.stop()
+            raise RuntimeError("SonarLint language server exited with code %s before connecting" % exited.result())
+        exited.cancel()
+        connected.result()
+        if recorder is not None:
+            # from spawning Java until the language server connected back
+            recorder.phases["start language server"] += recorder.now() - start
+            recorder.span("start language server", "phase", start, owner=self.server)
+        self.rule_resolver = SonarLintRuleResolver(self.server, self.rules, self.request_timeout)
+        self.closed_documents = ClosedDocuments(self.server)
+        await initialize(self.server, self.root_uri, self.workspace_folders)
+
+    def add_workspace_folders(self, folders: list):
+        """
+        Tell the language server about project roots it does not know yet
+
+        :param folders: paths
+        :return:
+        """
+        added = [folder for folder in folders if folder not in self.workspace_folders]
+        if len(added) == 0:
+            return
+        self.workspace_folders.extend(added)
+        self.server.send_notification("workspace/didChangeWorkspaceFolders", {
+            "event": {
+                "added": [workspace_folder(folder) for folder in added],
+                "removed": []
+            }
+        })
+
+    async def list_rules(self) -> list:
+        """
+        Ask the language server for the codes of all rules that the loaded analyzers provide
+
+        :return:
+        """
+        rules_by_language = await self.server.send_request("sonarlint/listAllRules", None)
+        return [rule["key"] for rules in (rules_by_language or {}).values() for rule in rules]
+
+    async def analyze(self, files, each_callback=None, max_open=64, keep_results=True, file_timeout=None,
+                      deadline=None, max_file_size=None) -> list:
+        """
+        Analyse files on this worker. Analyses are run one at a time.
+        Raises LanguageServerExited if the language server process exits before the analysis is finished.
+
+        :param files:
+        :param each_callback: called with the URI and result of each file once it has been analysed
+        :param max_open: maximum number of documents that are open on the language server at the same time
+        :param keep_results: return all results at the end. Disable this if each_callback already consumes them.
+        :param file_timeout: seconds after which a file without result is reported as timed out
+        :param deadline: event loop time after which all remaining files are reported as timed out
+        :param max_file_size: files with more bytes are reported as skipped
+        :return:
+        """
+        async with self._lock:
+            # every file is analysed in the context of its own project instead of the whole workspace
+            self.add_workspace_folders(list(discovery.group_by_project(files).keys()))
+            analysis = Analysis(self.server, self.rule_resolver, files, each_callback, max_open, keep_results,
+                                file_timeout, deadline, max_file_size, self.closed_documents)
+            running = asyncio.ensure_future(analysis.run())
+            exited = asyncio.ensure_future(self.process.wait())
+            await asyncio.wait([running, exited], return_when=asyncio.FIRST_COMPLETED)
+            if not running.done():
+                running.cancel()
+                raise LanguageServerExited(
+                    "SonarLint language server exited with code %s during analysis" % exited.result(),
+                    analysis.open_files
+                )
+            exited.cancel()
+            return running.result()
+
+    async def exit(self, timeout: float = 60):
+        """
+        Ask the language server to shut down and wait until its JVM has exited on its own, e.g. so it can write a class
+        data sharing archive. Falls back to stop() if that takes longer than timeout seconds.
+
+        :param timeout:
+        :return: exit code of the process
+        """
+        try:
+            await asyncio.wait_for(self.server.send_request("shutdown", None), timeout)
+            self.server.send_notification("exit", None)
+            self.server.flush()
+        except (asyncio.TimeoutError, ConnectionError, RuntimeError):
+            # it may be on its way out already
+            pass
+        try:
+            return await asyncio.wait_for(self.process.wait(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            await self.stop()
+
+    async def stop(self):
+        if self.server is not None:
+            await self.server.stop()
+        if self.process is not None:
+            await self.process.stop()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.stop()
+
+
+def error_result(file, error: str) -> dict:
+    """
+    Build the result record of a file that could not be analysed
+
+    :param file: URI of the file
+    :param error:
+    :return:
+    """
+    return {"uri": file, "diagnostics": [], "rules": {}, "error": error}
+
+
+def skipped_result(file, reason: str) -> dict:
+    """
+    Build the result record of a file that has deliberately not been analysed
+
+    :param file: URI of the file
+    :param reason:
+    :return:
+    """
+    return {"uri": file, "diagnostics": [], "rules": {}, "skipped": reason}
+
+
+def combine_result(file, diagnostics: list, resolved: list, rule_table: dict = None) -> dict:
+    """
+    Build the result record of a file from its diagnostics and the resolved rule details
+
+    :param file: URI of the file
+    :param diagnostics:
+    :param resolved: (code, description, html, type, severity) for each diagnostic
+    :param rule_table: rule records by code that are reused instead of building a new record per file. Results that
+                       share a table must not be modified.
+    :return:
+    """
+    if rule_table is None:
+        rule_table = {}
+    rules = {}
+    for rule in resolved:
+        code = rule[0]
+        if code in rules:
+            continue
+        record = rule_table.get(code)
+        if record is None:
+            _, description, html, type, severity = rule
+            record = rule_table[code] = {
+                "code": code,
+                "description": description,
+                "html": html,
+                "type": type,
+                "severity": severity
+            }
+        rules[code] = record
+    return {"uri": file, "diagnostics": diagnostics, "rules": rules}
+
+
+class AnalysisBatch:
+    """
+    Files that have been submitted to an Analysis together
+    The future resolves with the results once every file of the batch has one. If the callback raises, the batch fails
+    with that exception and later results are dropped.
+    """
+
+    def __init__(self, size: int, cb: callable, keep_results: bool):
+        self.remaining = size
+        self.results = [] if keep_results else None
+        self.future = asyncio.get_event_loop().create_future()
+        self._callback = ensure_callable(cb)
+        if size == 0:
+            self.future.set_result([])
+
+    def report(self, file, result):
+        if self.future.done():
+            # failed already
+            return
+        if self.results is not None:
+            self.results.append(result)
+        try:
+            self._callback(file, result)
+        except Exception as e:
+            # e.g. a closed output pipe, nobody is interested in the other results anymore
+            self.fail(e)
+            return
+        self.remaining -= 1
+        if self.remaining == 0 and not self.future.done():
+            self.future.set_result(self.results if self.results is not None else [])
+
+    def fail(self, exc: Exception):
+        if not self.future.done():
+            self.future.set_exception(exc)
+
+
+class ClosedDocuments:
+    """
+    Closes documents on a language server and keeps track of the ones whose diagnostics have not been cleared, yet
+    SonarLint publishes empty diagnostics for every document that is closed. If the document was opened again before
+    that notification arrives, it would be taken for the result of the new opening, so analyses wait for it (see
+    wait) before they open a document again. Create it before any analysis listens for diagnostics, so it sees the
+    notification first.
+    """
+
+    def __init__(self, ls_client):
         self._ls_client = ls_client
+        # future by URI that resolves once the diagnostics of the closed document have been cleared
+        self._closing = {}
         self._ls_client.on('textDocument/publishDiagnostics', self._on_diagnostics)
-        self._rule_resolver = rule_resolver
-        self._callback = ensure_callable(cb)
-        self._done_callback = ensure_callable(done)
-
-    def run(self):
-        self._ls_client.send_request("initialize", {
-            "processId": os.getpid(),
-            "rootUri": os.path.commonpath(self._files),
-            "capabilities": {},
-            "initializationOptions": {
-                "disableTelemetry": True,
-                "includeRuleDetailsInCodeAction": True,
-                "typeScriptLocation": "/usr/lib/node_modules/typescript/lib"
+
+    def close(self, uri):
+        self._ls_client.send_notification("textDocument/didClose", {
+            "textDocument": {
+                "uri": uri
             }
-        }, self._send_files)
+        })
+        if uri not in self._closing:
+            self._closing[uri] = asyncio.get_event_loop().create_future()
 
-    def _send_files(self, _init_result):
-        for file in self._files:
-            with open(str(file), "r") as fd:
-                uri = urify(file)
+    def closing(self, uri) -> bool:
+        return uri in self._closing
+
+    def wait(self, uri) -> asyncio.Future:
+        """
+        :param uri:
+        :return: future that resolves once the document can be opened again
+        """
+        if uri in self._closing:
+            return self._closing[uri]
+        future = asyncio.get_event_loop().create_future()
+        future.set_result(None)
+        return future
+
+    def detach(self):
+        self._ls_client.off('textDocument/publishDiagnostics', self._on_diagnostics)
+
+    def _on_diagnostics(self, params: dict):
+        if len(params['diagnostics']) > 0 or params['uri'] not in self._closing:
+            # a late result for the closed document, the cleared diagnostics are still to come
+            return
+        future = self._closing.pop(params['uri'])
+        if not future.done():
+            future.set_result(None)
+
+
+class OpenDocument:
+    """
+    State of a document that is open on the language server for an Analysis
+    A new object per opening tells resolutions for an earlier opening of the same URI apart.
+    """
+    __slots__ = ("batch", "opened", "version", "timeout")
+
+    def __init__(self, batch: AnalysisBatch, opened: float = None, version: int = 1):
+        self.batch = batch
+        # stats time of the didOpen (only while stats are recorded)
+        self.opened = opened
+        self.version = version
+        self.timeout: asyncio.TimerHandle = None
+
+
+class Analysis:
+    """
+    Sends files to an initialized language server and collects their diagnostics and rule details
+    Files can be submitted in any number of batches while the analysis is running (see submit), so a single analysis
+    can serve a long-lived session. At most max_open documents are open on the language server at the same time. A
+    document is closed as soon as its result is complete and the next queued file is opened in its place. A URI that
+    has been submitted again while it is open stays open and its next content is sent with textDocument/didChange.
+    One that has been closed is only opened again once the language server has cleared its diagnostics (see
+    ClosedDocuments), which the analyses of a worker share.
+    A file that has no result file_timeout seconds after it has been opened is reported with an error. Once the
+    deadline (event loop time) has passed all remaining files are reported that way.
+    The next max_open queued files are read and decoded on the source thread pool ahead of the window, so the event
+    loop never waits for the disk. Files with more than max_file_size bytes are reported as skipped.
+    """
+
+    def __init__(self, ls_client, rule_resolver: SonarLintRuleResolver, files: list = None, cb: callable = None,
+                 max_open: int = 64, keep_results: bool = True, file_timeout: float = None, deadline: float = None,
+                 max_file_size: int = None, closed_documents: ClosedDocuments = None):
+        self._files = files or []
+        self._callback = cb
+        self._keep_results = keep_results
+        self._max_open = max(1, max_open)
+        self._max_file_size = max_file_size
+        # (file, text or None, batch) waiting to be read
+        self._queue = collections.deque()
+        # (file, future of its text, batch) that are being read or waiting to be opened
+        self._loading = collections.deque()
+        # stats time since when the window has been waiting for the next file to be read
+        self._loading_since = None
+        # queue entries for documents that are still open or closing for an earlier submission by URI
+        self._deferred = {}
+        # version by URI of completed documents that are kept open for their deferred entry
+        self._kept_open = {}
+        # OpenDocument by URI
+        self._pending_files = {}
+        self._file_timeout = file_timeout
+        self._deadline = deadline
+        self._deadline_handle = None
+        self._ls_client = ls_client
+        self._rule_resolver = rule_resolver
+        self._owns_closed_documents = closed_documents is None
+        self._closed_documents = closed_documents or ClosedDocuments(ls_client)
+        self._started = False
+        self._draining = False
+
+    @property
+    def open_files(self) -> list:
+        return list(self._pending_files)
+
+    def start(self):
+        """
+        Start listening for diagnostics. The language server has to be initialized already (see initialize).
+
+        :return:
+        """
+        if self._started:
+            return
+        self._started = True
+        self._ls_client.on('textDocument/publishDiagnostics', self._on_diagnostics)
+        if self._deadline is not None:
+            self._deadline_handle = asyncio.get_event_loop().call_at(self._deadline, self._on_deadline)
+
+    def stop(self, exc: Exception = None):
+        """
+        Stop listening and fail all batches that are not complete, yet
+
+        :param exc: the batches fail with this exception
+        :return:
+        """
+        self._started = False
+        self._ls_client.off('textDocument/publishDiagnostics', self._on_diagnostics)
+        if self._owns_closed_documents:
+            self._closed_documents.detach()
+        if self._deadline_handle is not None:
+            self._deadline_handle.cancel()
+        for document in self._pending_files.values():
+            if document.timeout is not None:
+                document.timeout.cancel()
+        exc = exc if exc is not None else RuntimeError("Analysis has been stopped")
+        batches = [document.batch for document in self._pending_files.values()]
+        batches.extend(batch for _, _, batch in self._queue)
+        batches.extend(batch for _, _, batch in self._loading)
+        batches.extend(batch for entries in self._deferred.values() for _, _, batch in entries)
+        for _, future, _ in self._loading:
+            future.cancel()
+        self._pending_files.clear()
+        self._queue.clear()
+        self._loading.clear()
+        self._deferred.clear()
+        self._kept_open.clear()
+        for batch in batches:
+            batch.fail(exc)
+
+    def submit(self, files: list, cb: callable = None, sources: dict = None, keep_results: bool = None):
+        """
+        Queue files for analysis
+
+        :param files:
+        :param cb: called with the URI and result of each file once it has been analysed
+        :param sources: text to analyse instead of the content on disk by file, e.g. for unsaved buffers
+        :param keep_results: resolve with all results. Defaults to the keep_results of the analysis.
+        :return: future that resolves with the results of all files
+        """
+        batch = AnalysisBatch(len(files), cb, self._keep_results if keep_results is None else keep_results)
+        for file in files:
+            self._queue.append((file, sources.get(file) if sources else None, batch))
+        self._send_files()
+        return batch.future
+
+    async def run(self) -> list:
+        """
+        Analyse the files given to the constructor and return the results once every file has one
+
+        :return:
+        """
+        self.start()
+        try:
+            return await self.submit(self._files, self._callback)
+        finally:
+            self.stop()
+
+    def _load_files(self):
+        """
+        Start reading queued files until the next max_open files are being read or ready to be opened
+
+        :return:
+        """
+        if len(self._loading) > self._max_open // 2:
+            # refill in bulk so the reads can be batched
+            return
+        loop = asyncio.get_event_loop()
+        reads = []
+        while len(self._loading) < self._max_open and len(self._queue) > 0:
+            file, text, batch = self._queue.popleft()
+            future = loop.create_future()
+            if text is None:
+                reads.append((str(file), future))
+            else:
+                future.set_result(text)
+            self._loading.append((file, future, batch))
+        for i in range(0, len(reads), source.READ_BATCH_SIZE):
+            chunk = reads[i:i + source.READ_BATCH_SIZE]
+            loop.run_in_executor(
+                source.executor(), source.read_all, [path for path, _ in chunk], self._max_file_size
+            ).add_done_callback(lambda read, futures=[future for _, future in chunk]: self._on_read(futures, read))
+
+    @staticmethod
+    def _on_read(futures: list, read: asyncio.Future):
+        if read.cancelled():
+            return
+        if read.exception() is not None:
+            results = [read.exception()] * len(futures)
+        else:
+            results = read.result()
+        for future, result in zip(futures, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def _on_loaded(self, future):
+        recorder = stats.recorder
+        if recorder is not None and self._loading_since is not None:
+            recorder.phases["wait for files"] += recorder.now() - self._loading_since
+        self._loading_since = None
+        if self._started:
+            self._send_files()
+
+    def _send_files(self):
+        """
+        Open files that have been read on the language server until the window of max_open documents is full
+
+        :return:
+        """
+        loop = asyncio.get_event_loop()
+        recorder = stats.recorder
+        start = recorder.now() if recorder is not None else None
+        opened = 0
+        self._load_files()
+        while len(self._pending_files) < self._max_open and len(self._loading) > 0:
+            if self._ls_client.writing_paused:
+                # the language server is behind on reading, continue once it has caught up
+                if not self._draining:
+                    self._draining = True
+                    asyncio.ensure_future(self._send_after_drain())
+                break
+            file, future, batch = self._loading[0]
+            if not future.done():
+                # files are opened in order so wait for this one
+                if self._loading_since is None:
+                    self._loading_since = recorder.now() if recorder is not None else 0
+                    future.add_done_callback(self._on_loaded)
+                break
+            self._loading.popleft()
+            self._load_files()
+            uri = urify(file)
+            try:
+                text = future.result()
+            except source.FileTooLarge as e:
+                batch.report(uri, skipped_result(uri, "File is larger than %s bytes (%s bytes)" % (
+                    self._max_file_size, e.size
+                )))
+                continue
+            except (OSError, UnicodeDecodeError) as e:
+                batch.report(uri, error_result(uri, "Could not read file: %s" % e))
+                continue
+            if uri in self._pending_files or self._closed_documents.closing(uri):
+                # the language server only knows one version of a document at a time
+                if uri not in self._pending_files and uri not in self._deferred:
+                    self._closed_documents.wait(uri).add_done_callback(lambda _, uri=uri: self._on_cleared(uri))
+                self._deferred.setdefault(uri, collections.deque()).append((file, text, batch))
+                continue
+            version = self._kept_open.pop(uri, 0) + 1
+            if version == 1:
                 self._ls_client.send_notification("textDocument/didOpen", {
                     "textDocument": {
                         "uri": uri,
                         "languageId": get_language_id(file),
-                        "version": 1,
-                        "text": fd.read()
+                        "version": version,
+                        "text": text
                     }
                 })
-                self._pending_files.append(uri)
+            else:
+                self._ls_client.send_notification("textDocument/didChange", {
+                    "textDocument": {
+                        "uri": uri,
+                        "version": version
+                    },
+                    "contentChanges": [{"text": text}]
+                })
+            document = self._pending_files[uri] = OpenDocument(
+                batch, recorder.now() if recorder is not None else None, version
+            )
+            opened += 1
+            if self._file_timeout is not None:
+                document.timeout = loop.call_later(self._file_timeout, self._on_file_timeout, uri)
+        if recorder is not None and opened > 0:
+            recorder.span("open files", "analysis", start, owner=self._ls_client, files=opened)
+
+    async def _send_after_drain(self):
+        try:
+            await self._ls_client.drain()
+        finally:
+            self._draining = False
+        if self._started:
+            self._send_files()
+
+    def _on_file_timeout(self, uri):
+        self._complete_file(uri, error_result(uri, "Timed out after %ss" % self._file_timeout))
+
+    def _on_deadline(self):
+        """
+        Report all files that have not been completed yet as timed out
+
+        :return:
+        """
+        entries = list(self._queue)
+        entries.extend(self._loading)
+        entries.extend(entry for deferred in self._deferred.values() for entry in deferred)
+        for _, future, _ in self._loading:
+            future.cancel()
+        self._queue.clear()
+        self._loading.clear()
+        self._deferred.clear()
+        for uri in self._kept_open:
+            self._closed_documents.close(uri)
+        self._kept_open.clear()
+        for uri in list(self._pending_files):
+            self._complete_file(uri, error_result(uri, "Analysis deadline exceeded"), open_next=False)
+        for file, _, batch in entries:
+            uri = urify(file)
+            batch.report(uri, error_result(uri, "Analysis deadline exceeded"))
 
     def _on_diagnostics(self, params: dict):
         file = params['uri']
         diagnostics = params['diagnostics']
-        if file not in self._pending_files:
+        document = self._pending_files.get(file)
+        if document is None:
+            return
+        recorder = stats.recorder
+        if recorder is not None:
+            recorder.sample(len(self._pending_files), self._ls_client.pending_requests)
+            start = recorder.now()
+        resolved = [self._rule_resolver.get_cached(diagnostic['code']) for diagnostic in diagnostics]
+        if None in resolved:
+            asyncio.ensure_future(self._resolve_file(file, diagnostics, document))
+        else:
+            # all rules are known already so there is no need to wait for anything
+            self._complete_file(file, combine_result(file, diagnostics, resolved, self._rule_resolver.rule_table))
+        if recorder is not None:
+            recorder.span("diagnostics", "analysis", start, owner=self._ls_client, uri=file,
+                          diagnostics=len(diagnostics))
+
+    async def _resolve_file(self, file, diagnostics, document):
+        """
+        Resolve the rule details for all diagnostics of a file and publish the combined result
+
+        :param file:
+        :param diagnostics:
+        :param document: entry of the file in the open documents when the diagnostics arrived
+        :return:
+        """
+        try:
+            resolved = await asyncio.gather(*[
+                self._rule_resolver.get_by_diagnostics(file, diagnostic) for diagnostic in diagnostics
+            ])
+        except Exception as e:
+            self._complete_file(file, error_result(file, "Could not resolve rules: %s" % e), document=document)
             return
+        self._complete_file(
+            file, combine_result(file, diagnostics, resolved, self._rule_resolver.rule_table), document=document
+        )
+
+    def _complete_file(self, file, result, open_next=True, document=None):
+        current = self._pending_files.get(file)
+        if current is None or (document is not None and current is not document):
+            # diagnostics for this file have been published more than once, it has timed out already or it has been
+            # opened again in the meantime
+            return
+        del self._pending_files[file]
+        if current.opened is not None and stats.recorder is not None:
+            stats.recorder.file_done(os.path.basename(unurify(file)), current.opened, "error" in result,
+                                     self._ls_client)
+        if current.timeout is not None:
+            current.timeout.cancel()
+        if file in self._deferred:
+            # the language server clears the diagnostics of a closed document and that notification would be taken
+            # for the result of opening it again right away, so the document stays open for the next content
+            self._kept_open[file] = current.version
+            self._release_deferred(file)
+        else:
+            self._closed_documents.close(file)
+        current.batch.report(file, result)
+        if open_next:
+            self._send_files()
+
+    def _release_deferred(self, uri):
+        deferred = self._deferred[uri]
+        self._queue.appendleft(deferred.popleft())
+        if len(deferred) == 0:
+            del self._deferred[uri]
+
+    def _on_cleared(self, uri):
+        if self._started and uri in self._deferred and uri not in self._pending_files:
+            self._release_deferred(uri)
+            self._send_files()
+
+
+class LiveAnalysis:
+    """
+    Sends changed files to an initialized language server and re-analyses them with textDocument/didChange
+    Every time the language server publishes diagnostics for one of the changed files the callback is called with the
+    complete result, just like for an Analysis. At most max_open documents are open at the same time. Documents stay
+    open after their result has been published, so the next change of the same file is sent with didChange, and the
+    least recently analysed one is closed once another file needs the slot. Further changes wait for a free slot and
+    closed documents are only opened again once their diagnostics have been cleared (see ClosedDocuments). A file that
+    has no result file_timeout seconds after it has been sent is reported with an error.
+    Changed files are read on the source thread pool, so the event loop never waits for the disk.
+    """
+
+    def __init__(self, ls_client, rule_resolver: SonarLintRuleResolver, cb: callable, max_open: int = 64,
+                 file_timeout: float = None, closed_documents: ClosedDocuments = None):
+        self._ls_client = ls_client
+        self._rule_resolver = rule_resolver
+        self._callback = ensure_callable(cb)
+        self._max_open = max(1, max_open)
+        self._file_timeout = file_timeout
+        # version of the latest change by URI. Versions are unique over all files, so a document that is opened again
+        # after it has been closed never reuses the version of an outdated result.
+        self._versions = {}
+        self._next_version = itertools.count(1)
+        # timeout handle (or None) by URI of the documents that are open on the language server
+        self._open = {}
+        # version by URI of the content the language server has been sent last
+        self._sent = {}
+        # URIs of documents that take a slot while they are read to be opened
+        self._opening = set()
+        # URIs of open documents whose latest result has been published, least recently analysed first
+        self._idle = collections.OrderedDict()
+        self._owns_closed_documents = closed_documents is None
+        self._closed_documents = closed_documents or ClosedDocuments(ls_client)
+        # paths by URI of changed files waiting for a free slot
+        self._waiting = collections.OrderedDict()
+
+    def start(self):
+        self._ls_client.on('textDocument/publishDiagnostics', self._on_diagnostics)
+
+    def stop(self):
+        self._ls_client.off('textDocument/publishDiagnostics', self._on_diagnostics)
+        self._waiting.clear()
+        # reads that are still running are outdated from now on
+        self._versions.clear()
+        self._opening.clear()
+        for uri, timeout in list(self._open.items()):
+            if timeout is not None:
+                timeout.cancel()
+            self._closed_documents.close(uri)
+        self._open.clear()
+        self._sent.clear()
+        self._idle.clear()
+        if self._owns_closed_documents:
+            self._closed_documents.detach()
+
+    def update(self, file):
+        """
+        Read the current content of a file and send it to the language server or queue it until a document can be
+        opened. A file that cannot be read is reported as removed.
+
+        :param file:
+        :return:
+        """
+        uri = urify(file)
+        # an analysis that is still running for an earlier change is outdated already
+        self._versions[uri] = next(self._next_version)
+        if uri in self._open or uri in self._opening:
+            # not to be closed for another file while it is read
+            self._idle.pop(uri, None)
+            self._read(uri, file)
+        elif not self._closed_documents.closing(uri) and self._make_room():
+            self._opening.add(uri)
+            self._read(uri, file)
+        else:
+            self._waiting[uri] = file
+
+    def remove(self, file):
+        uri = urify(file)
+        self._waiting.pop(uri, None)
+        if uri in self._versions:
+            del self._versions[uri]
+            self._opening.discard(uri)
+            if uri in self._open:
+                self._close(uri)
+            self._open_waiting()
+            self._callback(uri, combine_result(uri, [], []))
+
+    def _make_room(self) -> bool:
+        """
+        Check if another document can be opened and close the least recently analysed one if the window is full
+
+        :return:
+        """
+        if len(self._open) + len(self._opening) < self._max_open:
+            return True
+        if len(self._idle) == 0:
+            return False
+        self._close(next(iter(self._idle)))
+        return True
+
+    def _open_waiting(self):
+        for uri, file in list(self._waiting.items()):
+            if self._closed_documents.closing(uri):
+                continue
+            if not self._make_room():
+                return
+            del self._waiting[uri]
+            self._opening.add(uri)
+            self._read(uri, file)
+
+    def _read(self, uri, file):
+        version = self._versions[uri]
+        asyncio.get_event_loop().run_in_executor(source.executor(), source.read, str(file)).add_done_callback(
+            lambda read: self._on_read(uri, file, version, read)
+        )
+
+    def _on_read(self, uri, file, version, read: asyncio.Future):
+        if self._versions.get(uri) != version:
+            # changed again or removed while it was read, the latest read sends it
+            return
+        try:
+            text = read.result()
+        except OSError:
+            # removed again before we could read it
+            self.remove(file)
+            return
+        self._sent[uri] = version
+        if uri in self._open:
+            self._ls_client.send_notification("textDocument/didChange", {
+                "textDocument": {
+                    "uri": uri,
+                    "version": version
+                },
+                "contentChanges": [{"text": text}]
+            })
+        else:
+            self._opening.discard(uri)
+            self._ls_client.send_notification("textDocument/didOpen", {
+                "textDocument": {
+                    "uri": uri,
+                    "languageId": get_language_id(file),
+                    "version": version,
+                    "text": text
+                }
+            })
+            self._open[uri] = None
+        self._start_timeout(uri)
+
+    def _start_timeout(self, uri):
+        if self._open[uri] is not None:
+            self._open[uri].cancel()
+        if self._file_timeout is not None:
+            self._open[uri] = asyncio.get_event_loop().call_later(self._file_timeout, self._on_file_timeout, uri)
+
+    def _on_file_timeout(self, uri):
+        self._open[uri] = None
+        self._callback(uri, error_result(uri, "Timed out after %ss" % self._file_timeout))
+        self._close(uri)
+        self._open_waiting()
+
+    def _close(self, uri):
+        timeout = self._open.pop(uri)
+        if timeout is not None:
+            timeout.cancel()
+        self._sent.pop(uri, None)
+        self._idle.pop(uri, None)
+        self._closed_documents.close(uri)
+        self._closed_documents.wait(uri).add_done_callback(lambda _: self._open_waiting())
+
+    def _on_diagnostics(self, params: dict):
+        uri = params['uri']
+        if uri in self._open and uri not in self._idle:
+            if self._open[uri] is not None:
+                self._open[uri].cancel()
+                self._open[uri] = None
+            asyncio.ensure_future(self._resolve_file(uri, self._sent[uri], params['diagnostics']))
+
+    async def _resolve_file(self, file, version, diagnostics):
+        try:
+            resolved = await asyncio.gather(*[
+                self._rule_resolver.get_by_diagnostics(file, diagnostic) for diagnostic in diagnostics
+            ])
+        except Exception as e:
+            print("Could not resolve rules for %s: %s" % (file, e), file=sys.stderr)
+            resolved = None
+        if self._versions.get(file) != version or file not in self._open:
+            # the file has changed or been removed in the meantime so this result is outdated already
+            return
+        if resolved is not None:
+            self._callback(file, combine_result(file, diagnostics, resolved, self._rule_resolver.rule_table))
+        # the document can be closed for a waiting file from now on
+        self._idle[file] = None
+        self._open_waiting()
+
+
+async def analyze_with_restarts(worker_factory: callable, files: list, each_callback=None, keep_results=True,
+                                max_restarts=3, **options) -> list:
+    """
+    Analyse files on a fresh worker and continue with the unfinished files on a new worker if the language server
+    crashes. The files that were open during a crash are analysed one at a time on the new worker before all others,
+    so the file that crashes the language server on its own is found and reported as failed while the files that
+    just happened to be open with it get their results. After max_restarts crashes all remaining files are reported
+    as failed.
+
+    :param worker_factory: creates a new SonarLintWorker that has not been started, yet
+    :param files:
+    :param each_callback: called with the URI and result of each file once it has been analysed
+    :param keep_results: return all results at the end. Disable this if each_callback already consumes them.
+    :param max_restarts:
+    :param options: passed to SonarLintWorker.analyze
+    :return:
+    """
+    callback = ensure_callable(each_callback)
+    results = []
+    finished = set()
+
+    def on_result(uri, result):
+        finished.add(uri)
+        if keep_results:
+            results.append(result)
+        callback(uri, result)
+
+    remaining = list(files)
+    # files that were open during a crash and are analysed alone
+    suspects = collections.deque()
+    restarts = 0
+    while len(remaining) > 0 or len(suspects) > 0:
+        isolating = False
+        async with worker_factory() as worker:
+            try:
+                isolating = True
+                while len(suspects) > 0:
+                    await worker.analyze([suspects[0]], on_result, keep_results=False, **options)
+                    suspects.popleft()
+                isolating = False
+                await worker.analyze(remaining, on_result, keep_results=False, **options)
+                break
+            except LanguageServerExited as e:
+                print("%s. %s files were open." % (e, len(e.open_files)), file=sys.stderr)
+                crashed = set(e.open_files)
+        restarts += 1
+        if isolating:
+            if urify(suspects[0]) in crashed:
+                uri = urify(suspects.popleft())
+                on_result(uri, error_result(uri, "Language server crashed while analysing this file"))
+        else:
+            unfinished = [file for file in remaining if urify(file) not in finished]
+            suspects.extend(file for file in unfinished if urify(file) in crashed)
+            remaining = [file for file in unfinished if urify(file) not in crashed]
+        if restarts > max_restarts:
+            for file in list(suspects) + remaining:
+                uri = urify(file)
+                on_result(uri, error_result(uri, "Language server crashed while analysing this file"))
+            break
+        if len(remaining) > 0 or len(suspects) > 0:
+            print("Restarting SonarLint language server for %s remaining files..." % (len(remaining) + len(suspects)),
+                  file=sys.stderr)
+    return results
+
+
+def shard_files(files: list, count: int, groups: dict = None) -> list:
+    """
+    Split files into count shards with roughly the same amount of bytes each
+    Files are assigned from largest to smallest to the shard with the fewest bytes so far. If groups are given (see
+    discovery.group_by_project) the files of a group are kept on one shard unless the group alone is larger than a
+    shard should be, so each language server only has to know a few projects.
+
+    :param files:
+    :param count:
+    :param groups: files by project root
+    :return: list of non-empty shards
+    """
+    sizes = {}
+    for file in files:
+        try:
+            sizes[file] = os.path.getsize(file)
+        except OSError:
+            # the Analysis reports the error once it tries to read the file
+            sizes[file] = 0
+    count = max(1, min(count, len(files)))
+    if groups is None:
+        groups = {file: [file] for file in files}
+    limit = sum(sizes.values()) / count
+    items = []
+    for group in groups.values():
+        group_size = sum(sizes[file] for file in group)
+        if group_size > limit:
+            items.extend((sizes[file], [file]) for file in group)
+        else:
+            items.append((group_size, group))
+    items.sort(key=lambda item: item[0], reverse=True)
+    shards = [(0, i, []) for i in range(count)]
+    for size, group in items:
+        total, i, shard = heapq.heappop(shards)
+        shard.extend(group)
+        heapq.heappush(shards, (total + size, i, shard))
+    return [shard for _, _, shard in sorted(shards, key=lambda s: s[1]) if len(shard) > 0]
 
-        resolved = 0
-        rules = {}
-
-        # scoping function that will resolve all callbacks
-        def resolve_callbacks():
-            if len(diagnostics) == resolved:
-                combined = {"uri": file, "diagnostics": diagnostics, "rules": rules}
-                self._results.append(combined)
-                self._callback(file, combined)
-                self._pending_files.remove(file)
-                if len(self._pending_files) == 0:
-                    # resolve completely if all files have been analyzed
-                    self._done_callback(self._results)
-
-        # scoping function that calls the callback with the file, diagnostics and rule details
-        def on_rule(code, description, html, type, severity):
-            nonlocal resolved
-            resolved += 1
-            rules[code] = {code: code, description: description, html: html, type: type, severity: severity}
-            resolve_callbacks()
-
-        # in case there is no diagnostics for this file we can already resolve
-        if len(diagnostics) == 0:
-            resolve_callbacks()
-
-        for diagnostic in diagnostics:
-            self._rule_resolver.get_by_diagnostics(file, diagnostic, on_rule)
-
-
-def analyze(ls_client, rule_resolver, files, done_callback = None, each_callback = None) -> Analysis:
-    analysis = Analysis(ls_client, rule_resolver, files, each_callback, done_callback)
-    analysis.run()
-    return analysis
@@ -0,0 +1,92 @@
+import codecs
+import concurrent.futures
+import mmap
+import os
+
+# files of at least this size are mapped instead of copied into a buffer before decoding
+MMAP_THRESHOLD = 1024 * 256
+READ_WORKERS = 4
+# files per job on the thread pool. Handing over every file on its own costs more than reading a small file.
+READ_BATCH_SIZE = 16
+# maps every byte to a character so files in any legacy 8-bit encoding load with their columns intact
+FALLBACK_ENCODING = "latin-1"
+BOMS = [
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+]
+
+_executor: concurrent.futures.ThreadPoolExecutor = None
+
+
+class FileTooLarge(Exception):
+    def __init__(self, path: str, size: int, max_size: int):
+        super().__init__("%s has %s bytes, more than the maximum of %s" % (path, size, max_size))
+        self.size = size
+
+
+def executor() -> concurrent.futures.ThreadPoolExecutor:
+    """
+    Thread pool all source files are read on so disk I/O never blocks the event loop
+
+    :return:
+    """
+    global _executor
+    if _executor is None:
+        _executor = concurrent.futures.ThreadPoolExecutor(max_workers=READ_WORKERS, thread_name_prefix="read-source")
+    return _executor
+
+
+def decode(data) -> str:
+    """
+    Decode a source file: a byte order mark wins, then UTF-8 if the content is valid UTF-8 and FALLBACK_ENCODING
+    otherwise
+
+    :param data: bytes-like content of the file
+    :return:
+    """
+    head = bytes(data[:4])
+    for bom, encoding in BOMS:
+        if head.startswith(bom):
+            return str(data, encoding, errors="replace")
+    try:
+        return str(data, "utf-8")
+    except UnicodeDecodeError:
+        return str(data, FALLBACK_ENCODING)
+
+
+def read(path: str, max_size: int = None) -> str:
+    """
+    Read and decode a source file. Line endings are kept as they are on disk.
+
+    :param path:
+    :param max_size: raise FileTooLarge instead of reading files with more bytes
+    :return:
+    """
+    with open(path, "rb") as handle:
+        size = os.fstat(handle.fileno()).st_size
+        if max_size is not None and size > max_size:
+            raise FileTooLarge(path, size, max_size)
+        if size < MMAP_THRESHOLD:
+            return decode(handle.read())
+        with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return decode(mapped)
+
+
+def read_all(paths: list, max_size: int = None) -> list:
+    """
+    Read several files in a row (see read)
+
+    :param paths:
+    :param max_size:
+    :return: the text or the exception raised while reading for each file
+    """
+    results = []
+    for path in paths:
+        try:
+            results.append(read(path, max_size))
+        except (OSError, FileTooLarge) as e:
+            results.append(e)
+    return results
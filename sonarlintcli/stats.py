@@ -0,0 +1,267 @@
+import collections
+import contextlib
+import json
+import os
+import time
+
+# the recorder of the running analysis or None if instrumentation is disabled (see install)
+recorder = None
+
+
+def install(new_recorder):
+    """
+    Make a recorder the one all language server connections and analyses report to
+
+    :param new_recorder: Recorder or None to disable instrumentation again
+    :return: the installed recorder
+    """
+    global recorder
+    recorder = new_recorder
+    return new_recorder
+
+
+def percentile(values: list, p: float) -> float:
+    """
+    Nearest-rank percentile of a list of values
+
+    :param values:
+    :param p: percentile between 0 and 100
+    :return:
+    """
+    if len(values) == 0:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * p // 100))
+    return ordered[int(rank) - 1]
+
+
+def format_bytes(count: int) -> str:
+    for unit in ("B", "KB", "MB"):
+        if count < 1024:
+            return "%.1f %s" % (count, unit) if unit != "B" else "%d B" % count
+        count /= 1024
+    return "%.1f GB" % count
+
+
+class Recorder:
+    """
+    Collects counters, per-file latencies, queue depths and phase durations of an analysis
+    With trace enabled every span is kept as well and can be written as a Chrome trace (chrome://tracing, Perfetto).
+    All times are taken with time.perf_counter and reported relative to the creation of the recorder.
+    """
+
+    def __init__(self, trace: bool = False):
+        self._origin = time.perf_counter()
+        self._threads = {}
+        self._next_async_id = 0
+        self.rpc_sent = collections.Counter()
+        self.rpc_received = collections.Counter()
+        self.rpc_durations = collections.defaultdict(list)
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.file_latencies = []
+        self.errors = 0
+        self.open_files = []
+        self.pending_requests = []
+        self.phases = collections.defaultdict(float)
+        self.events = [] if trace else None
+
+    @property
+    def tracing(self) -> bool:
+        return self.events is not None
+
+    def now(self) -> float:
+        return time.perf_counter()
+
+    def _timestamp(self, t: float) -> float:
+        # trace events use microseconds
+        return (t - self._origin) * 1e6
+
+    def thread(self, owner) -> int:
+        """
+        Map an object (e.g. a language server connection) to a trace thread so its spans end up on one row
+
+        :param owner:
+        :return:
+        """
+        key = id(owner)
+        if key not in self._threads:
+            self._threads[key] = len(self._threads) + 1
+            if self.tracing:
+                self.events.append({
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": os.getpid(),
+                    "tid": self._threads[key],
+                    "args": {"name": "%s #%d" % (type(owner).__name__, self._threads[key])}
+                })
+        return self._threads[key]
+
+    def sent(self, method: str, nbytes: int):
+        self.rpc_sent[method] += 1
+        self.bytes_sent += nbytes
+
+    def received(self, method: str):
+        self.rpc_received[method] += 1
+
+    def request_done(self, method: str, start: float, owner=None):
+        end = self.now()
+        self.rpc_durations[method].append(end - start)
+        self.span(method, "rpc", start, end, owner)
+
+    def span(self, name: str, category: str, start: float, end: float = None, owner=None, **args):
+        """
+        Record a complete span. Only kept when tracing.
+
+        :param name:
+        :param category:
+        :param start: perf_counter time the span started
+        :param end: perf_counter time the span ended, defaults to now
+        :param owner: object whose trace thread the span belongs to
+        :param args: shown in the details of the span
+        :return:
+        """
+        if not self.tracing:
+            return
+        if end is None:
+            end = self.now()
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": self._timestamp(start),
+            "dur": (end - start) * 1e6,
+            "pid": os.getpid(),
+            "tid": self.thread(owner)
+        }
+        if args:
+            event["args"] = args
+        self.events.append(event)
+
+    @contextlib.contextmanager
+    def phase(self, name: str, owner=None):
+        """
+        Measure a phase like the language server startup. Durations of phases with the same name are summed up.
+
+        :param name:
+        :param owner:
+        :return:
+        """
+        start = self.now()
+        try:
+            yield
+        finally:
+            end = self.now()
+            self.phases[name] += end - start
+            self.span(name, "phase", start, end, owner)
+
+    def file_done(self, name: str, start: float, error: bool = False, owner=None):
+        """
+        Record the latency of a file from opening it on the language server until its result is complete
+        Files overlap in time so they are traced as async spans.
+
+        :param name:
+        :param start:
+        :param error: the file has been reported with an error
+        :param owner:
+        :return:
+        """
+        end = self.now()
+        self.file_latencies.append(end - start)
+        if error:
+            self.errors += 1
+        if not self.tracing:
+            return
+        self._next_async_id += 1
+        common = {"name": name, "cat": "file", "id": self._next_async_id, "pid": os.getpid(), "tid": self.thread(owner)}
+        self.events.append(dict(common, ph="b", ts=self._timestamp(start)))
+        self.events.append(dict(common, ph="e", ts=self._timestamp(end), args={"error": error}))
+
+    def sample(self, open_files: int, pending_requests: int):
+        """
+        Record the current depth of the open document window and of the requests waiting for a response
+
+        :param open_files:
+        :param pending_requests:
+        :return:
+        """
+        self.open_files.append(open_files)
+        self.pending_requests.append(pending_requests)
+        if self.tracing:
+            self.events.append({
+                "name": "queues",
+                "ph": "C",
+                "ts": self._timestamp(self.now()),
+                "pid": os.getpid(),
+                "args": {"open files": open_files, "pending requests": pending_requests}
+            })
+
+    def summary(self) -> dict:
+        latencies = self.file_latencies
+        return {
+            "elapsed": self.now() - self._origin,
+            "files": len(latencies),
+            "errors": self.errors,
+            "latency": {
+                "p50": percentile(latencies, 50),
+                "p95": percentile(latencies, 95),
+                "p99": percentile(latencies, 99),
+                "max": max(latencies, default=0.0)
+            },
+            "phases": dict(self.phases),
+            "rpc_sent": dict(self.rpc_sent),
+            "rpc_received": dict(self.rpc_received),
+            "rpc_latency": {
+                method: {"count": len(durations), "p50": percentile(durations, 50), "max": max(durations)}
+                for method, durations in self.rpc_durations.items()
+            },
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "open_files": {
+                "max": max(self.open_files, default=0),
+                "mean": sum(self.open_files) / len(self.open_files) if self.open_files else 0.0
+            },
+            "pending_requests": {
+                "max": max(self.pending_requests, default=0),
+                "mean": sum(self.pending_requests) / len(self.pending_requests) if self.pending_requests else 0.0
+            }
+        }
+
+    def format_summary(self) -> str:
+        summary = self.summary()
+        latency = summary["latency"]
+        lines = [
+            "%d files in %.2fs (%d errors)" % (summary["files"], summary["elapsed"], summary["errors"]),
+            "Per-file latency: p50 %.1fms, p95 %.1fms, p99 %.1fms, max %.1fms" % (
+                latency["p50"] * 1000, latency["p95"] * 1000, latency["p99"] * 1000, latency["max"] * 1000
+            )
+        ]
+        if summary["phases"]:
+            lines.append("Phases: " + ", ".join(
+                "%s %.2fs" % (name, duration) for name, duration in summary["phases"].items()
+            ))
+        lines.append("Sent: %s in %s" % (format_bytes(summary["bytes_sent"]), ", ".join(
+            "%d %s" % (count, method) for method, count in sorted(summary["rpc_sent"].items())
+        ) or "no messages"))
+        lines.append("Received: %s in %s" % (format_bytes(summary["bytes_received"]), ", ".join(
+            "%d %s" % (count, method) for method, count in sorted(summary["rpc_received"].items())
+        ) or "no messages"))
+        for method, rpc in sorted(summary["rpc_latency"].items()):
+            lines.append("  %s: %d requests, p50 %.1fms, max %.1fms" % (
+                method, rpc["count"], rpc["p50"] * 1000, rpc["max"] * 1000
+            ))
+        lines.append("Open files: max %d, mean %.1f. Pending requests: max %d, mean %.1f" % (
+            summary["open_files"]["max"], summary["open_files"]["mean"],
+            summary["pending_requests"]["max"], summary["pending_requests"]["mean"]
+        ))
+        return "\n".join(lines)
+
+    def write_trace(self, path: str):
+        """
+        Write all recorded spans in the Chrome trace event format
+
+        :param path:
+        :return:
+        """
+        with open(path, "w") as handle:
+            json.dump({"traceEvents": self.events or [], "displayTimeUnit": "ms"}, handle)
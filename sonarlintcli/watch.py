@@ -0,0 +1,210 @@
+import asyncio
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+import sys
+
+from sonarlintcli.discovery import FileFinder
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+
+# struct inotify_event without the variable length name
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+def load_inotify():
+    """
+    Load the inotify functions from libc or return None if they are not available on this platform
+
+    :return:
+    """
+    name = ctypes.util.find_library("c")
+    if name is None:
+        return None
+    try:
+        libc = ctypes.CDLL(name, use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class Watcher:
+    """
+    Base class for file watchers
+    start() returns all files matching the patterns and changes() yields (changed files, removed files) tuples
+    afterwards. All paths are absolute.
+    """
+
+    def __init__(self, patterns: list, excludes: list = None):
+        self._patterns = patterns
+        self._finder = FileFinder(excludes)
+
+    def _find(self, patterns, on_directory=None) -> list:
+        return [os.path.abspath(file) for file in self._finder.find(patterns, on_directory)]
+
+    def start(self) -> list:
+        raise NotImplementedError()
+
+    async def changes(self):
+        raise NotImplementedError()
+        yield
+
+    def close(self):
+        pass
+
+
+class PollingWatcher(Watcher):
+    """
+    Finds changes by rescanning the tree and comparing modification times and sizes every interval seconds
+    """
+
+    def __init__(self, patterns: list, excludes: list = None, interval: float = 1.0):
+        super().__init__(patterns, excludes)
+        self.interval = interval
+        self._stats = {}
+
+    def _scan(self) -> dict:
+        stats = {}
+        for file in self._find(self._patterns):
+            try:
+                stat = os.stat(file)
+            except OSError:
+                continue
+            stats[file] = (stat.st_mtime_ns, stat.st_size)
+        return stats
+
+    def start(self) -> list:
+        self._stats = self._scan()
+        return list(self._stats.keys())
+
+    async def changes(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            stats = self._scan()
+            changed = [file for file, stat in stats.items() if self._stats.get(file) != stat]
+            removed = [file for file in self._stats.keys() if file not in stats]
+            self._stats = stats
+            if len(changed) > 0 or len(removed) > 0:
+                yield changed, removed
+
+
+class InotifyWatcher(Watcher):
+    """
+    Watches every directory that the file discovery walks into with Linux inotify
+    New directories are watched as soon as they are created. Events are collected for a short debounce delay so an
+    editor saving a file in several steps results in a single change.
+    """
+
+    def __init__(self, libc, patterns: list, excludes: list = None, debounce: float = 0.1):
+        super().__init__(patterns, excludes)
+        self.debounce = debounce
+        self._libc = libc
+        self._fd = -1
+        self._directories = {}
+        self._changed = set()
+        self._removed = set()
+        self._queue: asyncio.Queue = None
+        self._flush_handle = None
+
+    def _add_watch(self, directory):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                print("Could not watch %s: inotify watch limit reached" % directory, file=sys.stderr)
+            return
+        self._directories[wd] = directory
+
+    def start(self) -> list:
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._queue = asyncio.Queue()
+        files = self._find(self._patterns, self._add_watch)
+        asyncio.get_event_loop().add_reader(self._fd, self._read_events)
+        return files
+
+    def _read_events(self):
+        try:
+            data = os.read(self._fd, 1024 * 64)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + INOTIFY_EVENT.size:offset + INOTIFY_EVENT.size + length].rstrip(b"\0"))
+            offset += INOTIFY_EVENT.size + length
+            self._handle_event(wd, mask, name)
+        if self._flush_handle is None and (len(self._changed) > 0 or len(self._removed) > 0):
+            self._flush_handle = asyncio.get_event_loop().call_later(self.debounce, self._flush)
+
+    def _handle_event(self, wd, mask, name):
+        if mask & IN_IGNORED:
+            self._directories.pop(wd, None)
+            return
+        directory = self._directories.get(wd)
+        if directory is None or name == '':
+            return
+        path = os.path.join(directory, name)
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                # watch the new directory and treat all files that are already inside as changed
+                self._changed.update(self._find([os.path.join(path, "**", "*")], self._add_watch))
+            return
+        if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+            self._removed.discard(path)
+            self._changed.add(path)
+        elif mask & (IN_DELETE | IN_MOVED_FROM):
+            self._changed.discard(path)
+            self._removed.add(path)
+
+    def _flush(self):
+        self._flush_handle = None
+        changed = self._finder.filter(sorted(self._changed), self._patterns)
+        removed = self._finder.filter(sorted(self._removed), self._patterns)
+        self._changed.clear()
+        self._removed.clear()
+        if len(changed) > 0 or len(removed) > 0:
+            self._queue.put_nowait((changed, removed))
+
+    async def changes(self):
+        while True:
+            yield await self._queue.get()
+
+    def close(self):
+        if self._fd >= 0:
+            asyncio.get_event_loop().remove_reader(self._fd)
+            os.close(self._fd)
+            self._fd = -1
+
+
+def create_watcher(patterns: list, excludes: list = None, poll: bool = False, interval: float = 1.0) -> Watcher:
+    """
+    Create an inotify based watcher if possible and fall back to polling otherwise
+
+    :param patterns:
+    :param excludes:
+    :param poll: always use polling
+    :param interval: seconds between two scans when polling
+    :return:
+    """
+    libc = None if poll else load_inotify()
+    if libc is None:
+        return PollingWatcher(patterns, excludes, interval)
+    return InotifyWatcher(libc, patterns, excludes)